@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""
+  A local copy of the Gerrit account names, for checking reviewers before
+  asking Gerrit to add them.
+"""
+
+from threading import Thread, Lock
+import logging
+import time
+
+logger = logging.getLogger('gerrit_reviewer.accounts')
+
+
+def parse_ls_members (lines, email_domain):
+  """Account names from 'gerrit ls-members' output.
+
+  The output is a tab separated table with a header row.  Both the
+  usernames and the part before the @ of emails in email_domain are
+  returned, since reviewers are added as name@email_domain.
+  """
+  names = set()
+  columns = None
+  for line in lines:
+    fields = line.rstrip("\n").split("\t")
+    if columns is None:
+      columns = fields
+      continue
+    row = dict(zip(columns, fields))
+    username = row.get("username", "")
+    if username not in ("", "n/a"):
+      names.add(username)
+    email = row.get("email", "")
+    if email.endswith("@" + email_domain):
+      names.add(email[:-len(email_domain) - 1])
+  return names
+
+
+def account_name (address, email_domain):
+  """The account name of a reviewer Gerrit reported: the part before the @ of
+  an email in email_domain, or the name itself (a username or group)"""
+  address = address.strip()
+  if address.endswith("@" + email_domain):
+    return address[:-len(email_domain) - 1]
+  return address
+
+
+class AccountDirectory:
+  """The set of known account names, refreshed every ttl seconds.
+
+  fetch() returns all the account names and is called from a background
+  thread once start() was called.  If it fails, the last set is kept.
+
+  Names Gerrit rejected are remembered for negative_ttl seconds with
+  add_invalid(), and only those are invalid by default.  A name that's
+  just missing from the set may be an account outside of the listed group
+  or a group name, which Gerrit accepts, so it's counted as unknown and
+  left to Gerrit.  With strict, names missing from the set are invalid too.
+  """
+  def __init__ (self, fetch, ttl = 3600, negative_ttl = 600):
+    self.fetch = fetch
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.lock = Lock()
+    self.names = None       # None until the first fetch worked
+    self.loaded_at = 0
+    self.invalid = {}       # name => time it was rejected
+    self.refreshes = 0
+    self.refresh_failures = 0
+    self.unknown = 0
+    self.thread = None
+
+  def refresh (self):
+    try:
+      names = set(self.fetch())
+    except Exception, e:
+      logger.error("Couldn't refresh the account directory: %s", e)
+      self.refresh_failures += 1
+      return False
+    if len(names) == 0:
+      logger.error("Account directory refresh returned no accounts, keeping the old ones")
+      self.refresh_failures += 1
+      return False
+    self.lock.acquire()
+    try:
+      self.names = names
+      self.loaded_at = time.time()
+      self.refreshes += 1
+    finally:
+      self.lock.release()
+    logger.info("Account directory has %d accounts", len(names))
+    return True
+
+  def start (self):
+    """Fill the directory now and refresh it in the background"""
+    self.refresh()
+    self.thread = Thread(name="account_directory", target=self._refresh_loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _refresh_loop (self):
+    while True:
+      time.sleep(self.ttl)
+      self.refresh()
+
+  def add_invalid (self, names):
+    """Remember names Gerrit said aren't registered users"""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      for name in names:
+        self.invalid[name] = now
+        if self.names is not None:
+          self.names.discard(name)
+    finally:
+      self.lock.release()
+
+  def find_invalid (self, names, strict = False):
+    """Returns the names in names that Gerrit rejected, or that aren't known accounts with strict"""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      for name in self.invalid.keys():
+        if now - self.invalid[name] > self.negative_ttl:
+          del self.invalid[name]
+      invalid = []
+      for name in names:
+        if name in self.invalid:
+          invalid.append(name)
+        elif self.names is not None and name not in self.names:
+          if strict:
+            invalid.append(name)
+          else:
+            self.unknown += 1
+            logger.debug("%s isn't in the account directory, leaving it to Gerrit", name)
+      return invalid
+    finally:
+      self.lock.release()
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      accounts = 0
+      if self.names is not None:
+        accounts = len(self.names)
+      age = 0
+      if self.loaded_at > 0:
+        age = time.time() - self.loaded_at
+      return {"accounts": accounts, "invalid": len(self.invalid), "unknown": self.unknown, "age": age,
+              "refreshes": self.refreshes, "refresh_failures": self.refresh_failures}
+    finally:
+      self.lock.release()
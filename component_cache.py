@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+  A cache of parsed component maps, keyed by the blob sha of the components file.
+"""
+
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('gerrit_reviewer.component_cache')
+
+
+class ComponentCache:
+  """LRU cache of parsed component maps.
+
+  Keys are (kind, blob sha, ...) tuples, so an entry never goes stale: a new
+  version of a components file has a new blob sha and gets a new entry.
+  The least recently used entry is evicted once max_entries is reached.
+
+  If a path is given, the cache is saved to disk after a miss, at most
+  once every save_interval seconds; save_soon() saves the misses that came
+  after that.  It can be loaded from the file again at start up.
+  """
+  def __init__ (self, max_entries = 32, path = None, save_interval = 60):
+    self.max_entries = max(1, int(max_entries))
+    self.path = path
+    self.save_interval = save_interval
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.save_lock = threading.Lock() # One writer of self.path at a time
+    self.dirty = False
+    self.last_save = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__ (self):
+    return len(self.entries)
+
+  def values (self):
+    """Returns a list of the cached values"""
+    self.lock.acquire()
+    try:
+      return self.entries.values()
+    finally:
+      self.lock.release()
+
+  def stats (self):
+    """Returns a dict of the counters"""
+    return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "entries": len(self.entries)}
+
+  def get (self, key, build):
+    """Get the value for key, calling build() to create it on a miss"""
+    self.lock.acquire()
+    try:
+      if key in self.entries:
+        value = self.entries.pop(key)
+        self.entries[key] = value # Most recently used goes to the end
+        self.hits += 1
+        logger.debug("Component cache hit for %s %s (hits %d, misses %d, evictions %d)",
+                     key[0], key[1], self.hits, self.misses, self.evictions)
+        return value
+    finally:
+      self.lock.release()
+
+    # Build outside the lock, parsing can take a while
+    value = build()
+
+    self.lock.acquire()
+    try:
+      self.misses += 1
+      self.dirty = True
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_entries:
+        evicted = self.entries.popitem(last = False)[0]
+        self.evictions += 1
+        logger.info("Component cache evicted %s %s", evicted[0], evicted[1])
+      logger.info("Component cache miss for %s %s (hits %d, misses %d, evictions %d)",
+                  key[0], key[1], self.hits, self.misses, self.evictions)
+    finally:
+      self.lock.release()
+    self.save_soon()
+    return value
+
+  def clear (self):
+    self.lock.acquire()
+    try:
+      self.entries.clear()
+    finally:
+      self.lock.release()
+
+  def save_soon (self):
+    """Save the cache if it changed and wasn't saved in the last save_interval seconds"""
+    if self.dirty and time.time() - self.last_save >= self.save_interval:
+      self.save()
+
+  def save (self):
+    """Write the cache entries to self.path (if set)"""
+    if self.path is None:
+      return
+    self.save_lock.acquire()
+    try:
+      self.lock.acquire()
+      try:
+        entries = list(self.entries.items())
+        self.dirty = False
+      finally:
+        self.lock.release()
+      self.last_save = time.time()
+      temp_path = None
+      try:
+        # A temp file of its own next to self.path, so the rename stays on one filesystem
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                         dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(fd, "wb") as f:
+          pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, self.path)
+        logger.debug("Saved %d component cache entries to %s", len(entries), self.path)
+      except Exception, e:
+        logger.error("Couldn't save component cache to %s: %s", self.path, e)
+        self.dirty = True
+        if temp_path is not None and os.path.exists(temp_path):
+          os.remove(temp_path)
+    finally:
+      self.save_lock.release()
+
+  def load (self):
+    """Read the cache entries from self.path (if set and it exists)"""
+    if self.path is None or not os.path.isfile(self.path):
+      return
+    try:
+      with open(self.path, "rb") as f:
+        entries = pickle.load(f)
+    except Exception, e:
+      logger.error("Couldn't load component cache from %s: %s", self.path, e)
+      return
+    self.lock.acquire()
+    try:
+      for key, value in entries[-self.max_entries:]:
+        self.entries[key] = value
+    finally:
+      self.lock.release()
+    logger.info("Loaded %d component cache entries from %s", len(self.entries), self.path)
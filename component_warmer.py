@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+  Rebuilds the component maps of the branches whose components files
+  changed, on background threads, so neither the main loop nor a review
+  worker waits for the check.
+"""
+
+from threading import Lock, Event
+import logging
+
+import event_dispatcher
+
+logger = logging.getLogger('gerrit_reviewer.warmer')
+
+
+def keep_newest (old, new):
+  return new
+
+
+class ComponentWarmer:
+  """Checks branch updates for components file changes.
+
+  put(project, branch, event) marks project stale right away.  At most one
+  update per (project, branch) waits: a newer one is merged into it with
+  merge(waiting event, new event).  check(event) runs on one of workers
+  threads, one project at a time, and returns True if the update changed
+  a components file.  build(event) then builds the new maps.  The project
+  stays stale until all its waiting updates are checked and built, and
+  reviews call wait(project) first, so they never use maps an update they
+  came after made stale.
+  """
+  def __init__ (self, check, build, workers = 2, merge = keep_newest):
+    self.check = check
+    self.build = build
+    self.merge = merge
+    self.lock = Lock()
+    self.pending = {} # (project, branch) => event
+    self.stale = {}   # project => [updates not done yet, Event set when they're done]
+    self.dispatcher = event_dispatcher.ProjectDispatcher(max(1, workers), self._handle)
+    self.checked = 0
+    self.built = 0
+    self.merged = 0
+    self.failures = 0
+
+  def start (self):
+    self.dispatcher.start()
+
+  def put (self, project, branch, event):
+    key = (project, branch)
+    self.lock.acquire()
+    try:
+      if key in self.pending:
+        self.pending[key] = self.merge(self.pending[key], event)
+        self.merged += 1
+        return
+      self.pending[key] = event
+      if project not in self.stale:
+        self.stale[project] = [0, Event()]
+      self.stale[project][0] += 1
+    finally:
+      self.lock.release()
+    self.dispatcher.submit(project, key)
+
+  def wait (self, project, timeout = None):
+    """Wait until project's updates are checked and built.  Returns False if they aren't after timeout seconds."""
+    self.lock.acquire()
+    try:
+      entry = self.stale.get(project)
+    finally:
+      self.lock.release()
+    if entry is None:
+      return True
+    entry[1].wait(timeout)
+    return entry[1].is_set()
+
+  def _handle (self, key, worker_index):
+    self.lock.acquire()
+    try:
+      event = self.pending.pop(key)
+    finally:
+      self.lock.release()
+    try:
+      changed = self.check(event)
+      self.checked += 1
+      if changed:
+        self.build(event)
+        self.built += 1
+    except Exception, e:
+      logger.exception("Error warming the component maps of %s: %s", key, e)
+      self.failures += 1
+    finally:
+      self.lock.acquire()
+      try:
+        entry = self.stale[key[0]]
+        entry[0] -= 1
+        if entry[0] == 0:
+          del self.stale[key[0]]
+          entry[1].set()
+      finally:
+        self.lock.release()
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      return {"queued": len(self.pending), "stale_projects": len(self.stale), "checked": self.checked,
+              "built": self.built, "merged": self.merged, "failures": self.failures}
+    finally:
+      self.lock.release()
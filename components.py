@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict
 import os
 import re
+import threading
 
 
 class Component:
@@ -113,6 +118,80 @@ def find_component (components, item, delim="."):
   return (None, None)
 
 
+class PackageTrie:
+  """Segment trie version of find_component.
+
+  The keys of a components dict are split on delim ('.' for packages, '/'
+  for paths) once, into a tree of segments.  A lookup walks the item's
+  segments down the tree and remembers the deepest key it passed, so the
+  longest matching prefix is found in one walk instead of one dict probe
+  per rsplit.
+
+  The tree is built on the first lookup and isn't pickled, so a trie that's
+  cached but never searched costs no more than its components dict.
+
+  Nodes are lists of [str key or None, Component or None, dict children].
+  """
+  def __init__ (self, components, delim = "."):
+    self.components = components
+    self.delim = delim
+    self.root = None
+
+  def __getstate__ (self):
+    state = dict(self.__dict__)
+    state["root"] = None
+    return state
+
+  def _build (self):
+    components = self.components
+    delim = self.delim
+    root = [None, None, {}]
+    for key in components.keys():
+      node = root
+      for segment in key.split(delim):
+        children = node[2]
+        if segment not in children:
+          children[segment] = [None, None, {}]
+        node = children[segment]
+      node[0] = key
+      node[1] = components[key]
+    self.root = root
+
+  def find (self, item):
+    """Returns a tuple: (str match_found, Component matching_component)"""
+    if self.root is None:
+      self._build()
+    item = str(item)
+    delim = self.delim
+    found = (None, None)
+    node = self.root
+    start = 0
+    while True:
+      end = item.find(delim, start)
+      if end == -1:
+        node = node[2].get(item[start:])
+      else:
+        node = node[2].get(item[start:end])
+      if node is None:
+        return found
+      if node[0] is not None:
+        found = (node[0], node[1])
+      if end == -1:
+        return found
+      start = end + len(delim)
+
+  def find_all (self, items):
+    """Look up every item.
+
+    Returns a list of tuples: (str item, str match_found, Component matching_component)
+    """
+    matches = []
+    for item in items:
+      (match, component) = self.find(item)
+      matches.append((item, match, component))
+    return matches
+
+
 def find_component_re (components, item):
   """Search for a component using regex strings.
 
@@ -128,6 +207,146 @@ def find_component_re (components, item):
   return (None, None)
 
 
+# Python 2 re only supports 100 groups per pattern, keep some headroom
+MAX_GROUPS_PER_CHUNK = 90
+# Backreferences are numbered and inline flags apply to the whole pattern,
+#  so rules using them can't be moved into a combined pattern
+STANDALONE_RULE = re.compile(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]+\)")
+
+class ComponentMatcher:
+  """Compiled, priority ordered version of find_component_re.
+
+  The regex keys of a components dict are compiled once.  Consecutive
+  regexes are combined into a single alternation where each rule is
+  wrapped as ([\s\S]*?rule) and the alternation is anchored with re.match.
+  [\s\S] rather than . so that, like re.search, a rule can still match
+  after a newline in the item.
+  At position 0 the alternatives are tried in order, and each one scans
+  the whole item, so the first rule (in dict order) that re.search would
+  find is the one that wins.
+
+  Rules that can't be combined (backreferences, inline flags, bad syntax
+  in the combined form) are kept as their own compiled pattern.  Rules
+  that don't compile at all are skipped and listed in self.invalid.
+
+  The results of match() are kept for the last memo_size items (0 turns
+  it off), since the same paths come up change after change.  A matcher
+  is built for one version of a components file, so the memo never has
+  to be invalidated.
+  """
+  def __init__ (self, components, memo_size = 0):
+    self.components = components
+    self.memo_size = max(0, int(memo_size))
+    self.memo = OrderedDict() # item => (str regex_match, Component matching_component)
+    self.memo_lock = threading.Lock()
+    self.memo_hits = 0
+    self.memo_misses = 0
+    self.invalid = []
+    self.chunks = []
+    pending = []
+    pending_groups = 0
+    for key in components.keys():
+      try:
+        compiled = re.compile(key)
+      except (re.error, AssertionError), e:
+        self.invalid.append((key, str(e)))
+        continue
+      if STANDALONE_RULE.search(key) or compiled.groups + 1 > MAX_GROUPS_PER_CHUNK:
+        self._flush(pending)
+        pending, pending_groups = [], 0
+        self.chunks.append((compiled, key, None))
+        continue
+      if pending_groups + compiled.groups + 1 > MAX_GROUPS_PER_CHUNK:
+        self._flush(pending)
+        pending, pending_groups = [], 0
+      pending.append((key, compiled))
+      pending_groups += compiled.groups + 1
+    self._flush(pending)
+
+  def __getstate__ (self):
+    # Only the components are pickled, the patterns are compiled again on load
+    return (self.components, self.memo_size)
+
+  def __setstate__ (self, state):
+    if isinstance(state, tuple):
+      self.__init__(state[0], state[1])
+    else:
+      self.__init__(state)
+
+  def _flush (self, pending):
+    """Add a list of (key, compiled) as one combined chunk"""
+    if len(pending) == 0:
+      return
+    if len(pending) > 1:
+      parts = []
+      group_keys = {}
+      group_index = 1
+      for key, compiled in pending:
+        parts.append(r"([\s\S]*?(?:" + key + "))")
+        group_keys[group_index] = key
+        group_index += compiled.groups + 1
+      try:
+        self.chunks.append((re.compile("|".join(parts)), None, group_keys))
+        return
+      except (re.error, AssertionError):
+        pass # Fall back to the individual patterns
+    for key, compiled in pending:
+      self.chunks.append((compiled, key, None))
+
+  def match (self, item):
+    """Returns a tuple: (str regex_match, Component matching_component)"""
+    if self.memo_size == 0:
+      return self._match(item)
+    self.memo_lock.acquire()
+    try:
+      if item in self.memo:
+        result = self.memo.pop(item)
+        self.memo[item] = result # Most recently used goes to the end
+        self.memo_hits += 1
+        return result
+    finally:
+      self.memo_lock.release()
+    result = self._match(item)
+    self.memo_lock.acquire()
+    try:
+      self.memo_misses += 1
+      self.memo[item] = result
+      if len(self.memo) > self.memo_size:
+        self.memo.popitem(last = False)
+    finally:
+      self.memo_lock.release()
+    return result
+
+  def memo_stats (self):
+    """Returns a dict of the memo counters"""
+    return {"hits": self.memo_hits, "misses": self.memo_misses, "entries": len(self.memo)}
+
+  def _match (self, item):
+    for pattern, key, group_keys in self.chunks:
+      if group_keys is None:
+        if pattern.search(item) is not None:
+          return (key, self.components[key])
+      else:
+        m = pattern.match(item)
+        if m is not None:
+          index = m.lastindex
+          if index not in group_keys:
+            index = [i for i in sorted(group_keys.keys()) if m.start(i) != -1][0]
+          return (group_keys[index], self.components[group_keys[index]])
+    return (None, None)
+
+  def match_all (self, items):
+    """Match every item.
+
+    Returns a list of tuples: (str item, str regex_match, Component matching_component)
+    """
+    matches = []
+    for item in items:
+      (match, component) = self.match(item)
+      matches.append((item, match, component))
+    return matches
+
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+  Holds comment-added events for a short time so that a burst of events for
+  one change is processed once, for its newest patch set.
+"""
+
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger('gerrit_reviewer.coalescer')
+
+
+def is_verified (event_json):
+  for approval in event_json.get("approvals", []):
+    if approval["type"] == "Verified" and approval["value"] == "1":
+      return True
+  return False
+
+def patch_number (event_json):
+  try:
+    return int(event_json["patchSet"]["number"])
+  except (KeyError, ValueError):
+    return 0
+
+
+class EventCoalescer:
+  """Pending Verified+1 comment-added events, one per change.
+
+  An event is held for settle_seconds after the first event for its change
+  arrived.  A Verified+1 event for the same or a newer patch set replaces
+  the pending one and keeps its place, so a burst of CI votes ends up as
+  one event.  Any comment-added for a newer patch set also drops a pending
+  event for an older one, since it would only be skipped as not current.
+  Other events that aren't Verified+1 are dropped; they're never reviewed.
+  """
+  def __init__ (self, settle_seconds):
+    self.settle_seconds = settle_seconds
+    self.lock = Lock()
+    self.pending = {} # (project, change number) => [deadline, event_json]
+    self.replaced = 0
+    self.dropped = 0
+
+  def add (self, event_json, now = None):
+    """Add an event.  Returns True if it's pending now."""
+    if now is None:
+      now = time.time()
+    key = (event_json["change"]["project"], event_json["change"]["number"])
+    verified = is_verified(event_json)
+    self.lock.acquire()
+    try:
+      entry = self.pending.get(key)
+      if entry is not None and patch_number(event_json) >= patch_number(entry[1]):
+        if verified:
+          logger.debug("Change %s/%s replaces pending patch set %s", key[1],
+                       event_json["patchSet"]["number"], entry[1]["patchSet"]["number"])
+          entry[1] = event_json
+          self.replaced += 1
+          return True
+        if patch_number(event_json) > patch_number(entry[1]):
+          logger.debug("Change %s/%s makes pending patch set %s stale", key[1],
+                       event_json["patchSet"]["number"], entry[1]["patchSet"]["number"])
+          del self.pending[key]
+          self.dropped += 1
+      if not verified:
+        return False
+      if entry is not None and key in self.pending:
+        # Older patch set than the pending one
+        self.dropped += 1
+        return False
+      self.pending[key] = [now + self.settle_seconds, event_json]
+      return True
+    finally:
+      self.lock.release()
+
+  def next_deadline (self):
+    """The time the next pending event is ready, or None if there are none"""
+    self.lock.acquire()
+    try:
+      if len(self.pending) == 0:
+        return None
+      return min([entry[0] for entry in self.pending.values()])
+    finally:
+      self.lock.release()
+
+  def pop_ready (self, now = None):
+    """Remove and return the events whose settle time is over, oldest first"""
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      ready = [(entry[0], key) for key, entry in self.pending.items() if entry[0] <= now]
+      ready.sort()
+      return [self.pending.pop(key)[1] for deadline, key in ready]
+    finally:
+      self.lock.release()
+
+  def drain (self):
+    """Remove and return all the pending events, oldest first"""
+    return self.pop_ready(float("inf"))
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      return {"pending": len(self.pending), "replaced": self.replaced, "dropped": self.dropped}
+    finally:
+      self.lock.release()
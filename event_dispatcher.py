@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+  Hands events to a pool of worker threads, one project at a time.
+"""
+
+from Queue import Queue
+from threading import Thread, Lock
+import collections
+import logging
+
+logger = logging.getLogger('gerrit_reviewer.dispatcher')
+
+
+class ProjectDispatcher:
+  """Process events on worker threads.
+
+  Events for the same project are handled in the order they were submitted
+  and never at the same time.  Events for different projects are handled
+  in parallel by up to number_workers threads.
+
+  handler is called as handler(event, worker_index).  With 0 workers the
+  handler is called right away on the submitting thread with worker_index
+  None.
+
+  Nothing limits how many events wait here, the submitter has to check
+  queued() before it submits more.
+  """
+  def __init__ (self, number_workers, handler):
+    self.number_workers = max(0, int(number_workers))
+    self.handler = handler
+    self.lock = Lock()
+    self.pending = {}       # project => deque of events
+    self.scheduled = set()  # projects in ready or being worked on
+    self.ready = Queue()
+    self.threads = []
+    self.stopped = False
+
+  def start (self):
+    for index in range(self.number_workers):
+      worker = Thread(name="worker-%d" % index, target=self._work, args=(index,))
+      worker.daemon = True
+      worker.start()
+      self.threads.append(worker)
+    if self.number_workers > 0:
+      logger.info("Started %d event workers", self.number_workers)
+
+  def submit (self, project, event):
+    if self.number_workers == 0:
+      self._handle(event, None)
+      return
+    self.lock.acquire()
+    try:
+      if project not in self.pending:
+        self.pending[project] = collections.deque()
+      self.pending[project].append(event)
+      if project not in self.scheduled:
+        self.scheduled.add(project)
+        self.ready.put(project)
+    finally:
+      self.lock.release()
+
+  def queued (self):
+    """Number of events waiting for a worker"""
+    self.lock.acquire()
+    try:
+      return sum([len(i) for i in self.pending.values()])
+    finally:
+      self.lock.release()
+
+  def drain (self):
+    """Stop handing events to the workers and return the waiting ones, oldest first per project"""
+    self.lock.acquire()
+    try:
+      self.stopped = True
+      events = []
+      for project in self.pending.keys():
+        events.extend(self.pending[project])
+        self.pending[project].clear()
+      return events
+    finally:
+      self.lock.release()
+
+  def _handle (self, event, worker_index):
+    try:
+      self.handler(event, worker_index)
+    except Exception, e:
+      logger.exception("Error processing event: %s", e)
+
+  def _work (self, index):
+    while True:
+      project = self.ready.get()
+      event = None
+      self.lock.acquire()
+      try:
+        if not self.stopped:
+          event = self.pending[project].popleft()
+      finally:
+        self.lock.release()
+      if event is None:
+        continue # Drained
+
+      self._handle(event, index)
+
+      self.lock.acquire()
+      try:
+        if len(self.pending[project]) > 0:
+          self.ready.put(project)
+        else:
+          del self.pending[project]
+          self.scheduled.discard(project)
+      finally:
+        self.lock.release()
@@ -11,53 +11,133 @@ try:
   from collections import OrderedDict
 except ImportError:
   from ordereddict import OrderedDict
-from Queue import Queue, Empty
-from threading import Thread, Timer
+from Queue import Empty
+from threading import Lock
 import collections
+import account_directory
+import component_cache
+import component_warmer
+import contextlib
+import copy
+import event_coalescer
 import components
+import event_dispatcher
 import getpass
 import git
+import git_batch
+import git_process
 import json
 import logging
 import logging.handlers
+import mail_queue
+import metrics
+import query_batcher
 import os
 import paramiko
 import platform
 import re
+import repo_maintenance
+import repo_registry
+import reviewer_set
 import sendMail
 import signal
+import spill_queue
 import sys
-import thread
 import time
 
+import gerrit_ssh
 import gerrit_stream_events
 
-# Load Options
+# Options (set from the config json file by load_options)
 options = None
-if len(sys.argv) < 2:
-    print "Please pass in a config json file as the first argument."
-    print ""
-    print "Usage %s CONFIGFILE.json" % sys.argv[0]
-    sys.exit(1)
-options_file = sys.argv[1]
-if not os.path.isfile(options_file):
-  print "%s options file not found." % sys.argv[1]
-  sys.exit(1)
-with open(options_file, "r") as f:
-  options = json.load(f)
-GITREPOS = options["gitrepos"]
-GITREMOTE = str(options["gitremote"])
-USERNAME = str(options["username"])
-KEYFILE = str(options["keyfile"])
-GERRIT_HOST = str(options["hostname"])
-ADD_REVIEWERS = options["addreviewers"]
-ADD_COMMENT = options["addcomment"]
-SEND_EMAILS = options["sendemails"]
-MERGE_REVIEWERS = options["mergereviewers"]
-SMTP_SERVER = options["smtpserver"]
-EMAIL_FROM = options["emailfrom"]
-IGNORED_COMPONENTS = options["ignoredcomponents"]
-USERS_EMAIL_DOMAIN = options["usersemaildomain"]
+options_lock = Lock()
+
+def load_options(options_file):
+  """Read the config json file and set the option globals"""
+  with open(options_file, "r") as f:
+    set_options(json.load(f))
+
+def parse_options(options):
+  """The option globals for the dict of a config json file, by name, with
+  the defaults filled in.  Raises KeyError, ValueError or TypeError if the
+  file has bad or missing options."""
+  settings = {"options": options}
+  # A copy with the defaults filled in, the workers never see a repo without them
+  settings["GITREPOS"] = copy.deepcopy(options["gitrepos"])
+  for repo in settings["GITREPOS"].keys():
+    if "regexbranch" not in settings["GITREPOS"][repo]:
+      settings["GITREPOS"][repo]["regexbranch"] = "master"
+  settings["GITREMOTE"] = str(options["gitremote"])
+  settings["USERNAME"] = str(options["username"])
+  settings["KEYFILE"] = str(options["keyfile"])
+  settings["GERRIT_HOST"] = str(options["hostname"])
+  settings["ADD_REVIEWERS"] = options["addreviewers"]
+  settings["ADD_COMMENT"] = options["addcomment"]
+  settings["SEND_EMAILS"] = options["sendemails"]
+  settings["MERGE_REVIEWERS"] = options["mergereviewers"]
+  settings["SMTP_SERVER"] = str(options["smtpserver"])
+  settings["EMAIL_FROM"] = str(options["emailfrom"])
+  settings["IGNORED_COMPONENTS"] = options["ignoredcomponents"]
+  settings["USERS_EMAIL_DOMAIN"] = options["usersemaildomain"]
+  settings["COMPONENT_CACHE_SIZE"] = int(options.get("componentcachesize", 32))
+  settings["COMPONENT_CACHE_FILE"] = options.get("componentcachefile", None)
+  settings["SSH_POOL_SIZE"] = int(options.get("sshpoolsize", 2))
+  settings["SSH_IDLE_CHECK"] = int(options.get("sshidlecheck", 60))
+  settings["NUMBER_WORKERS"] = int(options.get("workers", 0))
+  settings["FETCH_FREE"] = options.get("fetchfree", False)
+  settings["QUEUE_SPILL_FILE"] = str(options.get("queuespillfile", "gerrit_events.spill"))
+  settings["QUEUE_HIGH_WATERMARK"] = int(options.get("queuehighwatermark", 10000))
+  settings["QUEUE_LOW_WATERMARK"] = int(options.get("queuelowwatermark", 1000))
+  settings["DISPATCH_LIMIT"] = max(1, int(options.get("dispatchlimit", 100)))
+  settings["TIMEOUT_FETCH"] = int(options.get("timeoutfetch",120))
+  settings["TIMEOUT_TOUCHED_FILES"] = int(options.get("timeouttouchedfiles", 15))
+  settings["TIMEOUT_COMMIT_MESSAGE"] = int(options.get("timeoutcommitmessage", 15))
+  settings["METRICS_PORT"] = options.get("metricsport", None)
+  settings["METRICS_ADDRESS"] = str(options.get("metricsaddress", "127.0.0.1"))
+  settings["SETTLE_SECONDS"] = float(options.get("settleseconds", 0))
+  settings["EMAIL_RETRIES"] = int(options.get("emailretries", 3))
+  settings["EMAIL_DIGEST_SECONDS"] = float(options.get("emaildigestseconds", 0))
+  settings["ACCOUNTS_COMMAND"] = options.get("accountscommand", None)
+  if settings["ACCOUNTS_COMMAND"] is not None:
+    settings["ACCOUNTS_COMMAND"] = str(settings["ACCOUNTS_COMMAND"])
+  settings["ACCOUNTS_TTL"] = int(options.get("accountsttl", 3600))
+  settings["ACCOUNTS_STRICT"] = options.get("accountsstrict", False)
+  settings["QUERY_BATCH_SIZE"] = int(options.get("querybatchsize", 50))
+  settings["QUERY_MAX_AGE"] = float(options.get("querymaxage", 5))
+  settings["PACKAGES_DELIMITER"] = str(options.get("packagesdelimiter", "."))
+  settings["MATCH_CACHE_SIZE"] = int(options.get("matchcachesize", 10000))
+  settings["MAX_TOUCHED_FILES"] = int(options.get("maxtouchedfiles", 5000)) or None # 0 for no cap
+  settings["REPO_IDLE_SECONDS"] = int(options.get("repoidleseconds", 900))
+  settings["REPO_LOCK_TIMEOUT"] = float(options.get("repolocktimeout", 30))
+  settings["MAINTENANCE_INTERVAL"] = float(options.get("maintenanceinterval", 0))
+  settings["MAINTENANCE_WORKERS"] = int(options.get("maintenanceworkers", 2))
+  settings["WARMER_WORKERS"] = int(options.get("warmerworkers", 2))
+  settings["GC_LOOSE_OBJECTS"] = int(options.get("gclooseobjects", 6700))
+  settings["GC_PACKS"] = int(options.get("gcpacks", 50))
+  settings["OBJECT_POOL"] = options.get("objectpool", None)
+  settings["CLONE_URL"] = str(options.get("cloneurl", settings["USERNAME"] + "@" + settings["GERRIT_HOST"] + ":%s"))
+  settings["DEBUG_LOGGING"] = bool(options.get("debuglogging", False))
+  return settings
+
+def set_options(new_options):
+  """Set the option globals from the dict of a config json file.
+
+  All of them are built and checked off to the side first, so a bad file
+  changes none of them, and then swapped in at once under options_lock.
+  """
+  settings = parse_options(new_options)
+  options_lock.acquire()
+  try:
+    globals().update(settings)
+  finally:
+    options_lock.release()
+
+# Options that are only read at start up, changing them needs a restart
+RESTART_OPTIONS = ["hostname", "username", "keyfile", "sshpoolsize", "sshidlecheck", "workers",
+                   "queuespillfile", "queuehighwatermark", "queuelowwatermark", "metricsport",
+                   "metricsaddress", "componentcachesize", "componentcachefile", "smtpserver",
+                   "sendemails", "accountscommand", "maintenanceinterval", "objectpool",
+                   "warmerworkers"]
 
 # Constants
 REQUEST_CR = "CRR: "
@@ -65,69 +145,116 @@ OPTIN = "AUTOREVIEW"
 EMAIL_OPTIN = "EMAILREVIEW"
 NOSUBMIT = "NOSUBMIT"
 CHANGE_REF = "GERRIT_MONITOR"
-CONNECTION_CHECK_INTERVAL = 60 #seconds
+CONNECTION_CHECK_INTERVAL = 5 #seconds
+STREAM_BACKOFF = 1 # seconds, doubled after each failed reconnect
+STREAM_MAX_BACKOFF = 120 # seconds
+CATCH_UP_MARGIN = 5 # seconds before the stream dropped that are queried again
+SEEN_VOTES = 10000 # Verified+1 votes remembered, so catching up doesn't review them twice
 QUEUE_TIMEOUT = 5 # seconds
+DISPATCH_WAIT = 0.5 # seconds between checks while the workers are behind
+PREFILTER_LOG_INTERVAL = 1000 # lines
+QUEUE_REPORT_INTERVAL = 60 # seconds
+OMITTED_FILES_SUMMARY = 10 # directories listed for files over maxtouchedfiles
 AUTHOR_NO_ONE = "noone"
 AUTHOR_IGNORED = "ignored"
 INVALID_USERS = "error: could not add (.*): (.*) does not identify a registered user or group"
 MULTIPLE_CHANGES = "matches multiple changes"
+NULL_REV = "0" * 40 # oldRev of a new branch and newRev of a deleted one
 
-# Debug-based settings
-CONNECTION_DOT = False
-
-# Set up Logger
+# Logger (handlers are added by set_up_logging)
 logger = logging.getLogger('gerrit_reviewer')
 logger.setLevel(logging.DEBUG)
-fh = logging.handlers.RotatingFileHandler('gerrit_reviewer.log', maxBytes=100 * 1024**2)
-fh.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-if options["debuglogging"]:
-  ch.setLevel(logging.DEBUG)
-else:
-  ch.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(message)s')
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
-
-exit_code = 0
-
-logger.info("----------------- %s started -------------------", sys.argv[0])
-
-
-#
-# Thread Functions
-#
 
-def check_connection(sshclient):
-  global exit_code
-  logger.info("Entering connection check loop")
-  while True:
-    if not sshclient.get_transport().is_active():
-      logger.critical("SSH Connection is down. Ending " + sys.argv[0])
-      clean_up()
-      exit_code = 1
-      thread.interrupt_main()
-    else:
-      if CONNECTION_DOT:
-        sys.stdout.write(".")
-        sys.stdout.flush()
-    time.sleep(CONNECTION_CHECK_INTERVAL)
+def set_up_logging():
+  global console_handler
+  fh = logging.handlers.RotatingFileHandler('gerrit_reviewer.log', maxBytes=100 * 1024**2)
+  fh.setLevel(logging.DEBUG)
+  ch = console_handler = logging.StreamHandler()
+  set_console_level()
+  formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(threadName)s - %(message)s')
+  fh.setFormatter(formatter)
+  ch.setFormatter(formatter)
+  logger.addHandler(fh)
+  logger.addHandler(ch)
+
+def set_console_level():
+  """debuglogging: the console gets the debug messages too, the log file always does"""
+  if console_handler is None:
+    return
+  if DEBUG_LOGGING:
+    console_handler.setLevel(logging.DEBUG)
+  else:
+    console_handler.setLevel(logging.INFO)
 
-def store_event_stream(out, queue):
-  logger.info("Event stream ready and waiting")
-  try:
-    for line in iter(out.readline, b''):
-      queue.put(line)
-  except Exception, e:
-    logger.error("Error in event stream thread: %s", e)
+exit_code = 0
+console_handler = None
+
+# Set up by main() (or a harness like replay_bench.py)
+git_repos = None
+repo_locks = repo_maintenance.RepoLocks()
+maintenance = None
+object_pool = None
+watched_projects = []
+seen_votes = gerrit_stream_events.SeenVotes(SEEN_VOTES)
+parsed_components = None
+ssh_commands = None
+event_stream = None
+event_queue = None
+event_prefilter = None
+coalescer = None
+dispatcher = None
+change_queries = None
+warmer = None
+emails = None
+accounts = None
+reload_requested = False
+stop_requested = False
 
 
 #
 # Helper Functions
 #
-def get_components_for_repo_and_branch(git_command, branch_packages, branch_regex):
+def get_blob_sha(git_objects, spec):
+  """Resolve REV:PATH to the file's blob sha.  Returns None if the file doesn't exist."""
+  info = git_objects.info(spec)
+  if info is None or info[1] != "blob":
+    return None
+  return info[0]
+
+def build_package_components(component_text):
+  component_dict = components.parse_component_text(component_text, starting_dict = dict())
+  for i in component_dict.keys():
+    if i in IGNORED_COMPONENTS:
+      del component_dict[i]
+  return {"packages": component_dict,
+          "packagestrie": components.PackageTrie(component_dict, PACKAGES_DELIMITER)}
+
+def build_regex_components(component_regex_text, branch_regex):
+  component_regex_dict = components.parse_component_text(component_regex_text, starting_dict = OrderedDict())
+  component_regex_high_dict = components.get_high_priority_components(component_regex_dict)
+  component_regex_normal_dict = components.get_normal_priority_components(component_regex_dict)
+  matcher_high = components.ComponentMatcher(component_regex_high_dict, MATCH_CACHE_SIZE)
+  matcher_normal = components.ComponentMatcher(component_regex_normal_dict, MATCH_CACHE_SIZE)
+  for invalid in matcher_high.invalid + matcher_normal.invalid:
+    logger.error("Invalid regex in components-regex.txt on %s: %s (%s)", branch_regex, invalid[0], invalid[1])
+  return {"regexhigh": component_regex_high_dict, "regexnormal": component_regex_normal_dict,
+          "matcherhigh": matcher_high, "matchernormal": matcher_normal}
+
+def get_cached_components(git_objects, kind, spec, build, extra_key = ()):
+  """Look up a components file by blob sha in the component cache, building it on a miss"""
+  sha = get_blob_sha(git_objects, spec)
+  if sha is None:
+    return build(None)
+  def show_and_build():
+    text = None
+    try:
+      text = git_objects.show(sha)
+    except Exception, e:
+      pass
+    return build(text)
+  return parsed_components.get((kind, sha) + extra_key, show_and_build)
+
+def get_components_for_repo_and_branch(git_objects, branch_packages, branch_regex):
   """
   Create a components dict from the specified branch
   """
@@ -137,27 +264,17 @@ def get_components_for_repo_and_branch(git_command, branch_packages, branch_rege
     else:
       branch_packages = GITREMOTE + "/" + branch_packages
 
-    component_text = None
-    component_regex_text = None
+    package_components = get_cached_components(git_objects, "packages",
+      branch_packages + ":components-packages.txt", build_package_components,
+      extra_key = (tuple(sorted(IGNORED_COMPONENTS)), PACKAGES_DELIMITER))
 
-    try:
-      component_text = git_command.show(branch_packages + \
-        ":components-packages.txt")
-    except Exception, e:
-      pass
-    component_dict = components.parse_component_text(component_text)
-    for i in component_dict.keys():
-      if i in IGNORED_COMPONENTS:
-        del component_dict[i]
+    regex_components = get_cached_components(git_objects, "regex",
+      "origin/%s:components-regex.txt" % branch_regex,
+      lambda text: build_regex_components(text, branch_regex))
 
-    try:
-      component_regex_text = git_command.show("origin/%s:components-regex.txt" % branch_regex)
-    except Exception, e:
-      pass
-    component_regex_dict = components.parse_component_text(component_regex_text, starting_dict = OrderedDict())
-    component_regex_high_dict = components.get_high_priority_components(component_regex_dict)
-    component_regex_normal_dict = components.get_normal_priority_components(component_regex_dict)
-    return {"packages": component_dict, "regexhigh": component_regex_high_dict, "regexnormal": component_regex_normal_dict}
+    all_components = dict(package_components)
+    all_components.update(regex_components)
+    return all_components
   except Exception, e:
     logger.error("Couldn't retrieve components file: %s", e)
     return {}
@@ -165,7 +282,7 @@ def get_components_for_repo_and_branch(git_command, branch_packages, branch_rege
 def pick_owner(component, author):
   """From a component, pick the owner.  We don't consider the author of the commit for ownership."""
   for consider in component.owners:
-    if author != consider:
+    if author.lower() != consider.lower():
       return consider
   return AUTHOR_NO_ONE
 
@@ -173,53 +290,67 @@ def pick_owner_all(component, author):
   """From a component, pick all the owners.  We don't consider the author of the commit for ownership."""
   considering = []
   for consider in component.owners:
-    if author != consider:
+    if author.lower() != consider.lower():
       considering.append(consider)
   if len(considering) > 0:
     return considering
   else:
     return [AUTHOR_NO_ONE]
 
-def add_reviewer_reason(reviewers, reviewer, reason):
-  """Add a tuple to the list of reasons to add a certain reviewer"""
-  # Format of reviewers dict:
-  #   reviewer => [(reason, notes), ... ]
-  #   ex:  kniktas : [ ("/path/to/file", str(component.name)), ("requested", ""), ...]
-  if reviewer not in reviewers:
-    reviewers[reviewer] = []
-  reviewers[reviewer].append(reason)
-
-def add_multiple_reviewer_reasons(reviewers, reviewer, reason):
-  if not isinstance(reviewer, list):
-    reviewer = [reviewer]
-  for i in reviewer:
-    add_reviewer_reason(reviewers, i, reason)
-
-def is_already_matched(reviewers, item):
-  for reviewer in reviewers.keys():
-    for reason in reviewers[reviewer]:
-      if item == reason[0]:
-        return True
-  return False
+def new_reviewer_set():
+  return reviewer_set.ReviewerSet(excluded = [AUTHOR_NO_ONE])
 
-def process_touched_files(comment, all_components, starting_reviewers = {}):
-  """Perform the actual processing of touched files and look for component owners."""
-  reviewers = starting_reviewers
-  for i in comment_added.touched_files:
-    if is_already_matched (reviewers, i):
-      continue
-    (match, component) = components.find_component_re(all_components["regexnormal"], i)
+def match_high_priority(comment, all_components, reviewers):
+  """Add the owners of the HIGH priority components the touched files match to reviewers.
+
+  Returns a list of tuples for the files that matched: (str file, str match, Component component)
+  """
+  matched = []
+  for (i, match, component) in all_components["matcherhigh"].match_all(comment.touched_files):
+    if component is not None:
+      logger.debug("file change HIGH \"%s\" matched on %s", i, component)
+      reviewers.add_multiple(pick_owner_all(component, comment.author), (i, "Matched on HIGH: " + match))
+      matched.append((i, match, component))
+  return matched
+
+def match_touched_files(comment, all_components, normal_matches = None):
+  """Match every touched file against the NORMAL priority components once.
+
+  normal_matches is the result of matchernormal.match_all(comment.touched_files),
+  if it was already run.
+
+  Returns a list of tuples: (str file, list owners, tuple reason)
+  """
+  if normal_matches is None:
+    normal_matches = all_components["matchernormal"].match_all(comment.touched_files)
+  matches = []
+  for (i, match, component) in normal_matches:
     if component is not None:
       logger.debug("file change \"%s\" matched on %s", i, component)
       if component.all_owners_component:
-        add_multiple_reviewer_reasons(reviewers, pick_owner_all(component, comment_added.author), \
-                              (i, "Matched on: " + match))
+        owners = pick_owner_all(component, comment.author)
       else:
-        add_reviewer_reason(reviewers, pick_owner(component, comment_added.author), \
-                              (i, "Matched on: " + match))
+        owners = [pick_owner(component, comment.author)]
+      matches.append((i, owners, (i, "Matched on: " + match)))
     else:
       logger.warning("file change \"%s\" was not matched", i)
-      add_reviewer_reason(reviewers, AUTHOR_NO_ONE, (i, "No matches"))
+      matches.append((i, [AUTHOR_NO_ONE], (i, "No matches")))
+  return matches
+
+def process_touched_files(comment, all_components, starting_reviewers = None, matches = None):
+  """Perform the actual processing of touched files and look for component owners.
+
+  Files that already have a reviewer in starting_reviewers are skipped.  Pass
+  in the result of match_touched_files as matches to reuse one matching pass.
+  """
+  if starting_reviewers is None:
+    starting_reviewers = new_reviewer_set()
+  if matches is None:
+    matches = match_touched_files(comment, all_components)
+  reviewers = starting_reviewers
+  for (i, owners, reason) in matches:
+    if not reviewers.is_matched(i):
+      reviewers.add_multiple(owners, reason)
   return reviewers
 
 def get_review_string(reviewer, reasons, change_url, change_patchset_number, is_main_reviewer = False, is_unmatched = False):
@@ -238,44 +369,70 @@ def get_review_string(reviewer, reasons, change_url, change_patchset_number, is_
       value.append("- " + change_url + "/" + change_patchset_number + "/" + i[0].replace(" ","+") + ",unified")
   return "\n".join(value)
 
+def report_queue():
+  match_cache = collect_match_cache()
+  for priority in ("high", "normal"):
+    hits, misses = match_cache.get((priority, "hits"), 0), match_cache.get((priority, "misses"), 0)
+    if hits + misses > 0:
+      logger.debug("Match cache (%s): %.1f%% hits, %d entries", priority, 100.0 * hits / (hits + misses),
+                   match_cache.get((priority, "entries"), 0))
+  stats = event_queue.stats()
+  if stats["spilled"] > 0:
+    logger.warning("Event queue: %d in memory, %d spilled to disk, oldest event %.1f seconds old",
+                   stats["memory"], stats["spilled"], stats["oldest_age"])
+  else:
+    logger.debug("Event queue: %d in memory, oldest event %.1f seconds old", stats["memory"], stats["oldest_age"])
+
 def clean_up():
-  if ssh_stream is not None:
+  if event_queue is not None:
+    # Back in the queue so they're saved with it, the oldest first
+    if dispatcher is not None:
+      for event_json in dispatcher.drain():
+        event_queue.put(json.dumps(event_json))
+    if coalescer is not None:
+      for event_json in coalescer.drain():
+        event_queue.put(json.dumps(event_json))
+    event_queue.persist()
+  if emails is not None:
+    emails.close()
+  if parsed_components is not None:
+    parsed_components.save()
+  if event_stream is not None:
     logger.info("Closing event stream")
-    ssh_stream.close()
+    event_stream.close()
   if ssh_commands is not None:
-    logger.info("Closing command connection")
+    logger.info("Closing command connections")
     ssh_commands.close()
+  if maintenance is not None:
+    maintenance.close()
+  if git_repos is not None:
+    git_repos.close()
 
 def send_gerrit_command(ssh_client, command, expect_output = False):
+  """Run a gerrit command on the SSHConnectionPool ssh_client"""
   result = None
+  command_name = " ".join(command.split(None, 2)[:2])
+  start = time.time()
   try:
-    ssh_client = connect_ssh_commands()
     if "\n" in command:
       logger.info("Sending command: %s", command.split("\n"))
     else:
       logger.info("Sending command: %s", command)
-    stdin, stdout, stderr = ssh_client.exec_command(command)
-    stdin.close()
-    outlines = stdout.readlines()
-    errlines = stderr.readlines()
+    outlines, errlines = ssh_client.exec_command(command)
     result = (outlines, errlines)
     if not expect_output:
       if len(outlines) > 0:
         logger.info("Result of command (out): %s", outlines)
     if len(errlines) > 0:
       logger.error("Result of command (err): %s", errlines)
-    ssh_client.close()
+      command_errors.inc([command_name])
   except Exception, e:
     logger.error("Error sending gerrit command: %s", e)
+    command_errors.inc([command_name])
   finally:
+    command_seconds.observe(time.time() - start, [command_name])
     return result
 
-def connect_ssh_commands():
-  ssh_client = paramiko.SSHClient()
-  ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-  ssh_client.connect(GERRIT_HOST, username=USERNAME, key_filename=KEYFILE)
-  return ssh_client
-
 
 def scan_for_invalid_users (ssh_errs):
   invalid_users = []
@@ -283,98 +440,901 @@ def scan_for_invalid_users (ssh_errs):
   for err in ssh_errs:
     m = p.match(err)
     if m:
-      invalid_users.append(m.group(1)[:-len(USERS_EMAIL_DOMAIN)])
+      invalid_users.append(account_directory.account_name(m.group(1), USERS_EMAIL_DOMAIN))
   return invalid_users
 
 
+def change_query_options ():
+  query_options = "--current-patch-set"
+  if FETCH_FREE:
+    query_options += " --files --commit-message"
+  return query_options
+
+def parse_query_output (lines):
+  """Returns a dict of change number => change JSON from 'gerrit query --format json' output"""
+  changes = {}
+  for line in lines:
+    try:
+      change = json.loads(line)
+    except ValueError, e:
+      logger.error("Couldn't decode query result %s: %s", line, e)
+      continue
+    if change.get("type") == "stats" or "number" not in change:
+      continue
+    changes[str(change["number"])] = change
+  return changes
+
+def query_changes (numbers):
+  """Query several changes with one 'gerrit query' per QUERY_BATCH_SIZE changes.
+
+  Returns a dict of change number => change JSON.  Changes in a batch that
+  failed are left out, so they can be queried one at a time instead.
+  """
+  changes = {}
+  for start in range(0, len(numbers), QUERY_BATCH_SIZE):
+    batch = numbers[start:start + QUERY_BATCH_SIZE]
+    gerrit_return = send_gerrit_command(ssh_commands, 'gerrit query ' + change_query_options() + ' --format json (' + \
+                      " OR ".join(["change:" + i for i in batch]) + ')', expect_output = True)
+    if gerrit_return is None or len(gerrit_return[1]) > 0:
+      logger.error("Batch query of %d changes failed, they'll be queried one at a time", len(batch))
+      continue
+    changes.update(parse_query_output(gerrit_return[0]))
+  return changes
+
+def catch_up_events (since):
+  """Queue comment-added events for the Verified+1 votes given since since.
+
+  Called when the event stream reconnected, for the events it missed.  The
+  votes the stream did deliver are in seen_votes and skipped, so the margin
+  doesn't review them again.
+  """
+  since -= CATCH_UP_MARGIN
+  if maintenance is not None:
+    maintenance.mark_all_updated() # The ref-updated events are lost too
+  minutes = int((time.time() - since) / 60) + 1
+  projects = sorted(watched_projects)
+  changes = {}
+  for start in range(0, len(projects), QUERY_BATCH_SIZE):
+    batch = projects[start:start + QUERY_BATCH_SIZE]
+    gerrit_return = send_gerrit_command(ssh_commands, 'gerrit query --current-patch-set --format json ' + \
+                      'status:open label:Verified=1 -age:%dm (' % minutes + \
+                      " OR ".join(["project:" + i for i in batch]) + ')', expect_output = True)
+    if gerrit_return is None or len(gerrit_return[1]) > 0:
+      logger.error("Couldn't query the changes verified since %s in %d projects, their events are lost",
+                   time.ctime(since), len(batch))
+      continue
+    changes.update(parse_query_output(gerrit_return[0]))
+  queued = 0
+  for change in changes.values():
+    if change.get("project") not in watched_projects:
+      continue
+    event_json = gerrit_stream_events.comment_added_from_query(change, since)
+    if event_json is None:
+      continue
+    if seen_votes.contains(event_json["change"]["number"], event_json["patchSet"]["number"]):
+      logger.debug("Change %s/%s was already read from the stream", event_json["change"]["number"],
+                   event_json["patchSet"]["number"])
+      continue
+    event_queue.put(json.dumps(event_json))
+    queued += 1
+  logger.info("Queued %d verified changes the event stream missed since %s", queued, time.ctime(since))
+  stream_catch_up_events.inc(amount = queued)
+  return queued
+
+def fetch_accounts ():
+  """Run the accountscommand and return the account names it lists"""
+  command_result = send_gerrit_command(ssh_commands, ACCOUNTS_COMMAND, expect_output = True)
+  if command_result is None or len(command_result[1]) > 0:
+    raise Exception("%s failed" % ACCOUNTS_COMMAND)
+  return account_directory.parse_ls_members(command_result[0], USERS_EMAIL_DOMAIN)
+
+
 def contains_multiple_matches (ssh_errs):
   for err in ssh_errs:
     if MULTIPLE_CHANGES in err:
       return True
   return False
 
+#
+# Stage Timing
+#
+
+# Functions called as observer(str stage, float seconds) after each timed stage
+stage_observers = []
+
+@contextlib.contextmanager
+def timed_stage(stage):
+  start = time.time()
+  try:
+    yield
+  finally:
+    elapsed = time.time() - start
+    for observer in stage_observers:
+      observer(stage, elapsed)
+
+#
+# Metrics
+#
+metrics_registry = metrics.Registry()
+stage_seconds = metrics_registry.register(metrics.Histogram("gerritbot_stage_seconds",
+  "Time spent in each stage of processing a comment-added event", ["stage"]))
+command_seconds = metrics_registry.register(metrics.Histogram("gerritbot_gerrit_command_seconds",
+  "Round trip time of the gerrit commands sent over ssh", ["command"]))
+command_errors = metrics_registry.register(metrics.Counter("gerritbot_gerrit_command_errors_total",
+  "Gerrit commands that failed or wrote to stderr", ["command"]))
+events_total = metrics_registry.register(metrics.Counter("gerritbot_events_total",
+  "Processed comment-added events by outcome", ["outcome"]))
+stream_catch_up_events = metrics_registry.register(metrics.Counter("gerritbot_stream_catch_up_events_total",
+  "Events queued from a query after the event stream reconnected"))
+
+def collect_queue_depth():
+  depth = {}
+  if event_queue is not None:
+    stats = event_queue.stats()
+    depth[("memory",)] = stats["memory"]
+    depth[("spilled",)] = stats["spilled"]
+  if dispatcher is not None:
+    depth[("dispatcher",)] = dispatcher.queued()
+  return depth
+
+def collect_queue_oldest_age():
+  if event_queue is None:
+    return {}
+  return {(): event_queue.stats()["oldest_age"]}
+
+def collect_prefilter():
+  if event_prefilter is None:
+    return {}
+  return dict([((key,), value) for key, value in event_prefilter.stats().items()])
+
+def collect_event_stream():
+  if event_stream is None:
+    return {}
+  return dict([((key,), value) for key, value in event_stream.stats().items()])
+
+def collect_coalescer():
+  if coalescer is None:
+    return {}
+  return dict([((key,), value) for key, value in coalescer.stats().items()])
+
+def collect_queries():
+  if change_queries is None:
+    return {}
+  return dict([((key,), value) for key, value in change_queries.stats().items()])
+
+def collect_emails():
+  if emails is None:
+    return {}
+  return dict([((key,), value) for key, value in emails.stats().items()])
+
+def collect_match_cache():
+  """Memo counters of the cached matchers, summed by priority"""
+  if parsed_components is None:
+    return {}
+  totals = {}
+  for value in parsed_components.values():
+    for priority in ("high", "normal"):
+      if not isinstance(value, dict) or "matcher" + priority not in value:
+        continue
+      for key, count in value["matcher" + priority].memo_stats().items():
+        totals[(priority, key)] = totals.get((priority, key), 0) + count
+  return totals
+
+def collect_accounts():
+  if accounts is None:
+    return {}
+  return dict([((key,), value) for key, value in accounts.stats().items()])
+
+def collect_repos():
+  if git_repos is None:
+    return {}
+  return dict([((key,), value) for key, value in git_repos.stats().items()])
+
+def collect_maintenance():
+  if maintenance is None:
+    return {}
+  return dict([((key,), value) for key, value in maintenance.stats().items()])
+
+def collect_warmer():
+  if warmer is None:
+    return {}
+  return dict([((key,), value) for key, value in warmer.stats().items()])
+
+def collect_component_cache():
+  if parsed_components is None:
+    return {}
+  return dict([((key,), value) for key, value in parsed_components.stats().items()])
+
+metrics_registry.register(metrics.Gauge("gerritbot_queue_depth",
+  "Events waiting to be processed", ["queue"], collect_queue_depth))
+metrics_registry.register(metrics.Gauge("gerritbot_queue_oldest_age_seconds",
+  "Age of the oldest event in the event queue", function = collect_queue_oldest_age))
+def only(function, keys):
+  """The values of a collect function whose last label is one of keys, to
+  split a stats() dict into its gauges and its counters"""
+  def collect():
+    return dict([(labels, value) for labels, value in function().items() if labels[-1] in keys])
+  return collect
+
+metrics_registry.register(metrics.Counter("gerritbot_prefilter_lines_total",
+  "Event stream lines accepted and dropped by the prefilter", ["result"], collect_prefilter))
+metrics_registry.register(metrics.Gauge("gerritbot_event_stream",
+  "Event stream connection state and seconds since the last line", ["gauge"],
+  only(collect_event_stream, ["connected", "last_line_age"])))
+metrics_registry.register(metrics.Counter("gerritbot_event_stream_total",
+  "Event stream reconnects, failed connects and lines read", ["counter"],
+  only(collect_event_stream, ["reconnects", "connect_failures", "lines"])))
+metrics_registry.register(metrics.Gauge("gerritbot_coalescer_events",
+  "Events waiting to settle", ["gauge"], only(collect_coalescer, ["pending"])))
+metrics_registry.register(metrics.Counter("gerritbot_coalescer_events_total",
+  "Events replaced or dropped by newer ones", ["counter"], only(collect_coalescer, ["replaced", "dropped"])))
+metrics_registry.register(metrics.Gauge("gerritbot_change_queries",
+  "Changes waiting for a query and fresh results", ["gauge"], only(collect_queries, ["wanted", "results"])))
+metrics_registry.register(metrics.Counter("gerritbot_change_queries_total",
+  "Batch queries and changes answered from a batch", ["counter"], only(collect_queries, ["batches", "hits"])))
+metrics_registry.register(metrics.Gauge("gerritbot_emails",
+  "Emails waiting to be sent or digested", ["gauge"], only(collect_emails, ["queued", "digest_waiting"])))
+metrics_registry.register(metrics.Counter("gerritbot_emails_total",
+  "Emails sent, failed, retried and digested", ["counter"],
+  only(collect_emails, ["sent", "failed", "retried", "digested"])))
+metrics_registry.register(metrics.Gauge("gerritbot_match_cache",
+  "Path to component match memo entries", ["priority", "gauge"], only(collect_match_cache, ["entries"])))
+metrics_registry.register(metrics.Counter("gerritbot_match_cache_total",
+  "Path to component match memo hits and misses", ["priority", "counter"],
+  only(collect_match_cache, ["hits", "misses"])))
+metrics_registry.register(metrics.Gauge("gerritbot_accounts",
+  "Account directory size, rejected reviewers remembered and seconds since the last refresh", ["gauge"],
+  only(collect_accounts, ["accounts", "invalid", "age"])))
+metrics_registry.register(metrics.Counter("gerritbot_accounts_total",
+  "Account directory refreshes and reviewers that weren't in it", ["counter"],
+  only(collect_accounts, ["refreshes", "refresh_failures", "unknown"])))
+metrics_registry.register(metrics.Gauge("gerritbot_repos",
+  "Open repos and repos in use", ["gauge"], only(collect_repos, ["open", "in_use"])))
+metrics_registry.register(metrics.Counter("gerritbot_repos_total",
+  "Repos opened and closed for being idle", ["counter"], only(collect_repos, ["opened", "evicted"])))
+metrics_registry.register(metrics.Gauge("gerritbot_maintenance",
+  "Repos waiting for a refresh", ["gauge"], only(collect_maintenance, ["dirty"])))
+metrics_registry.register(metrics.Counter("gerritbot_maintenance_total",
+  "Fetches, gcs, postponed gcs, failures, clones and pool repacks of the maintenance", ["counter"],
+  only(collect_maintenance, ["fetches", "gcs", "busy", "failures", "clones", "pool_repacks"])))
+metrics_registry.register(metrics.Gauge("gerritbot_component_warmer",
+  "Branch updates waiting to be checked for components changes and projects waiting for them", ["gauge"],
+  only(collect_warmer, ["queued", "stale_projects"])))
+metrics_registry.register(metrics.Counter("gerritbot_component_warmer_total",
+  "Branch updates checked, merged and failed, and component maps rebuilt", ["counter"],
+  only(collect_warmer, ["checked", "built", "merged", "failures"])))
+metrics_registry.register(metrics.Gauge("gerritbot_component_cache",
+  "Component cache entries", ["gauge"], only(collect_component_cache, ["entries"])))
+metrics_registry.register(metrics.Counter("gerritbot_component_cache_total",
+  "Component cache hits, misses and evictions", ["counter"],
+  only(collect_component_cache, ["hits", "misses", "evictions"])))
+
+stage_observers.append(lambda stage, seconds: stage_seconds.observe(seconds, [stage]))
+
 #
 # Git Repo Commands
 #
-class GitTimeoutException(Exception):
-  pass
-
-def git_timeout_handler(signum, frame):
-  raise GitTimeoutException()
-
-def git_timeout(timeout):
-  """Function decorator to timeout git commands"""
-  def wrap(func):
-    def wrapped_func(*args):
-      old_handler = signal.signal(signal.SIGALRM, git_timeout_handler)
-      signal.alarm(timeout)
-      try:
-        value = func(*args)
-      except GitTimeoutException:
-        return None
-      except Exception, e:
-        signal.alarm(0)
-        raise e
-      finally:
-        signal.signal(signal.SIGALRM, old_handler)
-      signal.alarm(0)
-      return value
-    return wrapped_func
-  return wrap
-
-TIMEOUT_FETCH = int(options.get("timeoutfetch",120))
+TIMEOUT_FETCH = 120
 TIMEOUT_TOUCHED_FILES = 15
 TIMEOUT_COMMIT_MESSAGE = 15
 
-@git_timeout(TIMEOUT_FETCH)
-def git_repo_fetch(g, ref):
-  return g.fetch(GITREMOTE , "+" + ref + ":" + CHANGE_REF)
+# The git functions raise git_process.GitTimeoutException when they time out.
+#  The git process is killed, so they're safe to call from any thread.
 
-@git_timeout(TIMEOUT_TOUCHED_FILES)
-def git_repo_show_touched_files(g):
-  return g.log("-M", "--name-status", "-1", "--pretty=oneline", CHANGE_REF)
+def git_repo_fetch(repo_path, ref, change_ref = CHANGE_REF):
+  return git_process.run(["fetch", GITREMOTE, "+" + ref + ":" + change_ref], repo_path, TIMEOUT_FETCH)
 
-@git_timeout(TIMEOUT_COMMIT_MESSAGE)
-def git_repo_commit_message(g):
-  return g.log("-1", "--format=%s%n%n%b", CHANGE_REF)
+def git_repo_show_touched_files(git_objects, handle, change_ref = CHANGE_REF):
+  """Calls handle(str status, str path) for each touched file.  Returns the commit's sha."""
+  return git_objects.touched_files(change_ref, handle, TIMEOUT_TOUCHED_FILES)
+
+def git_repo_commit_message(git_objects, change_ref = CHANGE_REF):
+  """Returns a tuple: (list parent_shas, str commit_message)"""
+  return git_objects.read_commit(change_ref, TIMEOUT_COMMIT_MESSAGE)
 
 #
+# Event Processing
 #
-#
+def process_comment_added(event_json, change_ref = CHANGE_REF, json_change = None):
+  """Handle a comment-added event for a watched project.
+
+  change_ref is the local ref the patch set is fetched into.  Each worker
+  uses its own so that projects sharing a repo don't step on each other.
+  json_change is the change's query result if it was already queried.
+
+  Returns the outcome for the events metric, for example "reviewed" or
+  "skipped-not-current".
+  """
+  current_project = event_json["change"]["project"]
+  git_objects = git_repos.get(current_project)["objects"]
+  git_settings = GITREPOS[current_project]
+
+  gerrit_comment = [] # No double-quotes please
+  comment_added = gerrit_stream_events.CommentAddedEvent(event_json)
+
+  if comment_added.verified != "1":
+    return "not-verified"
+
+  logger.debug("Considering %s change %s/%s : %s : %s", current_project, comment_added.number, comment_added.patch_number, comment_added.author, comment_added.subject)
+
+  # Get JSON info from gerrit
+  if json_change is None:
+    with timed_stage("query"):
+      gerrit_return = send_gerrit_command (ssh_commands, 'gerrit query ' + change_query_options() + ' --format json project:' + current_project + ' ' + \
+                        comment_added.number + '', expect_output = True)
+    if gerrit_return is not None:
+      gerrit_out, gerrit_err = gerrit_return
+      if len(gerrit_err) == 0:
+        json_change = parse_query_output(gerrit_out).get(comment_added.number)
+
+  if json_change is not None and json_change["currentPatchSet"]["number"] != comment_added.patch_number:
+    logger.debug("Change %s/%s is not the current patch set [%s].", comment_added.number, comment_added.patch_number, json_change["currentPatchSet"]["number"])
+    return "skipped-not-current"
+
+  reviewers = new_reviewer_set()
+  reviewers_email = new_reviewer_set()
+  author_opt_in = False
+  email_opt_in = False
+  high_priority_matches = False
+  merge_commit = False
+
+  # In fetch free mode the files, commit message and parents come from the query
+  from_query = False
+  if FETCH_FREE and json_change is not None:
+    from_query = comment_added.parse_query_result(json_change, REQUEST_CR, MAX_TOUCHED_FILES)
+    if not from_query:
+      logger.debug("Query result for %s has no file list, fetching the change", comment_added.number)
+
+  if not from_query:
+    try:
+      with timed_stage("fetch"):
+        try:
+          git_repo_fetch(git_settings["path"], comment_added.ref, change_ref)
+        except git_process.GitTimeoutException, e:
+          logger.error("Fetch failed (%s) for %s/%s. Trying again.", e, comment_added.number, comment_added.patch_number)
+          git_repo_fetch(git_settings["path"], comment_added.ref, change_ref)
+    # We can't exactly add a comment to the commit since we don't know if they want it reviewed
+    except git_process.GitCommandException, e:
+      logger.error("Git fetch failed: %s. stderr output: %s", e, str(e.stderr.split()))
+      return "git-error"
+    except git_process.GitTimeoutException, e:
+      logger.error("Git fetch failed: %s", e)
+      return "timeout"
+
+    # Get commit's information
+    try:
+      with timed_stage("commit"):
+        gitout = git_repo_commit_message(git_objects, change_ref)
+    except git_process.GitTimeoutException, e:
+      logger.error("Reading commit %s failed: %s", change_ref, e)
+      return "timeout"
+    except git_batch.GitBatchException, e:
+      logger.error("Reading commit %s failed: %s", change_ref, e)
+      return "git-error"
+    if gitout is None:
+      logger.error("Commit %s doesn't exist after fetching it", change_ref)
+      return "git-error"
+    comment_added.parents, commit_message = gitout
+
+  if len(comment_added.parents) > 1 and (MERGE_REVIEWERS is not None and len(MERGE_REVIEWERS) > 0):
+    # We have a merge commit!
+    merge_commit = True
+    logger.debug("Commit is a merge commit.  Adding: %s", str(MERGE_REVIEWERS))
+    if MERGE_REVIEWERS is not None:
+      for i in MERGE_REVIEWERS:
+        reviewers.add(i, ("mergecommit",""))
+
+  # Check for ABANDONED
+  if json_change is not None:
+    if json_change["status"] == "ABANDONED":
+      logger.debug("Commit is marked ABANDONED")
+      return "abandoned"
+
+  if not from_query:
+    # Get the list of touched files
+    try:
+      with timed_stage("touched_files"):
+        gitout = git_repo_show_touched_files(git_objects,
+          lambda status, path: comment_added.add_touched_file(path, MAX_TOUCHED_FILES), change_ref)
+    except git_process.GitTimeoutException, e:
+      logger.error("Git diff-tree for touched files failed: %s", e)
+      return "timeout"
+    except git_batch.GitBatchException, e:
+      logger.error("Git diff-tree for touched files failed: %s", e)
+      return "git-error"
+    if gitout is None:
+      logger.error("Commit %s doesn't exist after fetching it", change_ref)
+      return "git-error"
+
+    # Get the commit message for the requested CRs
+    comment_added.parse_git_commit(commit_message, REQUEST_CR)
+
+  # It already is marked for merge
+  if not merge_commit:
+    if "CR: " in comment_added.commit_message or "NOCR: " in comment_added.commit_message:
+      logger.debug("Skipping commit, it is already marked with CR: or NOCR:")
+      return "already-marked"
+
+  # Check for NOSUBMIT tag
+  if NOSUBMIT in comment_added.commit_message:
+    logger.debug("Commit is marked to not be submitted.")
+    if json_change is not None:
+      approvals = json_change["currentPatchSet"]["approvals"]
+      already_blocked = False
+      for approval in approvals:
+        if approval["by"]["name"] == USERNAME:
+          if approval["type"] == "Code-Review" and approval["value"] == "-2":
+            already_blocked = True
+            break
+      if not already_blocked and json_change["status"] == "NEW":
+        gerrit_cr_command = 'gerrit review --project ' + current_project + ' --message ' + \
+                          '"Marking -2CR because of ' + NOSUBMIT + '" --code-review -2 ' + \
+                            comment_added.number + "," + comment_added.patch_number
+        if ADD_COMMENT:
+          gerrit_return = send_gerrit_command (ssh_commands, gerrit_cr_command)
+        else:
+          logger.debug("Would send review command: %s", gerrit_cr_command)
+      else:
+        logger.debug("Change is already marked -2CR")
+    return "nosubmit"
+
+  with timed_stage("components"):
+    all_components = get_components_for_repo_and_branch(git_objects, comment_added.branch, git_settings["regexbranch"])
+
+  # Check for HIGH priority regex components
+  if not merge_commit:
+    with timed_stage("match_high"):
+      high_priority_matches = len(match_high_priority(comment_added, all_components, reviewers)) > 0
+
+  # If they explicitly ask for an AUTOREVIEW, give it to them
+  if OPTIN in comment_added.commit_message:
+    author_opt_in = True
+
+  if EMAIL_OPTIN in comment_added.commit_message:
+    email_opt_in = True
+
+  # If no opt-in, requested, or high priority matches, then ignore
+  if not author_opt_in and len(comment_added.requested_cr) == 0 and not high_priority_matches and not merge_commit and not email_opt_in:
+    logger.debug("Skipping commit.  There were no requested CRs, Auto Review requests, or HIGH priority matches.")
+    return "no-opt-in"
+
+  # One matching pass for both the reviewers and the email
+  touched_file_matches = None
+  if (author_opt_in and not merge_commit) or email_opt_in:
+    with timed_stage("match_normal"):
+      touched_file_matches = match_touched_files(comment_added, all_components)
+
+  if author_opt_in and not merge_commit:
+    reviewers = process_touched_files(comment_added, all_components, starting_reviewers = reviewers,
+                                      matches = touched_file_matches)
+
+  if email_opt_in:
+    reviewers_email = process_touched_files(comment_added, all_components, matches = touched_file_matches)
+    email = sendMail.EmailMessage()
+    email.setSMTPServer(SMTP_SERVER)
+    email.setFromAddr(EMAIL_FROM)
+    email.setToAddr([comment_added.author + "@" + USERS_EMAIL_DOMAIN])
+    email.setSubject(str("GerritReviewBot[%s] matches for %s" % (platform.uname()[1].upper(), comment_added.url)))
+    value = []
+    value.append(comment_added.author + ", these are the " + EMAIL_OPTIN + " matches for " + comment_added.url)
+    value.append("")
+    for reviewer in reviewers_email.keys():
+      reasons = reviewers_email[reviewer]
+      value.append(reviewer)
+      for i in reasons:
+        value.append(comment_added.url + "/" + comment_added.patch_number + "/" + i[0].replace(" ","+") + ",unified")
+      value.append("")
+    email_body = "\n".join(value)
+    email.setBody(str(email_body))
+    if SEND_EMAILS:
+      with timed_stage("email"):
+        emails.put(email, digest_key = comment_added.author)
+
+  logger.info("Requested CRs: [%s]", " ".join(comment_added.requested_cr))
+  for i in comment_added.requested_cr:
+    reviewers.add(i, ("requested", ""))
+
+  # Leave out reviewers Gerrit would reject
+  invalid_users = []
+  if accounts is not None:
+    invalid_users = accounts.find_invalid([x for x in reviewers.keys() if x != AUTHOR_NO_ONE and x != AUTHOR_IGNORED],
+                                          ACCOUNTS_STRICT)
+    if len(invalid_users) > 0:
+      logger.error("Invalid users were requested for CRs: %s", invalid_users)
+      for invalid in invalid_users:
+        del reviewers[invalid]
+
+  # Find the lucky reviewer who will be the main reviewer
+  most_review_reasons = 0
+  most_review_reviewer = None
+  if author_opt_in:
+    most_review_reviewer, most_review_reasons = reviewers.top()
+    logger.debug("Top reviewing person %s with %s reason(s)", most_review_reviewer, most_review_reasons)
+
+  # Add reviewers
+  reviewers_to_add = [x for x in reviewers.keys() if x != AUTHOR_NO_ONE and x != AUTHOR_IGNORED]
+  command_add_reviewers_base = "gerrit set-reviewers --project " + current_project + " " + \
+                              "".join([" --add " + x + "@" + USERS_EMAIL_DOMAIN for x in reviewers_to_add]) + \
+                              " "# + comment_added.number
+  if ADD_REVIEWERS and len(reviewers_to_add) > 0:
+    with timed_stage("set_reviewers"):
+      command_result = send_gerrit_command(ssh_commands, command_add_reviewers_base + comment_added.number)
+      if command_result is not None and len(command_result[1]) > 0:
+        if contains_multiple_matches(command_result[1]):
+          command_result = send_gerrit_command(ssh_commands, command_add_reviewers_base + comment_added.change_id)
+    if command_result is not None and len(command_result[1]) > 0:
+      rejected_users = scan_for_invalid_users(command_result[1])
+      if len(rejected_users) > 0:
+        logger.error("Invalid users were requested for CRs: %s", rejected_users)
+        if accounts is not None:
+          accounts.add_invalid(rejected_users)
+        invalid_users.extend(rejected_users)
+  elif not ADD_REVIEWERS:
+    logger.debug("Would send reviewer command: %s", command_add_reviewers_base + comment_added.number)
+
+  # Construct the comment to add to gerrit
+  number_reviewers = len(reviewers)
+
+  # Check for invalid users
+  if len(invalid_users) > 0:
+    for invalid in invalid_users:
+      if invalid in reviewers:
+        del reviewers[invalid]
+        number_reviewers = number_reviewers - 1
+    if author_opt_in:
+      most_review_reviewer, most_review_reasons = reviewers.top()
+    gerrit_comment.append(" " + comment_added.author + ", the following users were invalid: " + str(invalid_users))
+    gerrit_comment.append("")
+    gerrit_comment.append("")
+
+  # Files over maxtouchedfiles
+  if len(comment_added.omitted_files) > 0:
+    gerrit_comment.append(" " + comment_added.author + ", this change touches " + str(comment_added.touched_files_total) + \
+                          " files.  Only the first " + str(len(comment_added.touched_files)) + \
+                          " were matched to reviewers.  The rest are in:")
+    by_count = sorted(comment_added.omitted_files.items(), key = lambda i: i[1], reverse = True)
+    for top, count in by_count[:OMITTED_FILES_SUMMARY]:
+      gerrit_comment.append("- " + top + " (" + str(count) + " files)")
+    if len(by_count) > OMITTED_FILES_SUMMARY:
+      gerrit_comment.append("- " + str(len(by_count) - OMITTED_FILES_SUMMARY) + " more directories")
+    gerrit_comment.append("")
+    gerrit_comment.append("")
+
+  # Files with missing owners
+  if AUTHOR_NO_ONE in reviewers:
+    gerrit_comment.append(" " + comment_added.author + ", the following files could not have a reviewer mapped to them:")
+    gerrit_comment.append(get_review_string(AUTHOR_NO_ONE, reviewers[AUTHOR_NO_ONE], comment_added.url, comment_added.patch_number, is_unmatched = True))
+    gerrit_comment.append("")
+    gerrit_comment.append("")
+    number_reviewers = number_reviewers - 1
+
+  # Files we ignored
+  if AUTHOR_IGNORED in reviewers:
+    gerrit_comment.append(" " + comment_added.author + ", the following files are ignored by the bot:")
+    gerrit_comment.append(get_review_string(AUTHOR_IGNORED, reviewers[AUTHOR_IGNORED], comment_added.url, comment_added.patch_number, is_unmatched = True))
+    gerrit_comment.append("")
+    gerrit_comment.append("")
+    number_reviewers = number_reviewers - 1
+
+  if number_reviewers > 0:
+    gerrit_comment.append("")
+    gerrit_comment.append("You were each added as a reviewer for a reason.  Reasons listed under your username")
+    gerrit_comment.append("")
+
+  # The review owner
+  if most_review_reviewer is not None:
+    gerrit_comment.append(get_review_string(most_review_reviewer, reviewers[most_review_reviewer], \
+                                             comment_added.url, comment_added.patch_number, is_main_reviewer = True))
+  gerrit_comment.append("")
+  gerrit_comment.append("")
+
+  # The rest of the people
+  for i in reviewers.keys():
+    if i != most_review_reviewer and i != AUTHOR_NO_ONE and i != AUTHOR_IGNORED:
+      gerrit_comment.append(get_review_string(i, reviewers[i], comment_added.url, comment_added.patch_number))
+      gerrit_comment.append("")
+      gerrit_comment.append("")
+  gerrit_comment.append("")
+  gerrit_comment.append("")
+
+  gerrit_comment.append("-Your friendly GerritReviewer Bot")
+
+  logger.debug("Comment for Gerrit: %s", gerrit_comment)
+
+  # Comment on the change
+  command_comment = "gerrit review --project " + current_project + " --message '" + \
+                            "\n".join(gerrit_comment) + "' --code-review 0 " + \
+                            comment_added.number + "," + comment_added.patch_number
+  if ADD_COMMENT:
+    with timed_stage("review"):
+      send_gerrit_command(ssh_commands, command_comment)
+  else:
+    logger.debug("Would send comment command: %s", command_comment)
+  return "reviewed"
+
+
+def components_changed(event_json):
+  """Check a branch update of a watched project for components file changes.
+
+  Runs on a component warmer thread.  The paths the update touched are
+  checked first with a diff-tree of its old and new commit, and only if it
+  changed a components file the branch's reviews read is the branch
+  fetched, since the reviews read the components from the remote branch.
+  An update whose new commit isn't here yet can't be checked without it,
+  so that branch is fetched first.
+
+  Returns True if a components file changed and the branch was fetched.
+  """
+  ref_updated = gerrit_stream_events.RefUpdatedEvent(event_json)
+  branch = ref_updated.branch()
+  git_settings = GITREPOS.get(ref_updated.project)
+  if git_settings is None or branch is None or ref_updated.new_rev in (None, NULL_REV):
+    return False
+  path = git_settings["path"]
+  files = ["components-packages.txt"]
+  if branch == git_settings["regexbranch"]:
+    files.append("components-regex.txt")
+  def fetch_branch():
+    # Shared, so it runs next to the reviews but not under a gc
+    with repo_locks.hold(path, REPO_LOCK_TIMEOUT) as held:
+      if not held:
+        logger.warning("Repo %s is still being gc'd after %d seconds, fetching without waiting", path,
+                       REPO_LOCK_TIMEOUT)
+      try:
+        with timed_stage("fetch_branch"):
+          git_repo_fetch(path, "refs/heads/" + branch, "refs/remotes/%s/%s" % (GITREMOTE, branch))
+        return True
+      except (git_process.GitTimeoutException, git_process.GitCommandException), e:
+        logger.error("Couldn't fetch branch %s of %s: %s", branch, ref_updated.project, e)
+        return False
+  def changed_files(git_objects):
+    if ref_updated.old_rev in (None, NULL_REV) or git_objects.info(ref_updated.old_rev) is None:
+      # A new branch, or nothing to compare with: any components file it has is new
+      return [i for i in files if get_blob_sha(git_objects, "%s:%s" % (ref_updated.new_rev, i)) is not None]
+    with timed_stage("diff_tree"):
+      output = git_process.run(["diff-tree", "-r", "--name-only", "--no-commit-id", "-z",
+                                ref_updated.old_rev, ref_updated.new_rev, "--"] + files, path, TIMEOUT_FETCH)
+    return [i for i in output.split("\0") if i != ""]
+
+  with git_repos.use(ref_updated.project) as handles:
+    git_objects = handles["objects"]
+    fetched = git_objects.info(ref_updated.new_rev) is None
+    if fetched and not fetch_branch():
+      return False
+    try:
+      changed = changed_files(git_objects)
+    except (git_process.GitTimeoutException, git_process.GitCommandException), e:
+      logger.error("Couldn't check update of %s/%s for components changes: %s", ref_updated.project, branch, e)
+      return False
+    if len(changed) == 0:
+      return False
+    # The reviews read the components from the remote branch, it has to move too
+    if not fetched and not fetch_branch():
+      return False
+  logger.info("%s changed on %s/%s, building its component maps", ", ".join(changed), ref_updated.project, branch)
+  return True
+
+def merge_ref_updates(waiting, newer):
+  """Fold a branch update into the one still waiting for the warmer: from
+  the waiting one's old commit to the newer one's new commit"""
+  merged = copy.deepcopy(newer)
+  if "oldRev" in waiting["refUpdate"]:
+    merged["refUpdate"]["oldRev"] = waiting["refUpdate"]["oldRev"]
+  else:
+    merged["refUpdate"].pop("oldRev", None)
+  return merged
+
+def warm_components(event_json):
+  """Build the component maps of the branch components_changed found changed,
+  so the next review neither pays for it nor reads the old file"""
+  ref_updated = gerrit_stream_events.RefUpdatedEvent(event_json)
+  git_settings = GITREPOS.get(ref_updated.project)
+  if git_settings is None:
+    return
+  with git_repos.use(ref_updated.project) as handles:
+    with timed_stage("components_warm"):
+      get_components_for_repo_and_branch(handles["objects"], ref_updated.branch(), git_settings["regexbranch"])
+
+def worker_change_ref(worker_index):
+  """The local ref a worker fetches patch sets into"""
+  if worker_index is None:
+    return CHANGE_REF
+  return CHANGE_REF + "_" + str(worker_index)
+
+def handle_event(event_json, worker_index):
+  outcome = "error"
+  try:
+    if event_json["change"]["project"] not in GITREPOS:
+      outcome = "not-watched" # Removed by a reload since it was queued
+      change_queries.forget(event_json["change"]["number"])
+    else:
+      # Queried now rather than when it was queued, with the other waiting changes
+      with timed_stage("query_batch"):
+        json_change = change_queries.get(event_json["change"]["number"])
+      # After the project's branch updates that came first are checked and their component maps built
+      if not warmer.wait(event_json["change"]["project"], REPO_LOCK_TIMEOUT):
+        logger.warning("Component maps of %s are still being checked after %d seconds, reviewing without waiting",
+                       event_json["change"]["project"], REPO_LOCK_TIMEOUT)
+      # Keep the repo open and out of gc until the event is done
+      path = GITREPOS[event_json["change"]["project"]]["path"]
+      with git_repos.use(event_json["change"]["project"]):
+        with repo_locks.hold(path, REPO_LOCK_TIMEOUT) as held:
+          if not held:
+            logger.warning("Repo %s is still being gc'd after %d seconds, reviewing without waiting", path,
+                           REPO_LOCK_TIMEOUT)
+          outcome = process_comment_added(event_json, worker_change_ref(worker_index), json_change)
+  finally:
+    events_total.inc([outcome])
+
+def change_refs_in_use():
+  """The change refs of the configured workers"""
+  if NUMBER_WORKERS > 0:
+    return [worker_change_ref(i) for i in range(NUMBER_WORKERS)]
+  return [worker_change_ref(None)]
+
+def clean_up_change_refs(git_command, keep_refs):
+  """Delete the change refs left behind by workers that don't exist anymore"""
+  try:
+    refs = git_command.for_each_ref("--format=%(refname)", "refs/heads/" + CHANGE_REF + "*").split()
+  except Exception, e:
+    logger.error("Couldn't list change refs: %s", e)
+    return
+  for ref in refs:
+    name = ref[len("refs/heads/"):]
+    if re.match(CHANGE_REF + "(_[0-9]+)?$", name) and name not in keep_refs:
+      logger.debug("Deleting old change ref %s", ref)
+      try:
+        git_command.update_ref("-d", ref)
+      except Exception, e:
+        logger.error("Couldn't delete old change ref %s: %s", ref, e)
+
+
+def open_repo(project):
+  """The git handles of a watched project, opened by the RepoRegistry on first use"""
+  path = GITREPOS[project]["path"]
+  commands = git.Git(path)
+  clean_up_change_refs(commands, change_refs_in_use())
+  return {"commands": commands, "objects": git_batch.GitBatch(path)}
+
+def close_repo(handles):
+  handles["objects"].close()
+
+def set_up_repos(old_repos = None):
+  """Set up the registry that opens the repos.
+
+  On a reload, old_repos is the previous gitrepos and the repos that were
+  removed or moved are closed.
+  """
+  global watched_projects, git_repos
+  for repo in GITREPOS.keys():
+    logger.debug("Watching project %s at %s. (AUTOREVIEW using %s)", repo, GITREPOS[repo]["path"], GITREPOS[repo]["regexbranch"])
+  if git_repos is None:
+    git_repos = repo_registry.RepoRegistry(open_repo, close_repo, REPO_IDLE_SECONDS)
+  git_repos.idle_seconds = REPO_IDLE_SECONDS
+  if old_repos is not None:
+    for repo in old_repos.keys():
+      if repo not in GITREPOS or GITREPOS[repo]["path"] != old_repos[repo]["path"]:
+        git_repos.remove(repo)
+  watched_projects = GITREPOS.keys()
+  if maintenance is not None:
+    maintenance.set_paths(repo_paths(), clone_urls())
+
+def repo_paths():
+  """The distinct repo paths, projects can share a repo"""
+  return set([GITREPOS[repo]["path"] for repo in GITREPOS.keys()])
+
+def clone_urls():
+  """Where the repos that don't exist yet are cloned from, by path"""
+  return dict([(GITREPOS[repo]["path"], CLONE_URL % repo) for repo in GITREPOS.keys()])
+
+def set_up_object_pool():
+  """The shared object pool of the repos, if objectpool is set"""
+  global object_pool
+  if not OBJECT_POOL:
+    return
+  object_pool = repo_maintenance.ObjectPool(OBJECT_POOL)
+  object_pool.ensure()
+
+def set_up_maintenance():
+  """Fetch and gc the repos from the bot if maintenanceinterval is set, and
+  clone the missing ones if objectpool is"""
+  global maintenance
+  if MAINTENANCE_INTERVAL <= 0 and object_pool is None:
+    return
+  maintenance = repo_maintenance.MaintenanceScheduler(repo_locks, GITREMOTE, MAINTENANCE_INTERVAL,
+                                                      MAINTENANCE_WORKERS, GC_LOOSE_OBJECTS, GC_PACKS,
+                                                      object_pool)
+  maintenance.set_paths(repo_paths(), clone_urls())
+  maintenance.start()
+
+def dispatch_ref_updated(event_json):
+  """A ref-updated event: its repo needs a refresh and a branch's components
+  may have changed.  Patch set uploads are ignored."""
+  ref_updated = gerrit_stream_events.RefUpdatedEvent(event_json)
+  if ref_updated.project not in GITREPOS or ref_updated.is_change_ref():
+    return
+  if maintenance is not None:
+    maintenance.mark_updated(GITREPOS[ref_updated.project]["path"])
+  if ref_updated.branch() is not None:
+    warmer.put(ref_updated.project, ref_updated.branch(), event_json)
+
+def set_up_workers():
+  """Workers for processing the events"""
+  global dispatcher, change_queries, warmer
+  warmer = component_warmer.ComponentWarmer(components_changed, warm_components, WARMER_WORKERS, merge_ref_updates)
+  warmer.start()
+  change_queries = query_batcher.QueryBatcher(query_changes, QUERY_BATCH_SIZE, QUERY_MAX_AGE)
+  dispatcher = event_dispatcher.ProjectDispatcher(NUMBER_WORKERS, handle_event)
+  dispatcher.start()
+
+def request_reload(signum, frame):
+  """SIGHUP handler, the main loop does the reload"""
+  global reload_requested
+  reload_requested = True
+
+def request_stop(signum, frame):
+  """SIGTERM handler, the main loop cleans up and exits"""
+  global stop_requested
+  stop_requested = True
+
+def reload_options(options_file):
+  """Read the config file again and apply it without dropping the event stream.
+
+  The repos, ignoredcomponents, mergereviewers, timeouts, debuglogging
+  and the other options read while processing take effect right away.
+  If the file can't be read or has bad options, none of the old ones are
+  changed.
+  """
+  old_options, old_repos = options, GITREPOS
+  try:
+    with open(options_file, "r") as f:
+      new_options = json.load(f)
+    for key in RESTART_OPTIONS:
+      if old_options.get(key) != new_options.get(key):
+        logger.warning("Option %s changed, it's only applied after a restart", key)
+        new_options.pop(key, None)
+        if key in old_options:
+          new_options[key] = old_options[key]
+    set_options(new_options)
+  except (IOError, ValueError, KeyError, TypeError, AttributeError), e:
+    logger.error("Couldn't reload %s, keeping the old options: %s", options_file, e)
+    return False
+  set_console_level()
+  set_up_repos(old_repos)
+  if event_prefilter is not None:
+    event_prefilter.set_projects(watched_projects)
+  if coalescer is not None:
+    coalescer.settle_seconds = SETTLE_SECONDS
+  if change_queries is not None:
+    change_queries.batch_size = max(1, QUERY_BATCH_SIZE)
+    change_queries.max_age = QUERY_MAX_AGE
+  if maintenance is not None:
+    maintenance.remote = GITREMOTE
+    maintenance.workers = max(1, MAINTENANCE_WORKERS)
+    maintenance.gc_loose_objects = GC_LOOSE_OBJECTS
+    maintenance.gc_packs = GC_PACKS
+  logger.info("Reloaded %s, watching %d projects", options_file, len(watched_projects))
+  return True
+
+def connect_event_stream():
+  """A new SSH connection running 'gerrit stream-events'.  Returns (client, stdout)"""
+  client = paramiko.SSHClient()
+  client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+  client.connect(GERRIT_HOST, username=USERNAME, key_filename=KEYFILE)
+  client.get_transport().set_keepalive(CONNECTION_CHECK_INTERVAL)
+  stdin, stdout, stderr = client.exec_command('gerrit stream-events')
+  return (client, stdout)
+
+def start_event_stream():
+  """Queue and reconnecting reader for the event stream"""
+  global event_queue, event_prefilter, event_stream
+  event_queue = spill_queue.SpillQueue(QUEUE_SPILL_FILE, QUEUE_HIGH_WATERMARK, QUEUE_LOW_WATERMARK)
+  event_prefilter = gerrit_stream_events.EventPrefilter(["comment-added", "ref-updated"], watched_projects)
+  event_stream = gerrit_stream_events.EventStream(connect_event_stream, event_queue, event_prefilter,
+                                                  catch_up_events, STREAM_BACKOFF, STREAM_MAX_BACKOFF,
+                                                  CONNECTION_CHECK_INTERVAL, PREFILTER_LOG_INTERVAL)
+  event_stream.start()
 
-# Git objects for viewing commits and files
-#   Handle filling in defaults if not there
-git_commands = {}
-git_repos = {}
-for repo in GITREPOS.keys():
-  git_commands[repo] = git.Git(GITREPOS[repo]["path"])
-  git_repos[repo] = git.Repo(GITREPOS[repo]["path"])
-  if "regexbranch" not in GITREPOS[repo]:
-    GITREPOS[repo]["regexbranch"] = "master"
-  logger.debug("Set up git repo object at %s for project %s. (AUTOREVIEW using %s)", GITREPOS[repo]["path"], repo, GITREPOS[repo]["regexbranch"])
-watched_projects = git_repos.keys()
-
-
-# Queue, SSH Connection, and Thread for the event stream
-event_queue = Queue()
-ssh_stream = paramiko.SSHClient()
-ssh_stream.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-ssh_stream.connect(GERRIT_HOST, username=USERNAME, key_filename=KEYFILE)
-ssh_stream.get_transport().set_keepalive(30)
-stdin, stdout, stderr = ssh_stream.exec_command('gerrit stream-events')
-thread_stream = Thread(name="event_stream", target=store_event_stream, args=(stdout, event_queue))
-thread_stream.daemon = True
-thread_stream.start()
-
-
-# Thread to check for active connection to stream
-thread_connection = Thread(name='connection_check', target=check_connection, args = [ssh_stream])
-thread_connection.daemon = True
-thread_connection.start()
-
-
-# SSH Connection for the commands
-ssh_commands = None
 
 """
 NOTES:
@@ -392,273 +1352,123 @@ Things to consider
 """
 
 
-logger.info("Entering event queue loop.")
 
-while True:
-  try:
-    line = event_queue.get(True, timeout=QUEUE_TIMEOUT)
-  except Empty:
-    pass
-  except KeyboardInterrupt:
-    logger.info("KeyboardInterrupt caught, closing ssh connections and exiting")
-    clean_up()
-    sys.exit(exit_code)
-  else:
-    event_json = json.loads(str(line))
-    if event_json["type"] == "comment-added" and \
-       event_json["change"]["project"] in watched_projects:
-      current_project = event_json["change"]["project"]
-      git_command = git_commands[current_project]
-      git_repo = git_repos[current_project]
-      git_settings = GITREPOS[current_project]
-
-      gerrit_comment = [] # No double-quotes please
-      comment_added = gerrit_stream_events.CommentAddedEvent(event_json)
-
-      if comment_added.verified == "1":
-        logger.debug("Considering %s change %s/%s : %s : %s", current_project, comment_added.number, comment_added.patch_number, comment_added.author, comment_added.subject)
-
-        # Get JSON info from gerrit
-        json_change = None
-        gerrit_return = send_gerrit_command (ssh_commands, 'gerrit query --current-patch-set --format json project:' + current_project + ' ' + \
-                          comment_added.number + '', expect_output = True)
-        if gerrit_return is not None:
-          gerrit_out, gerrit_err = gerrit_return
-          if len(gerrit_err) == 0:
-            json_change = json.loads(gerrit_out[0])
-
-        if json_change is not None and json_change["currentPatchSet"]["number"] != comment_added.patch_number:
-          logger.debug("Change %s/%s is not the current patch set [%s].", comment_added.number, comment_added.patch_number, json_change["currentPatchSet"]["number"])
-          continue
+def main():
+  global parsed_components, ssh_commands, coalescer, emails, accounts, reload_requested
+  if len(sys.argv) < 2:
+      print "Please pass in a config json file as the first argument."
+      print ""
+      print "Usage %s CONFIGFILE.json" % sys.argv[0]
+      sys.exit(1)
+  options_file = sys.argv[1]
+  if not os.path.isfile(options_file):
+    print "%s options file not found." % sys.argv[1]
+    sys.exit(1)
+  load_options(options_file)
+  set_up_logging()
 
-        reviewers = {}
-        reviewers_email = {}
-        author_opt_in = False
-        email_opt_in = False
-        high_priority_matches = False
-        merge_commit = False
+  logger.info("----------------- %s started -------------------", sys.argv[0])
 
-        try:
-          gitout = git_repo_fetch(git_command, comment_added.ref)
-          if gitout is None:
-            logger.error("Fetch failed (timeout) for %s/%s. Trying again.", comment_added.number, comment_added.patch_number)
-            gitout = git_repo_fetch(git_command, comment_added.ref)
-            if gitout is None:
-              raise GitTimeoutException()
-        except (git.errors.GitCommandError, GitTimeoutException), e:
-          # Failed Fetch
-          if isinstance(e, git.errors.GitCommandError):
-            logger.error("Git fetch failed: %s. stderr output: %s", e, str(e.stderr.split()))
-          else:
-            logger.error("Git fetch command timed out in %d seconds", TIMEOUT_FETCH)
-          # We can't exactly add a comment to the commit since we don't know if they want it reviewed
-          continue
+  set_up_object_pool()
+  set_up_repos()
+  set_up_workers()
 
-        # Get commit's information
-        parents = git.commit.Commit(git_repo, CHANGE_REF).parents
-        if len(parents) > 1 and (MERGE_REVIEWERS is not None and len(MERGE_REVIEWERS) > 0):
-          # We have a merge commit!
-          merge_commit = True
-          logger.debug("Commit is a merge commit.  Adding: %s", str(MERGE_REVIEWERS))
-          if MERGE_REVIEWERS is not None:
-            for i in MERGE_REVIEWERS:
-              add_reviewer_reason(reviewers, i, ("mergecommit",""))
-
-        # Check for ABANDONED
-        if json_change is not None:
-          if json_change["status"] == "ABANDONED":
-            logger.debug("Commit is marked ABANDONED")
-            continue
-
-        # Get the list of touched files
-        gitout = git_repo_show_touched_files(git_command)
-        if gitout is None:
-          logger.error("Git show command for touched files timed out in %d seconds", TIMEOUT_TOUCHED_FILES)
-          continue
-        comment_added.parse_touched_files(gitout)
+  # Parsed components files, keyed by blob sha
+  parsed_components = component_cache.ComponentCache(COMPONENT_CACHE_SIZE, COMPONENT_CACHE_FILE)
+  parsed_components.load()
 
-        # Get the commit message for the requested CRs
-        gitout = git_repo_commit_message(git_command)
-        if gitout is None:
-          logger.error("Git log command for commit message timed out in %d seconds", TIMEOUT_COMMIT_MESSAGE)
-          continue
-        comment_added.parse_git_commit(gitout, REQUEST_CR)
-
-        # It already is marked for merge
-        if not merge_commit:
-          if "CR: " in comment_added.commit_message or "NOCR: " in comment_added.commit_message:
-            logger.debug("Skipping commit, it is already marked with CR: or NOCR:")
-            continue
-
-        # Check for NOSUBMIT tag
-        if NOSUBMIT in comment_added.commit_message:
-          logger.debug("Commit is marked to not be submitted.")
-          if json_change is not None:
-            approvals = json_change["currentPatchSet"]["approvals"]
-            already_blocked = False
-            for approval in approvals:
-              if approval["by"]["name"] == USERNAME:
-                if approval["type"] == "Code-Review" and approval["value"] == "-2":
-                  already_blocked = True
-                  break
-            if not already_blocked and json.loads(gerrit_out[0])["status"] == "NEW":
-              gerrit_cr_command = 'gerrit review --project ' + current_project + ' --message ' + \
-                                '"Marking -2CR because of ' + NOSUBMIT + '" --code-review -2 ' + \
-                                  comment_added.number + "," + comment_added.patch_number
-              if ADD_COMMENT:
-                gerrit_return = send_gerrit_command (ssh_commands, gerrit_cr_command)
-              else:
-                logger.debug("Would send review command: %s", gerrit_cr_command)
-            else:
-              logger.debug("Change is already marked -2CR")
-          continue
+  # SSH Connections for the commands
+  ssh_commands = gerrit_ssh.SSHConnectionPool(GERRIT_HOST, USERNAME, KEYFILE, SSH_POOL_SIZE, SSH_IDLE_CHECK)
 
-        all_components = get_components_for_repo_and_branch(git_command, comment_added.branch, git_settings["regexbranch"])
+  # Known accounts, to check reviewers before adding them
+  if ACCOUNTS_COMMAND:
+    accounts = account_directory.AccountDirectory(fetch_accounts, ACCOUNTS_TTL)
+    accounts.start()
 
-        # Check for HIGH priority regex components
-        if not merge_commit:
-          for i in comment_added.touched_files:
-            (match, component) = components.find_component_re(all_components["regexhigh"], i)
-            if component is not None:
-              high_priority_matches = True
-              logger.debug("file change HIGH \"%s\" matched on %s", i, component)
-              add_multiple_reviewer_reasons(reviewers, pick_owner_all(component, comment_added.author), \
-                                    (i, "Matched on HIGH: " + match))
+  # Emails are sent in the background
+  if SEND_EMAILS:
+    emails = mail_queue.MailQueue(SMTP_SERVER, EMAIL_RETRIES, digest_seconds = EMAIL_DIGEST_SECONDS)
+    emails.start()
 
-        # If they explicitly ask for an AUTOREVIEW, give it to them
-        if OPTIN in comment_added.commit_message:
-          author_opt_in = True
+  # Bursts of events for one change are processed once
+  coalescer = event_coalescer.EventCoalescer(SETTLE_SECONDS)
 
-        if EMAIL_OPTIN in comment_added.commit_message:
-          email_opt_in = True
+  # Mirrors are fetched and gc'd from here instead of a cron job
+  set_up_maintenance()
 
-        # If no opt-in, requested, or high priority matches, then ignore
-        if not author_opt_in and len(comment_added.requested_cr) == 0 and not high_priority_matches and not merge_commit and not email_opt_in:
-          logger.debug("Skipping commit.  There were no requested CRs, Auto Review requests, or HIGH priority matches.")
-          continue
+  start_event_stream()
 
-        if author_opt_in and not merge_commit:
-          reviewers = process_touched_files(comment_added, all_components, starting_reviewers = reviewers)
-
-        if email_opt_in:
-          reviewers_email = process_touched_files(comment_added, all_components)
-          email = sendMail.EmailMessage()
-          email.setSMTPServer(SMTP_SERVER)
-          email.setFromAddr(EMAIL_FROM)
-          email.setToAddr([comment_added.author + "@" + USERS_EMAIL_DOMAIN])
-          email.setSubject(str("GerritReviewBot[%s] matches for %s" % (platform.uname()[1].upper(), comment_added.url)))
-          value = []
-          value.append(comment_added.author + ", these are the " + EMAIL_OPTIN + " matches for " + comment_added.url)
-          value.append("")
-          for reviewer in reviewers_email.keys():
-            reasons = reviewers_email[reviewer]
-            value.append(reviewer)
-            for i in reasons:
-              value.append(comment_added.url + "/" + comment_added.patch_number + "/" + i[0].replace(" ","+") + ",unified")
-            value.append("")
-          email_body = "\n".join(value)
-          email.setBody(str(email_body))
-          if SEND_EMAILS:
-            email.sendMessage()
-
-        logger.info("Requested CRs: [%s]", " ".join(comment_added.requested_cr))
-        for i in comment_added.requested_cr:
-          add_reviewer_reason(reviewers, i, ("requested", ""))
-
-        # Find the lucky reviewer who will be the main reviewer
-        most_review_reasons = 0
-        most_review_reviewer = None
-        if author_opt_in:
-          for i in reviewers.keys():
-            if len(reviewers[i]) > most_review_reasons and i != AUTHOR_NO_ONE:
-              most_review_reasons = len(reviewers[i])
-              most_review_reviewer = i
-          logger.debug("Top reviewing person %s with %s reason(s)", most_review_reviewer, most_review_reasons)
-
-        # Add reviewers
-        reviewers_to_add = [x for x in reviewers.keys() if x != AUTHOR_NO_ONE and x != AUTHOR_IGNORED]
-        command_add_reviewers_base = "gerrit set-reviewers --project " + current_project + " " + \
-                                    "".join([" --add " + x + "@" + USERS_EMAIL_DOMAIN for x in reviewers_to_add]) + \
-                                    " "# + comment_added.number
-        invalid_users = []
-        if ADD_REVIEWERS:
-          command_result = send_gerrit_command(ssh_commands, command_add_reviewers_base + comment_added.number)
-          if command_result is not None and len(command_result[1]) > 0:
-            if contains_multiple_matches(command_result[1]):
-              command_result = send_gerrit_command(ssh_commands, command_add_reviewers_base + comment_added.change_id)
-          if command_result is not None and len(command_result[1]) > 0:
-            invalid_users = scan_for_invalid_users(command_result[1])
-            if len(invalid_users) > 0:
-              logger.error("Invalid users were requested for CRs: %s", invalid_users)
-        else:
-          logger.debug("Would send reviewer command: %s", command_add_reviewers_base + comment_added.number)
-
-        # Construct the comment to add to gerrit
-        number_reviewers = len(reviewers)
-
-        # Check for invalid users
-        if len(invalid_users) > 0:
-          for invalid in invalid_users:
-            if invalid in reviewers:
-              del reviewers[invalid]
-              number_reviewers = number_reviewers - 1
-          gerrit_comment.append(" " + comment_added.author + ", the following users were invalid: " + str(invalid_users))
-          gerrit_comment.append("")
-          gerrit_comment.append("")
-
-        # Files with missing owners
-        if AUTHOR_NO_ONE in reviewers:
-          gerrit_comment.append(" " + comment_added.author + ", the following files could not have a reviewer mapped to them:")
-          gerrit_comment.append(get_review_string(AUTHOR_NO_ONE, reviewers[AUTHOR_NO_ONE], comment_added.url, comment_added.patch_number, is_unmatched = True))
-          gerrit_comment.append("")
-          gerrit_comment.append("")
-          number_reviewers = number_reviewers - 1
-
-        # Files we ignored
-        if AUTHOR_IGNORED in reviewers:
-          gerrit_comment.append(" " + comment_added.author + ", the following files are ignored by the bot:")
-          gerrit_comment.append(get_review_string(AUTHOR_IGNORED, reviewers[AUTHOR_IGNORED], comment_added.url, comment_added.patch_number, is_unmatched = True))
-          gerrit_comment.append("")
-          gerrit_comment.append("")
-          number_reviewers = number_reviewers - 1
-
-        if number_reviewers > 0:
-          gerrit_comment.append("")
-          gerrit_comment.append("You were each added as a reviewer for a reason.  Reasons listed under your username")
-          gerrit_comment.append("")
-
-        # The review owner
-        if most_review_reviewer is not None:
-          gerrit_comment.append(get_review_string(most_review_reviewer, reviewers[most_review_reviewer], \
-                                                   comment_added.url, comment_added.patch_number, is_main_reviewer = True))
-        gerrit_comment.append("")
-        gerrit_comment.append("")
-
-        # The rest of the people
-        for i in reviewers.keys():
-          if i != most_review_reviewer and i != AUTHOR_NO_ONE and i != AUTHOR_IGNORED:
-            gerrit_comment.append(get_review_string(i, reviewers[i], comment_added.url, comment_added.patch_number))
-            gerrit_comment.append("")
-            gerrit_comment.append("")
-        gerrit_comment.append("")
-        gerrit_comment.append("")
-
-        gerrit_comment.append("-Your friendly GerritReviewer Bot")
-
-        logger.debug("Comment for Gerrit: %s", gerrit_comment)
-
-        # Comment on the change
-        command_comment = "gerrit review --project " + current_project + " --message '" + \
-                                  "\n".join(gerrit_comment) + "' --code-review 0 " + \
-                                  comment_added.number + "," + comment_added.patch_number
-        if ADD_COMMENT:
-          send_gerrit_command(ssh_commands, command_comment)
-        else:
-          logger.debug("Would send comment command: %s", command_comment)
-      else:
-        pass # Not Verified + 1
+  if METRICS_PORT:
+    metrics.start_http_server(metrics_registry, int(METRICS_PORT), METRICS_ADDRESS)
+
+  # kill -HUP reloads the config file
+  signal.signal(signal.SIGHUP, request_reload)
+  # Restart system calls instead of raising EINTR in whatever thread was reading a pipe or socket
+  signal.siginterrupt(signal.SIGHUP, False)
+  # kill (daemon_gerritreview.sh kill) saves the queued events like Ctrl-C does
+  signal.signal(signal.SIGTERM, request_stop)
+  signal.siginterrupt(signal.SIGTERM, False)
+
+  logger.info("Entering event queue loop.")
+
+  last_queue_report = time.time()
+  while True:
+    if time.time() - last_queue_report > QUEUE_REPORT_INTERVAL:
+      report_queue()
+      git_repos.evict_idle()
+      parsed_components.save_soon()
+      last_queue_report = time.time()
+    if stop_requested:
+      logger.info("SIGTERM caught, closing ssh connections and exiting")
+      clean_up()
+      sys.exit(exit_code)
+    if reload_requested:
+      reload_requested = False
+      reload_options(options_file)
+    timeout = QUEUE_TIMEOUT
+    next_deadline = coalescer.next_deadline()
+    if next_deadline is not None:
+      timeout = max(0, min(QUEUE_TIMEOUT, next_deadline - time.time()))
+    try:
+      if dispatcher.queued() >= DISPATCH_LIMIT:
+        # The workers are behind, leave the events in event_queue where the watermarks apply
+        time.sleep(DISPATCH_WAIT)
+        continue
+      line = event_queue.get(True, timeout=timeout)
+    except Empty:
+      pass
+    except KeyboardInterrupt:
+      logger.info("KeyboardInterrupt caught, closing ssh connections and exiting")
+      clean_up()
+      sys.exit(exit_code)
     else:
-      pass # change that isn't in supported project
-    pass
+      try:
+        event_json = gerrit_stream_events.loads(line)
+      except ValueError, e:
+        logger.error("Couldn't decode event %s: %s", line, e)
+        continue
+      if event_json["type"] == "comment-added" and \
+         event_json["change"]["project"] in watched_projects:
+        number, patch_number = event_json["change"]["number"], event_json["patchSet"]["number"]
+        if event_json.get("catchUp") and seen_votes.contains(number, patch_number):
+          # Read from the stream before it dropped, but still queued when catching up
+          logger.debug("Change %s/%s was already read from the stream", number, patch_number)
+          continue
+        if event_coalescer.is_verified(event_json):
+          seen_votes.add(number, patch_number)
+        coalescer.add(event_json)
+      elif event_json["type"] == "ref-updated":
+        dispatch_ref_updated(event_json)
+      else:
+        pass # change that isn't in supported project
+    ready = coalescer.pop_ready()
+    for event_json in ready:
+      change_queries.want(event_json["change"]["number"])
+    for event_json in ready:
+      dispatcher.submit(event_json["change"]["project"], event_json)
+
+  logger.critical("Exited the while loop")
+
 
-logger.critical("Exited the while loop")
+if __name__ == "__main__":
+  main()
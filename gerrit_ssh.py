@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+  A pool of authenticated SSH connections for sending gerrit commands.
+"""
+
+import collections
+import logging
+import paramiko
+import socket
+import threading
+import time
+
+logger = logging.getLogger('gerrit_reviewer.ssh')
+
+
+class PooledConnection:
+  def __init__ (self, client):
+    self.client = client
+    self.last_used = time.time()
+
+  def is_active (self):
+    transport = self.client.get_transport()
+    return transport is not None and transport.is_active()
+
+  def close (self):
+    try:
+      self.client.close()
+    except Exception, e:
+      pass
+
+
+class SSHConnectionPool:
+  """Keeps up to size SSH connections open and runs commands on new channels.
+
+  Each command is run with exec_command on an already authenticated
+  transport, so only the first command (or one after a reconnect) pays for
+  the TCP connection, handshake and key auth.  Connections that were idle
+  for more than idle_check seconds are checked before being used again.
+
+  Callers wait on a condition for a connection once size connections are
+  open.  It's notified both when a connection comes back and when one is
+  discarded, so a waiter can open a new one in place of a broken one.
+  """
+  def __init__ (self, hostname, username, key_filename, size = 2, idle_check = 60, keepalive = 30):
+    self.hostname = hostname
+    self.username = username
+    self.key_filename = key_filename
+    self.size = max(1, int(size))
+    self.idle_check = idle_check
+    self.keepalive = keepalive
+    self.idle = collections.deque()
+    self.condition = threading.Condition(threading.Lock())
+    self.open_connections = 0
+    self.closed = False
+
+  def _connect (self):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(self.hostname, username=self.username, key_filename=self.key_filename)
+    if self.keepalive:
+      client.get_transport().set_keepalive(self.keepalive)
+    logger.debug("Opened SSH command connection to %s", self.hostname)
+    return PooledConnection(client)
+
+  def _is_healthy (self, connection):
+    if not connection.is_active():
+      return False
+    if time.time() - connection.last_used > self.idle_check:
+      try:
+        connection.client.get_transport().send_ignore()
+      except Exception, e:
+        return False
+    return True
+
+  def acquire (self):
+    """Get a healthy connection, opening a new one if the pool isn't full yet"""
+    while True:
+      connection = None
+      self.condition.acquire()
+      try:
+        while len(self.idle) == 0 and self.open_connections >= self.size:
+          self.condition.wait()
+        if len(self.idle) > 0:
+          connection = self.idle.popleft()
+        else:
+          self.open_connections += 1
+      finally:
+        self.condition.release()
+      if connection is None:
+        try:
+          return self._connect()
+        except:
+          self._discard(None)
+          raise
+      if self._is_healthy(connection):
+        return connection
+      logger.info("SSH command connection to %s is no longer active, reconnecting", self.hostname)
+      self._discard(connection)
+
+  def release (self, connection):
+    connection.last_used = time.time()
+    if self.closed:
+      self._discard(connection)
+      return
+    self.condition.acquire()
+    try:
+      self.idle.append(connection)
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def _discard (self, connection):
+    if connection is not None:
+      connection.close()
+    self.condition.acquire()
+    try:
+      self.open_connections -= 1
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def exec_command (self, command):
+    """Run a command on a pooled connection.
+
+    The command is retried once on a fresh connection if the channel
+    couldn't be opened.
+
+    Returns a tuple: (list stdout_lines, list stderr_lines)
+    """
+    for attempt in (1, 2):
+      connection = self.acquire()
+      try:
+        stdin, stdout, stderr = connection.client.exec_command(command)
+      except (paramiko.SSHException, socket.error, EOFError), e:
+        self._discard(connection)
+        if attempt == 2:
+          raise
+        logger.info("Couldn't open SSH channel (%s), retrying on a new connection", e)
+        continue
+      try:
+        stdin.close()
+        outlines = stdout.readlines()
+        errlines = stderr.readlines()
+      except:
+        self._discard(connection)
+        raise
+      self.release(connection)
+      return (outlines, errlines)
+
+  def close (self):
+    self.closed = True
+    self.condition.acquire()
+    try:
+      idle = list(self.idle)
+      self.idle.clear()
+    finally:
+      self.condition.release()
+    for connection in idle:
+      self._discard(connection)
@@ -1,14 +1,312 @@
 #!/bin/usr/env python
 
+import collections
+import json
+import logging
 import os
 import re
+import threading
+import time
+
+# Use a faster JSON decoder if one is installed
+try:
+  import ujson as fast_json
+except ImportError:
+  try:
+    import simplejson as fast_json
+  except ImportError:
+    fast_json = json
 
 
 #https://gerrit-documentation.googlecode.com/svn/Documentation/2.4.2/cmd-stream-events.html
 
+logger = logging.getLogger('gerrit_reviewer.stream')
+
+def loads (line):
+  """Decode one line of the event stream"""
+  return fast_json.loads(line)
+
+
+# Gerrit's JSON escapes these as \uXXXX, so names containing them can't be found as is
+JSON_ESCAPED_CHARACTERS = "<>&='"
+
+class EventPrefilter:
+  """Drops stream lines before they are decoded.
+
+  A line is kept only if it contains one of the event types (as a quoted
+  JSON string) and one of the project names.  Lines that pass still have
+  to be checked after decoding, this is only a cheap first pass.
+
+  Dropped lines are counted by reason in self.dropped.
+  """
+  def __init__ (self, event_types, projects):
+    self.lock = threading.Lock()
+    self.accepted = 0
+    self.dropped = {"type": 0, "project": 0}
+    self.type_needles = ['"%s"' % i for i in event_types]
+    self.set_projects(projects)
+
+  def set_projects (self, projects):
+    needles = []
+    for project in projects:
+      if [i for i in JSON_ESCAPED_CHARACTERS if i in project] or \
+          [i for i in project if ord(i) > 127]:
+        needles = None # Can't filter on this project's name
+        break
+      needles.append(json.dumps(project))
+    self.project_needles = needles
+
+  def accept (self, line):
+    reason = None
+    for needle in self.type_needles:
+      if needle in line:
+        break
+    else:
+      reason = "type"
+    if reason is None and self.project_needles is not None:
+      for needle in self.project_needles:
+        if needle in line:
+          break
+      else:
+        reason = "project"
+    self.lock.acquire()
+    try:
+      if reason is None:
+        self.accepted += 1
+      else:
+        self.dropped[reason] += 1
+    finally:
+      self.lock.release()
+    return reason is None
+
+  def stats (self):
+    """Returns a dict of the accepted and dropped counters"""
+    self.lock.acquire()
+    try:
+      result = {"accepted": self.accepted}
+      for reason in self.dropped.keys():
+        result["dropped_" + reason] = self.dropped[reason]
+      return result
+    finally:
+      self.lock.release()
+
+
+class EventStream:
+  """Reads 'gerrit stream-events' lines into a queue, reconnecting when it drops.
+
+  connect() returns (paramiko.SSHClient client, file stdout) of a new
+  'gerrit stream-events'.  When the stream ends, fails, or its transport
+  goes down (checked every check_interval seconds, which closes the client
+  so the blocked read returns), it's connected again after backoff,
+  2*backoff, 4*backoff... seconds, up to max_backoff.  The backoff starts
+  over once a connection stayed up for max_backoff seconds.
+
+  After a reconnect, catch_up(since) is called with the time the last line
+  was read (or the last connection was made, if it read nothing), so the
+  events published while the stream was down can be queued from a query.
+  """
+  def __init__ (self, connect, queue, prefilter = None, catch_up = None,
+                backoff = 1, max_backoff = 120, check_interval = 5, log_interval = 1000):
+    self.connect = connect
+    self.queue = queue
+    self.prefilter = prefilter
+    self.catch_up = catch_up
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.check_interval = check_interval
+    self.log_interval = log_interval
+    self.lock = threading.Lock()
+    self.client = None
+    self.running = False
+    self.connected_at = None
+    self.last_line = None
+    self.lines_read = 0
+    self.reconnects = 0
+    self.connect_failures = 0
+
+  def start (self):
+    self.running = True
+    for name, target in (("event_stream", self._run), ("connection_check", self._check)):
+      thread = threading.Thread(name=name, target=target)
+      thread.daemon = True
+      thread.start()
+
+  def close (self):
+    self.running = False
+    self._close_client()
+
+  def _close_client (self):
+    self.lock.acquire()
+    try:
+      client, self.client = self.client, None
+    finally:
+      self.lock.release()
+    if client is not None:
+      try:
+        client.close()
+      except Exception, e:
+        logger.debug("Error closing the event stream: %s", e)
+
+  def is_connected (self):
+    client = self.client
+    if client is None:
+      return False
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+  def _run (self):
+    backoff = self.backoff
+    gap_start = None
+    while self.running:
+      try:
+        client, stdout = self.connect()
+      except Exception, e:
+        self.connect_failures += 1
+        logger.error("Couldn't connect the event stream: %s. Trying again in %d seconds", e, backoff)
+        time.sleep(backoff)
+        backoff = min(backoff * 2, self.max_backoff)
+        continue
+      self.lock.acquire()
+      try:
+        self.client = client
+      finally:
+        self.lock.release()
+      self.connected_at = time.time()
+      logger.info("Event stream ready and waiting")
+      if gap_start is not None:
+        self.reconnects += 1
+        if self.catch_up is not None:
+          try:
+            self.catch_up(gap_start)
+          except Exception, e:
+            logger.exception("Couldn't catch up on the events since %s: %s", time.ctime(gap_start), e)
+      self._read(stdout)
+      self._close_client()
+      if not self.running:
+        break
+      gap_start = max(self.connected_at, self.last_line or 0)
+      if time.time() - self.connected_at >= self.max_backoff:
+        backoff = self.backoff
+      logger.error("Event stream disconnected, reconnecting in %d seconds", backoff)
+      time.sleep(backoff)
+      backoff = min(backoff * 2, self.max_backoff)
+
+  def _read (self, stdout):
+    try:
+      for line in iter(stdout.readline, b''):
+        self.last_line = time.time()
+        self.lines_read += 1
+        if self.prefilter is None or self.prefilter.accept(line):
+          self.queue.put(line)
+        if self.prefilter is not None and self.lines_read % self.log_interval == 0:
+          logger.debug("Event stream prefilter: %s", self.prefilter.stats())
+    except Exception, e:
+      if self.running:
+        logger.error("Error in event stream thread: %s", e)
+
+  def _check (self):
+    logger.info("Entering connection check loop")
+    while self.running:
+      time.sleep(self.check_interval)
+      if self.client is not None and not self.is_connected():
+        logger.warning("SSH Connection of the event stream is down")
+        self._close_client()
+
+  def stats (self):
+    last_line_age = 0
+    if self.last_line is not None:
+      last_line_age = time.time() - self.last_line
+    return {"connected": int(self.is_connected()), "reconnects": self.reconnects,
+            "connect_failures": self.connect_failures, "lines": self.lines_read,
+            "last_line_age": last_line_age}
+
+
+def comment_added_from_query (change, since):
+  """A comment-added event for the Verified+1 on the current patch set of a
+  'gerrit query --current-patch-set' result, if it was given at or after since.
+
+  Used to replay votes the event stream missed, the event has "catchUp": True.
+  Returns None if there's no such vote.
+  """
+  patch_set = change.get("currentPatchSet")
+  if patch_set is None:
+    return None
+  for approval in patch_set.get("approvals", []):
+    if approval.get("type") == "Verified" and str(approval.get("value")) == "1" and \
+       int(approval.get("grantedOn", 0)) >= since:
+      return {"type": "comment-added",
+              "change": dict([(key, change[key]) for key in
+                              ("project", "branch", "id", "number", "subject", "owner", "url") if key in change]),
+              "patchSet": {"number": patch_set["number"], "revision": patch_set.get("revision"),
+                           "ref": patch_set["ref"]},
+              "author": approval.get("by", {}),
+              "approvals": [{"type": "Verified", "description": "Verified", "value": "1"}],
+              "comment": "",
+              "eventCreatedOn": approval.get("grantedOn"),
+              "catchUp": True}
+  return None
+
+
+class SeenVotes:
+  """The (change number, patch set number) of the last size Verified+1 votes read.
+
+  catch_up uses it to skip the votes the stream did deliver before it
+  dropped, so they aren't reviewed twice.
+  """
+  def __init__ (self, size = 10000):
+    self.size = size
+    self.lock = threading.Lock()
+    self.order = collections.deque()
+    self.seen = set()
+
+  def add (self, number, patch_number):
+    key = (str(number), str(patch_number))
+    self.lock.acquire()
+    try:
+      if key in self.seen:
+        return
+      self.seen.add(key)
+      self.order.append(key)
+      while len(self.order) > self.size:
+        self.seen.discard(self.order.popleft())
+    finally:
+      self.lock.release()
+
+  def contains (self, number, patch_number):
+    self.lock.acquire()
+    try:
+      return (str(number), str(patch_number)) in self.seen
+    finally:
+      self.lock.release()
+
+
+# Entries in a query's file list that aren't files in the commit
+QUERY_MAGIC_FILES = ["/COMMIT_MSG", "/MERGE_LIST"]
+
 class GerritEvent:
   pass
 
+class RefUpdatedEvent (GerritEvent):
+  def __init__ (self, event):
+    ref_update = event["refUpdate"]
+    self.project = ref_update["project"]
+    self.ref_name = ref_update["refName"]
+    self.old_rev = ref_update.get("oldRev")
+    self.new_rev = ref_update.get("newRev")
+
+  def is_change_ref (self):
+    """True for the refs/changes/ refs of uploaded patch sets"""
+    return self.ref_name.startswith("refs/changes/")
+
+  def branch (self):
+    """The branch name, from a refs/heads/ name or the short name older
+    Gerrit versions send for branches.  None for other refs."""
+    if self.ref_name.startswith("refs/heads/"):
+      return self.ref_name[len("refs/heads/"):]
+    if self.ref_name.startswith("refs/"):
+      return None
+    return self.ref_name
+
 class CommentAddedEvent (GerritEvent):
   def __init__ (self, change):
     if change["type"] != "comment-added":
@@ -35,19 +333,21 @@ class CommentAddedEvent (GerritEvent):
     self.ref = change["patchSet"]["ref"]
     self.commit_message = ""
     self.touched_files = []
+    self.touched_files_total = 0
+    self.omitted_files = {} # top level directory => number of files over max_files
     self.requested_cr = []
+    self.parents = []
 
-  def parse_touched_files (self, log):
-    self.touched_files = []
-    for i in log.split(os.linesep)[1:]:
-      splitted = i.split(None, 1) # Max 1 because some files have spaces
-      splitted = i.split("\t")
-      if len(splitted) > 1:
-        #Renamed files will use the new filename
-        if i.startswith("R") and len(splitted) > 2:
-          self.touched_files.append(splitted[2].strip())
-        else:
-          self.touched_files.append(splitted[1].strip())
+  def add_touched_file (self, path, max_files = None):
+    """Add a touched file.  Past max_files, files are only counted by top level directory."""
+    self.touched_files_total += 1
+    if max_files is None or len(self.touched_files) < max_files:
+      self.touched_files.append(path)
+    else:
+      top = "/"
+      if "/" in path:
+        top = path[:path.index("/")]
+      self.omitted_files[top] = self.omitted_files.get(top, 0) + 1
 
   def parse_git_commit (self, commit, request_cr = None):
     self.commit_message = str(commit)
@@ -61,4 +361,23 @@ class CommentAddedEvent (GerritEvent):
     self.requested_cr = list(set(self.requested_cr))
     self.requested_cr = [ i.replace("\"","") for i in self.requested_cr ] # For Git Revert Quotes
 
+  def parse_query_result (self, change, request_cr = None, max_files = None):
+    """Fill in the touched files, commit message and parents from the JSON of
+    'gerrit query --current-patch-set --files --commit-message'.
+
+    Returns False if the query result doesn't contain that information.
+    """
+    patch_set = change.get("currentPatchSet", {})
+    if "files" not in patch_set or "parents" not in patch_set or "commitMessage" not in change:
+      return False
+    self.touched_files = []
+    self.touched_files_total = 0
+    self.omitted_files = {}
+    for i in patch_set["files"]:
+      if i["file"] in QUERY_MAGIC_FILES:
+        continue
+      self.add_touched_file(i["file"].encode("utf-8"), max_files)
+    self.parents = [i.encode("utf-8") for i in patch_set["parents"]]
+    self.parse_git_commit(change["commitMessage"].encode("utf-8"), request_cr)
+    return True
 
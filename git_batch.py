@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+  Long running git processes for reading objects out of a repo without
+  starting a new git process for every read.
+"""
+
+import logging
+import os
+import subprocess
+import threading
+
+import git_process
+
+logger = logging.getLogger('gerrit_reviewer.git_batch')
+
+# Lines diff-tree --stdin doesn't understand are echoed back, which marks
+#  the end of the output for a commit
+DIFF_TREE_END = "# end of diff-tree output"
+
+
+class GitBatchException(Exception):
+  pass
+
+
+class NulTokenReader:
+  """Reads NUL terminated tokens from a pipe as they arrive, without
+  holding more than one read's worth of output"""
+  def __init__ (self, stdout, read_size = 65536):
+    self.fd = stdout.fileno()
+    self.read_size = read_size
+    self.buffer = ""
+    self.start = 0
+
+  def _fill (self):
+    data = os.read(self.fd, self.read_size)
+    if data == "":
+      raise GitBatchException("unexpected end of output")
+    self.buffer = self.buffer[self.start:] + data
+    self.start = 0
+
+  def peek (self):
+    """The next character, without consuming it"""
+    while self.start >= len(self.buffer):
+      self._fill()
+    return self.buffer[self.start]
+
+  def token (self):
+    while True:
+      end = self.buffer.find("\0", self.start)
+      if end != -1:
+        value = self.buffer[self.start:end]
+        self.start = end + 1
+        return value
+      self._fill()
+
+  def line (self):
+    while True:
+      end = self.buffer.find("\n", self.start)
+      if end != -1:
+        value = self.buffer[self.start:end]
+        self.start = end + 1
+        return value
+      self._fill()
+
+
+class GitBatch:
+  """Keeps git cat-file --batch, cat-file --batch-check and diff-tree --stdin
+  running for one repo.
+
+  Each request is a write to the process's stdin and a read of the answer.
+  The processes are started on first use and started again if they die.
+  Requests are serialized, so one GitBatch can be shared between threads.
+
+  Requests given a timeout kill the process if it doesn't answer in time
+  and raise git_process.GitTimeoutException.
+  """
+  def __init__ (self, path, git_executable = "git"):
+    self.path = path
+    self.git_executable = git_executable
+    self.processes = {}
+    self.lock = threading.Lock()
+
+  def _start (self, name, args):
+    logger.debug("Starting git %s in %s", " ".join(args), self.path)
+    self.processes[name] = git_process.popen(args, self.path, self.git_executable,
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return self.processes[name]
+
+  def _stop (self, name):
+    process = self.processes.pop(name, None)
+    if process is None:
+      return
+    try:
+      process.stdin.close()
+    except Exception, e:
+      pass
+    try:
+      if process.poll() is None:
+        process.kill()
+      process.wait()
+    except Exception, e:
+      pass
+
+  def _request (self, name, args, line, read_answer, timeout = None, retry = True):
+    """Write line to the named process and read the answer with read_answer(stdout).
+
+    If the process died or the exchange failed, it is restarted and the
+    request is tried once more, unless retry is False.
+    """
+    self.lock.acquire()
+    try:
+      for attempt in (1, 2):
+        process = self.processes.get(name)
+        if process is None or process.poll() is not None:
+          self._stop(name)
+          process = self._start(name, args)
+        timer, expired = None, []
+        if timeout is not None:
+          timer, expired = git_process.deadline(process, timeout)
+        try:
+          process.stdin.write(line + "\n")
+          process.stdin.flush()
+          return read_answer(process.stdout)
+        except (IOError, OSError, ValueError, GitBatchException), e:
+          self._stop(name)
+          if len(expired) > 0:
+            raise git_process.GitTimeoutException(args + [line.split("\n")[0]], timeout, self.path)
+          if attempt == 2 or not retry:
+            raise GitBatchException("git %s failed in %s: %s" % (" ".join(args), self.path, e))
+          logger.info("git %s died in %s (%s), restarting it", " ".join(args), self.path, e)
+        except:
+          # The answer may be partly unread, don't reuse the process
+          self._stop(name)
+          raise
+        finally:
+          if timer is not None:
+            timer.cancel()
+    finally:
+      self.lock.release()
+
+  def _read_header (self, stdout):
+    header = stdout.readline()
+    if header == "":
+      raise GitBatchException("unexpected end of output")
+    parts = header.split()
+    if len(parts) == 2 and parts[1] == "missing":
+      return None
+    if len(parts) != 3:
+      raise GitBatchException("unexpected output: %s" % header.strip())
+    return (parts[0], parts[1], int(parts[2]))
+
+  def info (self, spec, timeout = None):
+    """Returns a tuple (str sha, str type, int size), or None if spec doesn't exist"""
+    return self._request("check", ["cat-file", "--batch-check"], spec, self._read_header, timeout)
+
+  def read (self, spec, timeout = None):
+    """Returns a tuple (str sha, str type, str content), or None if spec doesn't exist"""
+    def read_object(stdout):
+      header = self._read_header(stdout)
+      if header is None:
+        return None
+      content = stdout.read(header[2])
+      stdout.read(1) # Newline after the content
+      if len(content) != header[2]:
+        raise GitBatchException("short read of %s" % spec)
+      return (header[0], header[1], content)
+    return self._request("batch", ["cat-file", "--batch"], spec, read_object, timeout)
+
+  def show (self, spec):
+    """Returns the content of a blob like 'git show REV:PATH', or None if it doesn't exist"""
+    obj = self.read(spec)
+    if obj is None:
+      return None
+    return obj[2]
+
+  def read_commit (self, spec, timeout = None):
+    """Returns a tuple (list parent_shas, str message) for a commit, or None"""
+    obj = self.read(spec + "^{commit}", timeout)
+    if obj is None:
+      return None
+    headers, _, message = obj[2].partition("\n\n")
+    parents = [i[len("parent "):] for i in headers.split("\n") if i.startswith("parent ")]
+    return (parents, message.rstrip("\n"))
+
+  def touched_files (self, spec, handle, timeout = None):
+    """Call handle(str status, str path) for each file a commit touches, as
+    'git diff-tree -r -M --name-status -z' outputs them.
+
+    The output is parsed as it's read, so it's never all in memory at once.
+    Paths are taken as they are, tabs and newlines included.  Renames and
+    copies are passed with their new path.
+
+    Returns the commit's sha, or None if spec doesn't exist.  It isn't
+    retried if the process dies, since handle may have been called already.
+    """
+    info = self.info(spec + "^{commit}", timeout)
+    if info is None:
+      return None
+    def read_diff(stdout):
+      tokens = NulTokenReader(stdout)
+      while True:
+        # Statuses never start with "#", the echoed end marker always does
+        if tokens.peek() == "#":
+          line = tokens.line()
+          if line != DIFF_TREE_END:
+            raise GitBatchException("unexpected output: %s" % line)
+          return info[0]
+        status = tokens.token()
+        if status == info[0]:
+          continue # The commit header
+        path = tokens.token()
+        if status[:1] in ("R", "C"):
+          path = tokens.token() # Renames and copies have the old path first
+        handle(status, path)
+    return self._request("difftree", ["diff-tree", "--stdin", "--root", "-r", "-M", "--name-status", "-z"],
+                         info[0] + "\n" + DIFF_TREE_END, read_diff, timeout, retry = False)
+
+  def close (self):
+    self.lock.acquire()
+    try:
+      for name in self.processes.keys():
+        self._stop(name)
+    finally:
+      self.lock.release()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+  Runs git commands with a deadline that works from any thread.
+"""
+
+from threading import Timer
+import logging
+import os
+import signal
+import subprocess
+
+logger = logging.getLogger('gerrit_reviewer.git_process')
+
+
+class GitTimeoutException(Exception):
+  """A git command ran longer than its timeout and was killed"""
+  def __init__ (self, command, timeout, repo):
+    Exception.__init__(self, command, timeout, repo)
+    self.command = command
+    self.timeout = timeout
+    self.repo = repo
+
+  def __str__ (self):
+    return "git %s timed out after %s seconds in %s" % (" ".join(self.command), self.timeout, self.repo)
+
+
+class GitCommandException(Exception):
+  """A git command exited with a non-zero status"""
+  def __init__ (self, command, status, stderr, repo):
+    Exception.__init__(self, command, status, stderr, repo)
+    self.command = command
+    self.status = status
+    self.stderr = stderr
+    self.repo = repo
+
+  def __str__ (self):
+    return "git %s returned exit status %d in %s" % (" ".join(self.command), self.status, self.repo)
+
+
+def popen (args, cwd, git_executable = "git", **kwargs):
+  """Start git in its own process group, so kill_process_group gets its children too"""
+  return subprocess.Popen([git_executable] + args, cwd=cwd, preexec_fn=os.setsid, close_fds=True, **kwargs)
+
+def kill_process_group (process):
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except OSError, e:
+    pass # Already gone
+
+def deadline (process, timeout):
+  """Start a Timer that kills process's group after timeout seconds.
+
+  Returns (Timer timer, list expired), expired is non-empty once it fired.
+  Cancel the timer when the process is done.
+  """
+  expired = []
+  def expire():
+    expired.append(True)
+    kill_process_group(process)
+  timer = Timer(timeout, expire)
+  timer.daemon = True
+  timer.start()
+  return (timer, expired)
+
+def run (args, cwd, timeout = None, git_executable = "git"):
+  """Run git args in cwd and return its stdout.
+
+  Raises GitTimeoutException if it runs longer than timeout seconds, after
+  killing it and everything it started (ssh, remote helpers), and
+  GitCommandException if it fails.
+  """
+  with open(os.devnull, "r") as devnull:
+    process = popen(args, cwd, git_executable, stdin=devnull, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  timer, expired = None, []
+  if timeout is not None:
+    timer, expired = deadline(process, timeout)
+  try:
+    stdout, stderr = process.communicate()
+  finally:
+    if timer is not None:
+      timer.cancel()
+  if len(expired) > 0:
+    raise GitTimeoutException(args, timeout, cwd)
+  if process.returncode != 0:
+    raise GitCommandException(args, process.returncode, stderr, cwd)
+  return stdout
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+  Sends sendMail.EmailMessage objects from a background thread over a
+  reused SMTP connection.
+"""
+
+from Queue import Queue, Empty
+from threading import Thread, Lock
+import logging
+import smtplib
+import socket
+import time
+
+import sendMail
+
+logger = logging.getLogger('gerrit_reviewer.mail')
+
+
+class MailQueue:
+  """A queue of emails sent one at a time by a worker thread.
+
+  The SMTP connection is kept open between messages and checked with NOOP
+  before it's reused.  A message that fails to send is retried up to
+  retries times, waiting backoff, 2*backoff, 4*backoff... seconds between
+  tries, on a new connection each time.
+
+  With digest_seconds > 0, messages put with the same digest_key within
+  digest_seconds of the first one are sent as one email with their bodies
+  one after another.
+  """
+  def __init__ (self, smtpserver, retries = 3, backoff = 5, digest_seconds = 0):
+    self.smtpserver = smtpserver
+    self.retries = max(0, int(retries))
+    self.backoff = backoff
+    self.digest_seconds = digest_seconds
+    self.queue = Queue()
+    self.lock = Lock()
+    self.digests = {} # digest_key => [deadline, [EmailMessage]]
+    self.server = None
+    self.running = False
+    self.thread = None
+    self.sent = 0
+    self.failed = 0
+    self.retried = 0
+    self.digested = 0
+
+  def start (self):
+    self.running = True
+    self.thread = Thread(name="mail_queue", target=self._work)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def put (self, message, digest_key = None):
+    """Queue an EmailMessage to be sent"""
+    if self.digest_seconds <= 0 or digest_key is None:
+      self.queue.put(message)
+      return
+    self.lock.acquire()
+    try:
+      if digest_key not in self.digests:
+        self.digests[digest_key] = [time.time() + self.digest_seconds, []]
+      self.digests[digest_key][1].append(message)
+    finally:
+      self.lock.release()
+
+  def _combine (self, messages):
+    """One EmailMessage with the bodies of all of messages"""
+    if len(messages) == 1:
+      return messages[0]
+    first = messages[0]
+    digest = sendMail.EmailMessage()
+    if first.getFromAddr() is not None:
+      digest.setFromAddr(first.getFromAddr())
+    digest.setToAddr(list(first.getToAddrs()))
+    digest.setSubject("%s (and %d more)" % (first.getSubject(), len(messages) - 1))
+    digest.setBody(("\n" + "-" * 40 + "\n\n").join([i.getBody() for i in messages]))
+    self.digested += len(messages)
+    return digest
+
+  def _due_digests (self, now):
+    self.lock.acquire()
+    try:
+      due = [key for key in self.digests.keys() if self.digests[key][0] <= now]
+      return [self._combine(self.digests.pop(key)[1]) for key in due]
+    finally:
+      self.lock.release()
+
+  def _next_deadline (self):
+    self.lock.acquire()
+    try:
+      if len(self.digests) == 0:
+        return None
+      return min([i[0] for i in self.digests.values()])
+    finally:
+      self.lock.release()
+
+  def _disconnect (self):
+    if self.server is None:
+      return
+    try:
+      self.server.quit()
+    except Exception, e:
+      try:
+        self.server.close()
+      except Exception, e:
+        pass
+    self.server = None
+
+  def _connection (self):
+    """An open SMTP connection, reusing the last one if it still answers NOOP"""
+    if self.server is not None:
+      try:
+        if self.server.noop()[0] == 250:
+          return self.server
+      except (smtplib.SMTPException, socket.error), e:
+        logger.debug("SMTP connection went away: %s", e)
+      self._disconnect()
+    self.server = smtplib.SMTP(self.smtpserver)
+    return self.server
+
+  def _send (self, message):
+    for attempt in range(self.retries + 1):
+      try:
+        message.sendMessage(self._connection())
+        self.sent += 1
+        return True
+      except smtplib.SMTPRecipientsRefused, e:
+        logger.error("Email to %s was refused: %s", message.getToAddrs(), e)
+        break
+      except (smtplib.SMTPException, socket.error), e:
+        self._disconnect()
+        if attempt == self.retries:
+          logger.error("Couldn't send email to %s after %d tries: %s", message.getToAddrs(), attempt + 1, e)
+          break
+        wait = self.backoff * 2 ** attempt
+        logger.warning("Sending email to %s failed (%s), trying again in %.1f seconds", message.getToAddrs(), e, wait)
+        self.retried += 1
+        time.sleep(wait)
+    self.failed += 1
+    return False
+
+  def _work (self):
+    while self.running or not self.queue.empty():
+      for message in self._due_digests(time.time()):
+        self.queue.put(message)
+      timeout = 1
+      deadline = self._next_deadline()
+      if deadline is not None:
+        timeout = max(0, min(timeout, deadline - time.time()))
+      try:
+        message = self.queue.get(True, timeout)
+      except Empty:
+        continue
+      try:
+        self._send(message)
+      except Exception, e:
+        self.failed += 1
+        logger.exception("Unexpected error sending email: %s", e)
+    self._disconnect()
+
+  def close (self, timeout = 30):
+    """Send the digests now and wait up to timeout seconds for the queue to empty"""
+    for message in self._due_digests(float("inf")):
+      self.queue.put(message)
+    self.running = False
+    if self.thread is not None:
+      self.thread.join(timeout)
+      if self.thread.is_alive():
+        logger.warning("Gave up waiting for %d queued emails", self.queue.qsize())
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      waiting = sum([len(i[1]) for i in self.digests.values()])
+    finally:
+      self.lock.release()
+    return {"queued": self.queue.qsize(), "digest_waiting": waiting, "sent": self.sent,
+            "failed": self.failed, "retried": self.retried, "digested": self.digested}
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+"""
+  Counters, gauges and histograms served in the Prometheus text format.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread, Lock
+import logging
+
+logger = logging.getLogger('gerrit_reviewer.metrics')
+
+# Seconds, from a fast regex pass up to a fetch timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape_label_value (value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels (label_names, label_values, extra = ()):
+  pairs = list(zip(label_names, label_values)) + list(extra)
+  if len(pairs) == 0:
+    return ""
+  return "{" + ",".join(['%s="%s"' % (name, escape_label_value(value)) for name, value in pairs]) + "}"
+
+def format_value (value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value))
+
+
+class Metric:
+  metric_type = "untyped"
+
+  def __init__ (self, name, help_text, label_names = ()):
+    self.name = name
+    self.help_text = help_text
+    self.label_names = tuple(label_names)
+    self.lock = Lock()
+
+  def header (self):
+    return ["# HELP %s %s" % (self.name, self.help_text), "# TYPE %s %s" % (self.name, self.metric_type)]
+
+
+class CollectedMetric (Metric):
+  """A value per combination of label values, kept here or collected.
+
+  If a function is given, it's called when the metrics are collected and
+  returns a dict of label values tuple => value.
+  """
+  def __init__ (self, name, help_text, label_names = (), function = None):
+    Metric.__init__(self, name, help_text, label_names)
+    self.values = {}
+    self.function = function
+
+  def expose (self):
+    lines = self.header()
+    if self.function is not None:
+      try:
+        values = self.function()
+      except Exception, e:
+        logger.error("Couldn't collect %s: %s", self.name, e)
+        values = {}
+    else:
+      self.lock.acquire()
+      try:
+        values = dict(self.values)
+      finally:
+        self.lock.release()
+    for label_values in sorted(values.keys()):
+      lines.append("%s%s %s" % (self.name, format_labels(self.label_names, label_values),
+                                format_value(values[label_values])))
+    return lines
+
+
+class Counter (CollectedMetric):
+  """A value that only goes up, one per combination of label values.
+
+  Its name should end in _total.  With a function, the function returns
+  the running totals kept elsewhere.
+  """
+  metric_type = "counter"
+
+  def inc (self, label_values = (), amount = 1):
+    label_values = tuple(label_values)
+    self.lock.acquire()
+    try:
+      self.values[label_values] = self.values.get(label_values, 0) + amount
+    finally:
+      self.lock.release()
+
+
+class Gauge (CollectedMetric):
+  """A value that can go up and down, one per combination of label values"""
+  metric_type = "gauge"
+
+  def set (self, value, label_values = ()):
+    self.lock.acquire()
+    try:
+      self.values[tuple(label_values)] = value
+    finally:
+      self.lock.release()
+
+
+class Histogram (Metric):
+  """Counts observations into cumulative buckets, one set per combination of label values"""
+  metric_type = "histogram"
+
+  def __init__ (self, name, help_text, label_names = (), buckets = DEFAULT_BUCKETS):
+    Metric.__init__(self, name, help_text, label_names)
+    self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+    self.values = {} # label values => [bucket counts, sum, count]
+
+  def observe (self, value, label_values = ()):
+    label_values = tuple(label_values)
+    self.lock.acquire()
+    try:
+      if label_values not in self.values:
+        self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+      counts = self.values[label_values]
+      for index in range(len(self.buckets)):
+        if value <= self.buckets[index]:
+          counts[0][index] += 1
+          break
+      counts[1] += value
+      counts[2] += 1
+    finally:
+      self.lock.release()
+
+  def expose (self):
+    lines = self.header()
+    self.lock.acquire()
+    try:
+      for label_values in sorted(self.values.keys()):
+        bucket_counts, total, count = self.values[label_values]
+        cumulative = 0
+        for index in range(len(self.buckets)):
+          cumulative += bucket_counts[index]
+          lines.append("%s_bucket%s %d" % (self.name, format_labels(self.label_names, label_values,
+                                                                     [("le", format_value(self.buckets[index]))]), cumulative))
+        labels = format_labels(self.label_names, label_values)
+        lines.append("%s_sum%s %s" % (self.name, labels, format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, labels, count))
+    finally:
+      self.lock.release()
+    return lines
+
+
+class Registry:
+  def __init__ (self):
+    self.metrics = []
+
+  def register (self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def expose (self):
+    """Returns all the metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in self.metrics:
+      lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+def start_http_server (registry, port, address = "127.0.0.1"):
+  """Serve registry.expose() on http://address:port/metrics from a daemon thread"""
+  class MetricsHandler (BaseHTTPRequestHandler):
+    def do_GET (self):
+      if self.path.split("?")[0] not in ("/", "/metrics"):
+        self.send_error(404)
+        return
+      body = registry.expose()
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message (self, format, *args):
+      logger.debug("%s - %s", self.address_string(), format % args)
+
+  server = HTTPServer((address, port), MetricsHandler)
+  thread = Thread(name="metrics_http", target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  logger.info("Serving metrics on http://%s:%d/metrics", address, port)
+  return server
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+  Queries the changes of waiting events together, when the first of them
+  is picked up.
+"""
+
+from threading import Lock
+import logging
+import time
+
+logger = logging.getLogger('gerrit_reviewer.queries')
+
+
+class QueryBatcher:
+  """Change query results shared by the events waiting to be processed.
+
+  want(number) is called when an event that needs change number is queued.
+  get(number) is called when the event is processed: it returns a result
+  that was fetched less than max_age seconds ago, or queries number
+  together with up to batch_size - 1 other wanted changes that don't have
+  a fresh result.  So the batch holds what's actually waiting, and no
+  event uses a result older than max_age.
+
+  query(numbers) returns a dict of change number => change JSON and leaves
+  out the changes it couldn't query.  get() returns None for those.
+  """
+  def __init__ (self, query, batch_size = 50, max_age = 5):
+    self.query = query
+    self.batch_size = max(1, int(batch_size))
+    self.max_age = max_age
+    self.lock = Lock()
+    self.wanted = {}  # change number => number of waiting events
+    self.results = {} # change number => [time queried, change JSON]
+    self.batches = 0
+    self.hits = 0
+
+  def want (self, number):
+    self.lock.acquire()
+    try:
+      self.wanted[number] = self.wanted.get(number, 0) + 1
+    finally:
+      self.lock.release()
+
+  def forget (self, number):
+    """An event that wanted number won't be processed"""
+    self.lock.acquire()
+    try:
+      self._unwant(number)
+    finally:
+      self.lock.release()
+
+  def _unwant (self, number):
+    if number not in self.wanted:
+      return
+    self.wanted[number] -= 1
+    if self.wanted[number] <= 0:
+      del self.wanted[number]
+
+  def _expire (self, now):
+    for number in self.results.keys():
+      if now - self.results[number][0] > self.max_age:
+        del self.results[number]
+
+  def get (self, number):
+    """The query result of change number, or None if it couldn't be queried"""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      self._expire(now)
+      self._unwant(number)
+      if number in self.results:
+        self.hits += 1
+        return self.results[number][1]
+      batch = [number] + sorted([i for i in self.wanted.keys() if i != number and i not in self.results])
+      batch = batch[:self.batch_size]
+    finally:
+      self.lock.release()
+    queried_at = time.time()
+    changes = self.query(batch)
+    self.lock.acquire()
+    try:
+      self.batches += 1
+      for i in batch:
+        if i in changes:
+          self.results[i] = [queried_at, changes[i]]
+      if len(batch) > 1:
+        logger.debug("Queried %d changes for change %s", len(batch), number)
+    finally:
+      self.lock.release()
+    return changes.get(number)
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      return {"wanted": len(self.wanted), "results": len(self.results), "batches": self.batches, "hits": self.hits}
+    finally:
+      self.lock.release()
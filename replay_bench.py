@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+  Replays recorded 'gerrit stream-events' output through the review
+  pipeline of gerrit2.py and reports throughput and per-stage latencies.
+
+  Usage: replay_bench.py CONFIGFILE.json EVENTS_FILE [QUERIES_FILE]
+
+  CONFIGFILE.json is a normal bot config whose gitrepos point at local
+  fixture repos.  The patch set refs in the events have to be fetchable
+  from the fixture repo's gitremote, for example a bare repo the changes
+  were pushed to with 'git push fixture HEAD:refs/changes/45/12345/2'.
+  (With fetchfree and a QUERIES_FILE recorded with --files --commit-message,
+  only the components files are read from the fixture repo.)
+
+  QUERIES_FILE has recorded 'gerrit query --format json' output, one change
+  per line.  Changes without a recorded query get one made up from their
+  event: status NEW, with the event's patch set as the current patch set.
+
+  Nothing is sent to Gerrit and no emails are sent.  The set-reviewers and
+  review commands the pipeline issues are recorded and counted instead.
+"""
+
+import json
+import logging
+import sys
+import time
+
+import component_cache
+import gerrit2
+import gerrit_stream_events
+
+
+class FakeGerrit:
+  """Stands in for the SSHConnectionPool gerrit2 sends its commands to"""
+  def __init__ (self, queries):
+    self.queries = queries # change number => recorded query line
+    self.events = {}       # change number => latest event, for made up queries
+    self.commands = []
+
+  def made_up_query (self, event):
+    change = dict(event["change"])
+    change["status"] = "NEW"
+    change["currentPatchSet"] = dict(event["patchSet"])
+    change["currentPatchSet"]["approvals"] = event.get("approvals", [])
+    return change
+
+  def exec_command (self, command):
+    if command.startswith("gerrit query"):
+      number = command.split()[-1]
+      if number in self.queries:
+        line = self.queries[number]
+      elif number in self.events:
+        line = json.dumps(self.made_up_query(self.events[number])) + "\n"
+      else:
+        return ([], ["Error: no recorded query for change %s\n" % number])
+      return ([line, '{"type":"stats","rowCount":1}\n'], [])
+    self.commands.append(command)
+    return ([], [])
+
+  def close (self):
+    pass
+
+
+def percentile (ordered_values, fraction):
+  index = int(round(fraction * (len(ordered_values) - 1)))
+  return ordered_values[min(index, len(ordered_values) - 1)]
+
+def load_queries (queries_file):
+  queries = {}
+  if queries_file is None:
+    return queries
+  with open(queries_file, "r") as f:
+    for line in f:
+      change = json.loads(line)
+      if "number" in change:
+        queries[str(change["number"])] = line
+  return queries
+
+def report (lines_read, events_processed, elapsed, timings, commands):
+  print "Replayed %d lines, processed %d events in %.2f seconds (%.1f events/sec)" % \
+    (lines_read, events_processed, elapsed, events_processed / max(elapsed, 0.000001))
+  set_reviewers = len([i for i in commands if i.startswith("gerrit set-reviewers")])
+  reviews = len([i for i in commands if i.startswith("gerrit review")])
+  print "Commands issued: %d set-reviewers, %d review" % (set_reviewers, reviews)
+  print ""
+  print "%-14s %8s %10s %10s %10s %10s" % ("stage", "count", "p50 ms", "p90 ms", "p99 ms", "max ms")
+  for stage in sorted(timings.keys()):
+    ordered = sorted(timings[stage])
+    print "%-14s %8d %10.2f %10.2f %10.2f %10.2f" % (stage, len(ordered),
+      percentile(ordered, 0.5) * 1000, percentile(ordered, 0.9) * 1000,
+      percentile(ordered, 0.99) * 1000, ordered[-1] * 1000)
+
+def main ():
+  if len(sys.argv) < 3:
+    print "Usage %s CONFIGFILE.json EVENTS_FILE [QUERIES_FILE]" % sys.argv[0]
+    sys.exit(1)
+  queries_file = None
+  if len(sys.argv) > 3:
+    queries_file = sys.argv[3]
+
+  gerrit2.load_options(sys.argv[1])
+  gerrit2.SEND_EMAILS = False
+  handler = logging.StreamHandler()
+  handler.setLevel(logging.WARNING)
+  gerrit2.logger.addHandler(handler)
+
+  gerrit2.set_up_repos()
+  gerrit2.parsed_components = component_cache.ComponentCache(gerrit2.COMPONENT_CACHE_SIZE)
+  fake_gerrit = FakeGerrit(load_queries(queries_file))
+  gerrit2.ssh_commands = fake_gerrit
+
+  timings = {}
+  def record(stage, seconds):
+    if stage not in timings:
+      timings[stage] = []
+    timings[stage].append(seconds)
+  gerrit2.stage_observers.append(record)
+
+  prefilter = gerrit_stream_events.EventPrefilter(["comment-added"], gerrit2.watched_projects)
+  lines_read = 0
+  events_processed = 0
+  start = time.time()
+  with open(sys.argv[2], "r") as f:
+    for line in f:
+      lines_read += 1
+      with gerrit2.timed_stage("parse"):
+        if not prefilter.accept(line):
+          continue
+        event_json = gerrit_stream_events.loads(line)
+      if event_json["type"] != "comment-added" or \
+         event_json["change"]["project"] not in gerrit2.watched_projects:
+        continue
+      fake_gerrit.events[str(event_json["change"]["number"])] = event_json
+      with gerrit2.timed_stage("event"):
+        gerrit2.process_comment_added(event_json)
+      events_processed += 1
+  elapsed = time.time() - start
+
+  gerrit2.git_repos.close()
+  report(lines_read, events_processed, elapsed, timings, fake_gerrit.commands)
+
+
+if __name__ == "__main__":
+  main()
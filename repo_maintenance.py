@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+"""
+  Keeps the local mirrors fetched and packed from inside the bot, so it
+  doesn't compete with an outside cron job for the same repos.
+"""
+
+from Queue import Queue, Empty
+from threading import Thread, Lock, Event, Condition
+import contextlib
+import logging
+import os
+import re
+import time
+
+import git_process
+
+logger = logging.getLogger('gerrit_reviewer.maintenance')
+
+FETCH_TIMEOUT = 600 # seconds
+COUNT_OBJECTS_TIMEOUT = 60 # seconds
+GC_TIMEOUT = 3600 # seconds
+CLONE_TIMEOUT = 3600 # seconds
+GC_LOCK_WAIT = 60 # seconds gc waits for the reviews of a repo to finish before it's postponed
+
+
+class RepoLock:
+  """A shared/exclusive lock of one repo path.
+
+  Reviews hold it shared, so they only keep gc out and never wait for each
+  other, not even when several projects share the repo.  gc holds it
+  exclusive.  While gc waits for it, no new shared holders get it, so a
+  busy repo can't keep gc out forever.
+  """
+  def __init__ (self):
+    self.condition = Condition(Lock())
+    self.readers = 0
+    self.writer = False
+    self.writers_waiting = 0
+
+  def _wait (self, ready, timeout):
+    """Wait on the condition until ready() or timeout seconds passed.  Call with the condition held."""
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    while not ready():
+      if deadline is None:
+        self.condition.wait()
+      else:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return False
+        self.condition.wait(remaining)
+    return True
+
+  def acquire_shared (self, timeout = None):
+    """Returns False if it couldn't be had in timeout seconds"""
+    self.condition.acquire()
+    try:
+      if not self._wait(lambda: not self.writer and self.writers_waiting == 0, timeout):
+        return False
+      self.readers += 1
+      return True
+    finally:
+      self.condition.release()
+
+  def release_shared (self):
+    self.condition.acquire()
+    try:
+      self.readers -= 1
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+  def acquire_exclusive (self, timeout = None):
+    """Returns False if it couldn't be had in timeout seconds"""
+    self.condition.acquire()
+    try:
+      self.writers_waiting += 1
+      try:
+        if not self._wait(lambda: not self.writer and self.readers == 0, timeout):
+          return False
+      finally:
+        self.writers_waiting -= 1
+        self.condition.notify_all()
+      self.writer = True
+      return True
+    finally:
+      self.condition.release()
+
+  def release_exclusive (self):
+    self.condition.acquire()
+    try:
+      self.writer = False
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+
+class RepoLocks:
+  """One RepoLock per repo path, shared by event processing and maintenance"""
+  def __init__ (self):
+    self.lock = Lock()
+    self.locks = {} # path => RepoLock
+
+  def get (self, path):
+    self.lock.acquire()
+    try:
+      if path not in self.locks:
+        self.locks[path] = RepoLock()
+      return self.locks[path]
+    finally:
+      self.lock.release()
+
+  @contextlib.contextmanager
+  def hold (self, path, timeout = None, exclusive = False):
+    """Hold path's lock, shared unless exclusive, for the duration of a with block.
+
+    With a timeout, stop waiting after timeout seconds and run the block
+    without the lock.  Yields True if the lock is held.
+    """
+    lock = self.get(path)
+    if exclusive:
+      held = lock.acquire_exclusive(timeout)
+    else:
+      held = lock.acquire_shared(timeout)
+    try:
+      yield held
+    finally:
+      if held:
+        if exclusive:
+          lock.release_exclusive()
+        else:
+          lock.release_shared()
+
+
+def count_objects (path, timeout = COUNT_OBJECTS_TIMEOUT):
+  """The counters of 'git count-objects -v' as a dict, for example {"count": 12, "packs": 3}"""
+  counters = {}
+  for line in git_process.run(["count-objects", "-v"], path, timeout).splitlines():
+    if ":" not in line:
+      continue
+    key, value = line.split(":", 1)
+    try:
+      counters[key.strip()] = int(value.strip())
+    except ValueError:
+      pass
+  return counters
+
+
+def objects_dir (repo_path):
+  """The objects directory of a repo with a work tree or a bare repo"""
+  if os.path.isdir(os.path.join(repo_path, ".git")):
+    return os.path.join(repo_path, ".git", "objects")
+  return os.path.join(repo_path, "objects")
+
+
+class ObjectPool:
+  """A bare repo holding the objects of all the mirrors.
+
+  Mirrors borrow its objects through objects/info/alternates, so history
+  shared by forks and sibling repos is stored and fetched once.  absorb()
+  fetches a mirror's remote branches and tags into refs/pool/<mirror>/ of
+  the pool.  The pool is only ever repacked with -k and never pruned or
+  gc'd, since any of its objects may be the only copy a mirror has.  Its
+  config turns off auto gc and pruning, so git doesn't do it either.
+  """
+  def __init__ (self, path):
+    self.path = os.path.abspath(path)
+    self.lock = Lock()
+    self.repacks = 0
+
+  def ensure (self):
+    """Create the pool if it doesn't exist yet and make sure git never gcs or prunes it"""
+    if not os.path.isdir(os.path.join(self.path, "objects")):
+      logger.info("Creating the object pool at %s", self.path)
+      if not os.path.isdir(self.path):
+        os.makedirs(self.path)
+      git_process.run(["init", "--bare", "--quiet"], self.path)
+    git_process.run(["config", "gc.auto", "0"], self.path)
+    git_process.run(["config", "gc.pruneExpire", "never"], self.path)
+
+  def clone (self, url, repo_path):
+    """Clone a new mirror that borrows the pool's objects"""
+    logger.info("Cloning %s into %s with the object pool", url, repo_path)
+    parent = os.path.dirname(os.path.abspath(repo_path))
+    if not os.path.isdir(parent):
+      os.makedirs(parent)
+    git_process.run(["clone", "--quiet", "--reference", self.path, url, os.path.abspath(repo_path)],
+                    parent, CLONE_TIMEOUT)
+
+  def is_linked (self, repo_path):
+    alternates = os.path.join(objects_dir(repo_path), "info", "alternates")
+    if not os.path.isfile(alternates):
+      return False
+    with open(alternates, "r") as f:
+      linked = [os.path.abspath(line.strip()) for line in f if line.strip() != ""]
+    return os.path.join(self.path, "objects") in linked
+
+  def link (self, repo_path):
+    """Make an existing mirror borrow the pool's objects.  Returns True if it wasn't yet."""
+    if self.is_linked(repo_path):
+      return False
+    info = os.path.join(objects_dir(repo_path), "info")
+    if not os.path.isdir(info):
+      os.makedirs(info)
+    with open(os.path.join(info, "alternates"), "a") as f:
+      f.write(os.path.join(self.path, "objects") + "\n")
+    logger.info("Linked %s to the object pool", repo_path)
+    return True
+
+  def ref_prefix (self, repo_path):
+    return "refs/pool/" + re.sub("[^A-Za-z0-9._-]+", "_", os.path.abspath(repo_path).strip("/")) + "/"
+
+  def absorb (self, repo_path, timeout = FETCH_TIMEOUT):
+    """Fetch the objects of a mirror's remote branches and tags into the pool"""
+    prefix = self.ref_prefix(repo_path)
+    self.lock.acquire()
+    try:
+      # Kept as a pack, so the mirror's gc finds them packed and drops its loose copies
+      git_process.run(["-c", "fetch.unpackLimit=1", "fetch", "--quiet", "--no-tags", os.path.abspath(repo_path),
+                       "+refs/remotes/*:" + prefix + "remotes/*", "+refs/tags/*:" + prefix + "tags/*"],
+                      self.path, timeout)
+    finally:
+      self.lock.release()
+
+  def repack (self, loose_objects, packs):
+    """Pack the pool if it has loose_objects loose objects or packs packs, keeping every object"""
+    self.lock.acquire()
+    try:
+      counters = count_objects(self.path)
+      if counters.get("count", 0) < loose_objects and counters.get("packs", 0) < packs:
+        return False
+      logger.info("Repacking the object pool (%d loose objects, %d packs)", counters.get("count", 0),
+                  counters.get("packs", 0))
+      git_process.run(["repack", "-a", "-d", "-k", "-q"], self.path, GC_TIMEOUT)
+      self.repacks += 1
+      return True
+    finally:
+      self.lock.release()
+
+
+class MaintenanceScheduler:
+  """Fetches and gcs the repo paths that changed, every interval seconds.
+
+  A path is refreshed when mark_updated() was called for it since its last
+  refresh (from the ref-updated events of its projects), and every path is
+  refreshed once after it's added.  Up to workers paths are refreshed at
+  the same time.
+
+  After the fetch, 'git gc' only runs if the repo has gc_loose_objects
+  loose objects or gc_packs packs.  The fetch holds the path's lock in
+  locks shared, next to the reviews.  gc holds it exclusive: it waits up
+  to gc_lock_wait seconds for the reviews using the repo to finish, and
+  is postponed to the next round if they don't.
+
+  With an ObjectPool, each fetched path is linked to and absorbed into the
+  pool, and gc'd once after its first absorb so it drops the objects the
+  pool has now.  The pool is repacked after a round by the same limits.
+  Paths that don't exist yet are cloned against the pool from their URL in
+  set_paths' clone_urls, on the maintenance thread, as soon as they're
+  added.  With an interval of 0 that's all it does.
+  """
+  def __init__ (self, locks, remote, interval = 300, workers = 2, gc_loose_objects = 6700, gc_packs = 50,
+                pool = None, gc_lock_wait = GC_LOCK_WAIT):
+    self.locks = locks
+    self.gc_lock_wait = gc_lock_wait
+    self.pool = pool
+    self.pooled = set() # Paths absorbed and gc'd since start up
+    self.remote = remote
+    self.interval = interval
+    self.workers = max(1, int(workers))
+    self.gc_loose_objects = gc_loose_objects
+    self.gc_packs = gc_packs
+    self.lock = Lock()
+    self.paths = set()
+    self.dirty = set()
+    self.clone_urls = {} # path => URL to clone it from if it doesn't exist
+    self.wake = Event()
+    self.running = False
+    self.thread = None
+    self.clones = 0
+    self.fetches = 0
+    self.gcs = 0
+    self.failures = 0
+    self.busy = 0
+    self.last_round = 0
+
+  def set_paths (self, paths, clone_urls = None):
+    """The repo paths to maintain.  Paths that are new are refreshed in the next round.
+
+    clone_urls maps paths to the URL they're cloned from if they don't exist.
+    """
+    self.lock.acquire()
+    try:
+      paths = set(paths)
+      self.dirty.update(paths - self.paths)
+      self.dirty.intersection_update(paths)
+      self.paths = paths
+      self.clone_urls = dict(clone_urls or {})
+    finally:
+      self.lock.release()
+    self.wake.set()
+
+  def mark_updated (self, path):
+    self.lock.acquire()
+    try:
+      if path in self.paths:
+        self.dirty.add(path)
+    finally:
+      self.lock.release()
+
+  def mark_all_updated (self):
+    self.lock.acquire()
+    try:
+      self.dirty.update(self.paths)
+    finally:
+      self.lock.release()
+
+  def start (self):
+    self.running = True
+    self.thread = Thread(name="maintenance", target=self._loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close (self):
+    self.running = False
+    self.wake.set()
+
+  def _loop (self):
+    next_round = time.time() + self.interval
+    while self.running:
+      if self.interval > 0:
+        self.wake.wait(max(0, next_round - time.time()))
+      else:
+        self.wake.wait()
+      self.wake.clear()
+      if not self.running:
+        return
+      try:
+        self.set_up_pooled()
+        if self.interval > 0 and time.time() >= next_round:
+          self.run_once()
+          next_round = time.time() + self.interval
+      except Exception, e:
+        logger.exception("Error in repo maintenance: %s", e)
+
+  def set_up_pooled (self):
+    """Clone the paths that don't exist yet against the pool and link the others to it"""
+    if self.pool is None:
+      return
+    self.lock.acquire()
+    try:
+      paths = sorted(self.paths)
+      clone_urls = dict(self.clone_urls)
+    finally:
+      self.lock.release()
+    for path in paths:
+      try:
+        if os.path.exists(path):
+          self.pool.link(path)
+        elif path in clone_urls:
+          self.pool.clone(clone_urls[path], path)
+          self.clones += 1
+      except (git_process.GitTimeoutException, git_process.GitCommandException, OSError, IOError), e:
+        logger.error("Couldn't set up %s with the object pool: %s", path, e)
+        self.failures += 1
+
+  def run_once (self):
+    """Refresh the dirty paths now.  Returns the number of paths refreshed."""
+    self.lock.acquire()
+    try:
+      dirty, self.dirty = self.dirty, set()
+    finally:
+      self.lock.release()
+    if len(dirty) == 0:
+      return 0
+    start = time.time()
+    pending = Queue()
+    for path in sorted(dirty):
+      pending.put(path)
+    done = []
+    threads = []
+    for index in range(min(self.workers, len(dirty))):
+      thread = Thread(name="maintenance-%d" % index, target=self._work, args=(pending, done))
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+    if self.pool is not None and len(done) > 0:
+      try:
+        self.pool.repack(self.gc_loose_objects, self.gc_packs)
+      except (git_process.GitTimeoutException, git_process.GitCommandException), e:
+        logger.error("Couldn't repack the object pool: %s", e)
+        self.failures += 1
+    self.last_round = time.time()
+    logger.info("Refreshed %d of %d updated repos in %.1f seconds", len(done), len(dirty), self.last_round - start)
+    return len(done)
+
+  def _work (self, pending, done):
+    while True:
+      try:
+        path = pending.get(False)
+      except Empty:
+        return
+      if self.maintain(path):
+        done.append(path)
+      else:
+        self.mark_updated(path) # Try again next round
+
+  def maintain (self, path):
+    """Fetch path and gc it if it needs it.  Returns False if the gc was postponed or it failed."""
+    if not os.path.isdir(path):
+      logger.debug("Repo %s doesn't exist yet, maintaining it later", path)
+      return False
+    try:
+      with self.locks.hold(path):
+        git_process.run(["fetch", "--prune", "--quiet", self.remote], path, FETCH_TIMEOUT)
+        self.fetches += 1
+        gc = False
+        if self.pool is not None:
+          self.pool.link(path)
+          self.pool.absorb(path)
+          gc = path not in self.pooled
+        counters = count_objects(path)
+      if not gc and counters.get("count", 0) < self.gc_loose_objects and counters.get("packs", 0) < self.gc_packs:
+        return True
+      with self.locks.hold(path, self.gc_lock_wait, exclusive = True) as held:
+        if not held:
+          logger.debug("Repo %s is still busy after %d seconds, running gc later", path, self.gc_lock_wait)
+          self.busy += 1
+          return False
+        logger.info("Running gc in %s (%d loose objects, %d packs)", path, counters.get("count", 0),
+                    counters.get("packs", 0))
+        git_process.run(["gc", "--quiet"], path, GC_TIMEOUT)
+        self.gcs += 1
+        if self.pool is not None:
+          self.pooled.add(path)
+      return True
+    except (git_process.GitTimeoutException, git_process.GitCommandException), e:
+      logger.error("Couldn't maintain %s: %s", path, e)
+      self.failures += 1
+      return False
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      dirty = len(self.dirty)
+    finally:
+      self.lock.release()
+    stats = {"dirty": dirty, "fetches": self.fetches, "gcs": self.gcs, "failures": self.failures, "busy": self.busy}
+    if self.pool is not None:
+      stats["pool_repacks"] = self.pool.repacks
+      stats["clones"] = self.clones
+    return stats
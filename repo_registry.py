@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+  Git handles for the watched repos, opened on first use and closed when idle.
+"""
+
+from threading import Lock
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger('gerrit_reviewer.repos')
+
+
+class RepoRegistry:
+  """The open handles of each project's repo.
+
+  open_repo(project) creates the handles of a project the first time it's
+  needed and close_repo(handles) closes them again.  Handles nobody used
+  for idle_seconds are closed by evict_idle().  Handles pinned with use()
+  are never closed while they're in use: a project that's removed in the
+  meantime is closed when its last user is done.
+  """
+  def __init__ (self, open_repo, close_repo, idle_seconds = 900):
+    self.open_repo = open_repo
+    self.close_repo = close_repo
+    self.idle_seconds = idle_seconds
+    self.lock = Lock()
+    self.entries = {} # project => [handles, last used, users, removed]
+    self.opened = 0
+    self.evicted = 0
+
+  def get (self, project):
+    """The handles of project, opening them if they aren't open yet"""
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(project)
+      if entry is not None and not entry[3]:
+        entry[1] = time.time()
+        return entry[0]
+    finally:
+      self.lock.release()
+    # Opening runs git, don't hold up the other projects meanwhile
+    handles = self.open_repo(project)
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(project)
+      if entry is None or entry[3]:
+        # A removed entry that's still in use is closed by its last user
+        self.entries[project] = [handles, time.time(), 0, False]
+        self.opened += 1
+        logger.debug("Opened repo of project %s", project)
+        return handles
+      entry[1] = time.time()
+    finally:
+      self.lock.release()
+    self._close(project, handles) # Another thread opened it first
+    return entry[0]
+
+  @contextlib.contextmanager
+  def use (self, project):
+    """Keep project's handles open for the duration of a with block"""
+    handles = self.get(project)
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(project)
+      if entry is not None and entry[0] is handles:
+        entry[2] += 1
+      else:
+        entry = None
+    finally:
+      self.lock.release()
+    try:
+      yield handles
+    finally:
+      if entry is not None:
+        self._release(project, entry)
+
+  def _release (self, project, entry):
+    self.lock.acquire()
+    try:
+      entry[1] = time.time()
+      entry[2] -= 1
+      close = entry[3] and entry[2] == 0
+      if close and self.entries.get(project) is entry:
+        del self.entries[project]
+    finally:
+      self.lock.release()
+    if close:
+      self._close(project, entry[0])
+
+  def _close (self, project, handles):
+    try:
+      self.close_repo(handles)
+    except Exception, e:
+      logger.error("Couldn't close the repo of project %s: %s", project, e)
+
+  def remove (self, project):
+    """Close project's handles, or have them closed once they aren't in use"""
+    self.lock.acquire()
+    try:
+      entry = self.entries.get(project)
+      if entry is None:
+        return
+      entry[3] = True
+      if entry[2] > 0:
+        return
+      del self.entries[project]
+    finally:
+      self.lock.release()
+    self._close(project, entry[0])
+
+  def evict_idle (self, now = None):
+    """Close the handles that weren't used for idle_seconds.  Returns how many were closed."""
+    if now is None:
+      now = time.time()
+    self.lock.acquire()
+    try:
+      idle = [(project, entry) for project, entry in self.entries.items()
+              if entry[2] == 0 and now - entry[1] >= self.idle_seconds]
+      for project, entry in idle:
+        del self.entries[project]
+      self.evicted += len(idle)
+    finally:
+      self.lock.release()
+    for project, entry in idle:
+      logger.debug("Closing idle repo of project %s", project)
+      self._close(project, entry[0])
+    return len(idle)
+
+  def close (self):
+    self.lock.acquire()
+    try:
+      entries, self.entries = self.entries, {}
+    finally:
+      self.lock.release()
+    for project, entry in entries.items():
+      self._close(project, entry[0])
+
+  def stats (self):
+    self.lock.acquire()
+    try:
+      in_use = len([entry for entry in self.entries.values() if entry[2] > 0])
+      return {"open": len(self.entries), "in_use": in_use, "opened": self.opened, "evicted": self.evicted}
+    finally:
+      self.lock.release()
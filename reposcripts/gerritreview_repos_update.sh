@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# Not needed when the bot's config sets "maintenanceinterval", the bot fetches and gcs the repos itself.
+#  Running both makes them fight over the same repos.
+
 MY_HOME=/path/to/reposcripts/location
 BASE_DIR=/path/to/all/git/repos
 
@@ -2,6 +2,8 @@
 
 MY_HOME=/path/to/reposcripts/location
 BASE_DIR=/path/to/all/git/repos
+# Set POOL_DIR (the bot's "objectpool") to clone new repos borrowing the objects of the shared pool
+POOL_DIR=${POOL_DIR:-}
 
 if [ -z "$GIT_REPOS_LIST" ]; then
   echo "GIT_REPOS_LIST must be set to a file name"
@@ -13,6 +15,15 @@ if [ ! -f $GIT_REPOS_LIST ]; then
   exit 1
 fi
 
+CLONE_ARGS=""
+if [ -n "$POOL_DIR" ]; then
+  if [ ! -d $POOL_DIR/objects ]; then
+    echo "Creating the object pool $POOL_DIR"
+    git init --bare $POOL_DIR
+  fi
+  CLONE_ARGS="--reference $POOL_DIR"
+fi
+
 date
 for i in $(cat $GIT_REPOS_LIST); do
   REPO_DIR=$($MY_HOME/gerritreview_repos_format.sh $i)
@@ -20,6 +31,6 @@ for i in $(cat $GIT_REPOS_LIST); do
   cd $BASE_DIR
   if [ ! -d $REPO_DIR ]; then
     echo "Repo directory $REPO_DIR for repo $i does not exist. Clone"
-    git clone GERRITUSER@gerrit.example.local:$i $REPO_DIR
+    git clone $CLONE_ARGS GERRITUSER@gerrit.example.local:$i $REPO_DIR
   fi
 done
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict
+
+
+class ReviewerSet:
+  """The reviewers of a change and the reasons each one was picked.
+
+  Reasons are tuples of (item, notes), for example:
+    ("/path/to/file", "Matched on: regex"), ("requested", ""), ("mergecommit", "")
+
+  Besides reviewer => [reasons], it keeps an index of item => number of
+  reasons naming it, so is_matched is a dict lookup, and it keeps track of
+  the reviewer with the most reasons as reasons are added.  Reviewers in
+  excluded are never picked as the top reviewer.
+
+  Reviewers are kept in the order they were first added.  Names that only
+  differ in case are the same reviewer, kept as it was first spelled:
+  authors come from the local part of an email address, where the case is
+  anyone's guess.
+  """
+  def __init__ (self, excluded = ()):
+    self.reasons = OrderedDict()
+    self.names = {} # lower case name => name as first added
+    self.items = {}
+    self.excluded = set([i.lower() for i in excluded])
+    self.top_reviewer = None
+    self.top_count = 0
+
+  def _name (self, reviewer):
+    return self.names.get(reviewer.lower(), reviewer)
+
+  def add (self, reviewer, reason):
+    """Add a reason to add a certain reviewer"""
+    reviewer = self.names.setdefault(reviewer.lower(), reviewer)
+    if reviewer not in self.reasons:
+      self.reasons[reviewer] = []
+    self.reasons[reviewer].append(reason)
+    self.items[reason[0]] = self.items.get(reason[0], 0) + 1
+    count = len(self.reasons[reviewer])
+    if count > self.top_count and reviewer.lower() not in self.excluded:
+      self.top_reviewer = reviewer
+      self.top_count = count
+
+  def add_multiple (self, reviewers, reason):
+    if not isinstance(reviewers, list):
+      reviewers = [reviewers]
+    for i in reviewers:
+      self.add(i, reason)
+
+  def is_matched (self, item):
+    """Returns True if any reviewer has a reason for item"""
+    return item in self.items
+
+  def top (self):
+    """Returns a tuple: (str reviewer, int number_of_reasons) of the reviewer with the most reasons"""
+    return (self.top_reviewer, self.top_count)
+
+  def keys (self):
+    return self.reasons.keys()
+
+  def __len__ (self):
+    return len(self.reasons)
+
+  def __contains__ (self, reviewer):
+    return reviewer.lower() in self.names
+
+  def __getitem__ (self, reviewer):
+    return self.reasons[self._name(reviewer)]
+
+  def __delitem__ (self, reviewer):
+    reviewer = self._name(reviewer)
+    del self.names[reviewer.lower()]
+    for reason in self.reasons.pop(reviewer):
+      self.items[reason[0]] -= 1
+      if self.items[reason[0]] == 0:
+        del self.items[reason[0]]
+    if reviewer == self.top_reviewer:
+      self.top_reviewer, self.top_count = None, 0
+      for i in self.reasons.keys():
+        if len(self.reasons[i]) > self.top_count and i.lower() not in self.excluded:
+          self.top_reviewer, self.top_count = i, len(self.reasons[i])
@@ -16,8 +16,10 @@ class EmailMessage:
     An email message class that can attach files, have multiple recipients, and is easy to use.
   """
   def __init__ (self):
-    self.msg = MIMEMultipart()
+    self.fromAddr = None
+    self.subject = None
     self.bodyText = ""
+    self.isHtml = False
     self.smtpserver = None
     self.attachments = []
     self.toAddrs = []
@@ -30,7 +32,10 @@ class EmailMessage:
   def setFromAddr (self, fromAddr):
     if type(fromAddr) is not str:
       raise TypeError("From address must be a string")
-    self.msg['From'] = fromAddr
+    self.fromAddr = fromAddr
+
+  def getFromAddr (self):
+    return self.fromAddr
 
   def setToAddr (self, toAddrs):
     """Set the list of recipients for the email"""
@@ -44,10 +49,16 @@ class EmailMessage:
       raise TypeError("The to-address added to the list must be a str")
     self.toAddrs.append(toAddr)
 
+  def getToAddrs (self):
+    return self.toAddrs
+
   def setSubject (self, subject):
     if type(subject) is not str:
       raise TypeError("The subject must be a str")
-    self.msg['Subject'] = subject
+    self.subject = subject
+
+  def getSubject (self):
+    return self.subject
 
   def setBody (self, body, html=False):
     if type(body) is not str:
@@ -55,6 +66,9 @@ class EmailMessage:
     self.bodyText = body
     self.isHtml = html
 
+  def getBody (self):
+    return self.bodyText
+
   def setAttach (self, files):
     """Set the list of filenames the class will attach when it is time to send"""
     if type(files) is not list:
@@ -67,14 +81,19 @@ class EmailMessage:
       raise TypeError("The filename added must be a str")
     self.attachments.append(fileName)
 
-  def sendMessage (self):
-    """Send the actual message."""
-    self.msg['To'] = COMMASPACE.join(self.toAddrs)
-    self.msg['Date'] = formatdate(localtime=True)
+  def buildMessage (self):
+    """Build the MIME message with the body and attachments"""
+    msg = MIMEMultipart()
+    if self.fromAddr is not None:
+      msg['From'] = self.fromAddr
+    if self.subject is not None:
+      msg['Subject'] = self.subject
+    msg['To'] = COMMASPACE.join(self.toAddrs)
+    msg['Date'] = formatdate(localtime=True)
     if self.isHtml:
-      self.msg.attach( MIMEText(self.bodyText,'html') )
+      msg.attach( MIMEText(self.bodyText,'html') )
     else:
-      self.msg.attach ( MIMEText(self.bodyText) )
+      msg.attach ( MIMEText(self.bodyText) )
 
     if len(self.attachments) > 0:
       for filename in self.attachments:
@@ -83,11 +102,23 @@ class EmailMessage:
           part.set_payload( open(filename,"rb").read() )
           Encoders.encode_base64(part)
           part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(filename))
-          self.msg.attach(part)
-
+          msg.attach(part)
+    return msg
+
+  def sendMessage (self, server = None):
+    """Send the actual message.
+
+    If server is an open smtplib.SMTP connection the message is sent on it
+    and it's left open, otherwise a connection to the SMTP server is made
+    for this message.
+    """
+    msg = self.buildMessage()
+    if server is not None:
+      server.sendmail(self.fromAddr, self.toAddrs, msg.as_string())
+      return
     assert self.smtpserver is not None, "SMTP Server is not set"
     server = smtplib.SMTP(self.smtpserver)
-    server.sendmail(self.msg['From'], self.toAddrs, self.msg.as_string())
+    server.sendmail(self.fromAddr, self.toAddrs, msg.as_string())
     server.quit()
 
 
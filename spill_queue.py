@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+  A bounded event queue that spills to disk instead of growing in memory.
+"""
+
+from Queue import Empty
+import collections
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('gerrit_reviewer.spill_queue')
+
+
+class SpillQueue:
+  """A FIFO queue of single line strings with a bounded in-memory part.
+
+  While fewer than high_watermark items are in memory, put() keeps items in
+  memory.  Once it's reached, new items are appended to the segment file at
+  spill_path instead.  Items are read back from the file in order once the
+  in-memory part has drained below low_watermark, and until the file is
+  empty every new item goes to the file too, so the order never changes.
+
+  The read position in the file is kept in spill_path + ".offset", so items
+  still on disk are picked up again by the next process.  persist() moves
+  the in-memory items to disk as well, for use at shutdown.
+
+  get() has the same signature as Queue.get and raises Queue.Empty.  put()
+  never blocks, a full queue spills instead, so it takes no block or
+  timeout.
+  """
+  def __init__ (self, spill_path, high_watermark = 10000, low_watermark = 1000):
+    self.spill_path = spill_path
+    self.offset_path = spill_path + ".offset"
+    self.high_watermark = max(1, int(high_watermark))
+    self.low_watermark = min(max(0, int(low_watermark)), self.high_watermark - 1)
+    self.memory = collections.deque() # (time queued, item)
+    self.condition = threading.Condition()
+    self.spilled = 0        # items on disk that weren't read back yet
+    self.read_offset = 0
+    self.oldest_spilled = None
+    self.total_spilled = 0
+    self._recover()
+
+  def _recover (self):
+    """Pick up the items a previous process left on disk"""
+    if not os.path.isfile(self.spill_path):
+      return
+    if os.path.isfile(self.offset_path):
+      try:
+        with open(self.offset_path, "r") as f:
+          self.read_offset = int(f.read().strip() or 0)
+      except (IOError, ValueError), e:
+        logger.error("Couldn't read spill offset %s: %s", self.offset_path, e)
+    with open(self.spill_path, "r") as f:
+      f.seek(self.read_offset)
+      for record in f:
+        if record.endswith("\n"):
+          if self.oldest_spilled is None:
+            self.oldest_spilled = float(record.split("\t", 1)[0])
+          self.spilled += 1
+    if self.spilled > 0:
+      logger.info("Recovered %d spilled events from %s", self.spilled, self.spill_path)
+    else:
+      self._reset_spill()
+
+  def _reset_spill (self):
+    for path in (self.spill_path, self.offset_path):
+      if os.path.isfile(path):
+        os.remove(path)
+    self.read_offset = 0
+    self.spilled = 0
+    self.oldest_spilled = None
+
+  def _spill (self, queued_at, item):
+    with open(self.spill_path, "a") as f:
+      f.write("%f\t%s\n" % (queued_at, item.rstrip("\n")))
+    if self.spilled == 0:
+      self.oldest_spilled = queued_at
+      logger.warning("Event queue is full (%d in memory), spilling to %s", len(self.memory), self.spill_path)
+    self.spilled += 1
+    self.total_spilled += 1
+
+  def _refill (self):
+    """Move spilled items back into memory, up to high_watermark"""
+    with open(self.spill_path, "r") as f:
+      f.seek(self.read_offset)
+      while self.spilled > 0 and len(self.memory) < self.high_watermark:
+        record = f.readline()
+        if not record.endswith("\n"):
+          break # Partly written line, leave it for now
+        queued_at, item = record.rstrip("\n").split("\t", 1)
+        self.memory.append((float(queued_at), item))
+        self.spilled -= 1
+      self.read_offset = f.tell()
+      if self.spilled > 0:
+        next_record = f.readline()
+        if next_record.endswith("\n"):
+          self.oldest_spilled = float(next_record.split("\t", 1)[0])
+    if self.spilled == 0:
+      logger.info("Spilled events have all been read back from %s", self.spill_path)
+      self._reset_spill()
+    else:
+      with open(self.offset_path, "w") as f:
+        f.write(str(self.read_offset))
+
+  def put (self, item):
+    self.condition.acquire()
+    try:
+      queued_at = time.time()
+      if self.spilled > 0 or len(self.memory) >= self.high_watermark:
+        self._spill(queued_at, item)
+      else:
+        self.memory.append((queued_at, item.rstrip("\n")))
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def get (self, block = True, timeout = None):
+    self.condition.acquire()
+    try:
+      if self.spilled > 0 and len(self.memory) <= self.low_watermark:
+        self._refill()
+      if block:
+        end = None
+        if timeout is not None:
+          end = time.time() + timeout
+        while len(self.memory) == 0:
+          if end is None:
+            self.condition.wait()
+          else:
+            remaining = end - time.time()
+            if remaining <= 0:
+              break
+            self.condition.wait(remaining)
+      if len(self.memory) == 0:
+        raise Empty
+      return self.memory.popleft()[1]
+    finally:
+      self.condition.release()
+
+  def qsize (self):
+    return len(self.memory) + self.spilled
+
+  def stats (self):
+    """Returns a dict with the queue depth and the age in seconds of the oldest event"""
+    self.condition.acquire()
+    try:
+      oldest = None
+      if len(self.memory) > 0:
+        oldest = self.memory[0][0]
+      elif self.spilled > 0:
+        oldest = self.oldest_spilled
+      age = 0
+      if oldest is not None:
+        age = time.time() - oldest
+      return {"memory": len(self.memory), "spilled": self.spilled, "depth": len(self.memory) + self.spilled,
+              "oldest_age": age, "total_spilled": self.total_spilled}
+    finally:
+      self.condition.release()
+
+  def persist (self):
+    """Write the in-memory items to disk, ahead of the already spilled ones"""
+    self.condition.acquire()
+    try:
+      if len(self.memory) == 0:
+        return
+      remaining = []
+      if self.spilled > 0:
+        with open(self.spill_path, "r") as f:
+          f.seek(self.read_offset)
+          remaining = f.readlines()
+      temp_path = self.spill_path + ".tmp"
+      with open(temp_path, "w") as f:
+        for queued_at, item in self.memory:
+          f.write("%f\t%s\n" % (queued_at, item.rstrip("\n")))
+        f.writelines(remaining)
+      os.rename(temp_path, self.spill_path)
+      if os.path.isfile(self.offset_path):
+        os.remove(self.offset_path)
+      logger.info("Saved %d queued events to %s", len(self.memory) + self.spilled, self.spill_path)
+      self.spilled += len(self.memory)
+      self.oldest_spilled = self.memory[0][0]
+      self.read_offset = 0
+      self.memory.clear()
+    finally:
+      self.condition.release()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+"""
+  Reviewers Gerrit rejected are caught by the account directory next time.
+"""
+
+import unittest
+
+import account_directory
+import gerrit2
+
+
+REJECTED = "error: could not add typo@example.com: typo@example.com does not identify a registered user or group\n"
+
+
+class AccountDirectoryTest (unittest.TestCase):
+  def setUp (self):
+    gerrit2.USERS_EMAIL_DOMAIN = "example.com"
+
+  def test_rejected_reviewer_is_invalid_next_time (self):
+    rejected = gerrit2.scan_for_invalid_users([REJECTED, "fatal: something else\n"])
+    self.assertEqual(rejected, ["typo"])
+    directory = account_directory.AccountDirectory(lambda: ["alice"])
+    self.assertEqual(directory.find_invalid(["typo", "alice"]), [])
+    directory.add_invalid(rejected)
+    self.assertEqual(directory.find_invalid(["typo", "alice"]), ["typo"])
+
+  def test_account_name (self):
+    self.assertEqual(account_directory.account_name("bob@example.com", "example.com"), "bob")
+    self.assertEqual(account_directory.account_name("Developers", "example.com"), "Developers")
+    self.assertEqual(account_directory.account_name("bob@other.com", "example.com"), "bob@other.com")
+
+  def test_unknown_names_are_only_rejected_when_strict (self):
+    directory = account_directory.AccountDirectory(lambda: ["alice"])
+    directory.refresh()
+    self.assertEqual(directory.find_invalid(["alice", "Developers"]), [])
+    self.assertEqual(directory.find_invalid(["alice", "Developers"], True), ["Developers"])
+    self.assertEqual(directory.stats()["unknown"], 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""
+  ComponentCache saving and loading its file.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import component_cache
+
+
+class ComponentCacheTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "cache.pickle")
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def load (self):
+    cache = component_cache.ComponentCache(32, self.path)
+    cache.load()
+    return sorted([key[1] for key in cache.entries.keys()])
+
+  def test_misses_are_saved_at_most_once_per_interval (self):
+    cache = component_cache.ComponentCache(32, self.path, save_interval = 3600)
+    cache.get(("packages", "a"), lambda: "A")
+    self.assertEqual(self.load(), ["a"])
+    cache.get(("packages", "b"), lambda: "B")
+    cache.save_soon()
+    self.assertEqual(self.load(), ["a"])
+    cache.save()
+    self.assertEqual(self.load(), ["a", "b"])
+
+  def test_concurrent_misses_leave_a_whole_file (self):
+    cache = component_cache.ComponentCache(32, self.path, save_interval = 0)
+    def miss(name):
+      for i in range(20):
+        cache.get(("packages", "%s%d" % (name, i)), lambda: name * 1000)
+    threads = [threading.Thread(target=miss, args=(i,)) for i in "abcd"]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(10)
+    cache.save()
+    self.assertEqual(len(self.load()), 32)
+    self.assertEqual(os.listdir(self.tmp), ["cache.pickle"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+  ComponentWarmer with fake check and build functions.
+"""
+
+import threading
+import unittest
+
+import component_warmer
+
+
+def merge (waiting, newer):
+  return {"name": waiting["name"] + "+" + newer["name"], "changed": waiting["changed"] or newer["changed"]}
+
+
+class ComponentWarmerTest (unittest.TestCase):
+  def setUp (self):
+    self.checking = threading.Event()
+    self.building = threading.Event()
+    self.check_done = threading.Event()
+    self.build_done = threading.Event()
+    self.checked = []
+    self.built = []
+    self.warmer = component_warmer.ComponentWarmer(self.check, self.build, 2, merge)
+    self.warmer.start()
+
+  def tearDown (self):
+    self.check_done.set()
+    self.build_done.set()
+
+  def check (self, event):
+    if event["name"] == "slow":
+      self.checking.set()
+      self.check_done.wait(5)
+    self.checked.append(event["name"])
+    return event["changed"]
+
+  def build (self, event):
+    self.building.set()
+    self.build_done.wait(5)
+    self.built.append(event["name"])
+
+  def test_reviews_wait_from_the_update_on (self):
+    self.warmer.put("proj", "master", {"name": "slow", "changed": False})
+    self.checking.wait(5)
+    # Stale while the update is checked, not only while the maps are built
+    self.assertFalse(self.warmer.wait("proj", 0.1))
+    self.assertTrue(self.warmer.wait("other", 0))
+    self.check_done.set()
+    self.assertTrue(self.warmer.wait("proj", 5))
+
+    self.warmer.put("proj", "master", {"name": "owners", "changed": True})
+    self.building.wait(5)
+    self.assertFalse(self.warmer.wait("proj", 0.1))
+    self.build_done.set()
+    self.assertTrue(self.warmer.wait("proj", 5))
+    self.assertEqual(self.built, ["owners"])
+    stats = self.warmer.stats()
+    self.assertEqual((stats["checked"], stats["built"], stats["failures"], stats["stale_projects"]), (2, 1, 0, 0))
+
+  def test_waiting_updates_of_a_branch_are_merged (self):
+    self.warmer.put("proj", "master", {"name": "slow", "changed": False})
+    self.checking.wait(5)
+    self.warmer.put("proj", "master", {"name": "a", "changed": False})
+    self.warmer.put("proj", "master", {"name": "b", "changed": True})
+    self.warmer.put("proj", "stable", {"name": "c", "changed": False})
+    self.assertEqual(self.warmer.stats()["queued"], 2)
+    self.check_done.set()
+    self.build_done.set()
+    self.assertTrue(self.warmer.wait("proj", 5))
+    self.assertEqual(self.checked, ["slow", "a+b", "c"])
+    self.assertEqual(self.built, ["a+b"])
+    self.assertEqual(self.warmer.stats()["merged"], 1)
+
+  def test_a_slow_project_doesnt_hold_up_the_others (self):
+    self.warmer.put("proj", "master", {"name": "slow", "changed": False})
+    self.checking.wait(5)
+    self.warmer.put("other", "master", {"name": "quick", "changed": False})
+    self.assertTrue(self.warmer.wait("other", 5))
+    self.assertFalse(self.warmer.wait("proj", 0))
+    self.check_done.set()
+    self.assertTrue(self.warmer.wait("proj", 5))
+
+
+if __name__ == "__main__":
+  unittest.main()
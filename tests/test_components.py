@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+  ComponentMatcher has to pick the same rule as find_component_re.
+
+  Run from the top of the repo: python -m unittest discover tests
+"""
+
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict
+import cPickle
+import random
+import unittest
+
+import components
+
+
+RULES = ["x", "^src/", "\\.md$", "a.b", "^x", "b$", "doc/.*\\.txt", "(foo|bar)/", "^$", "x\\nx",
+         "(a)\\1", "(?i)README", "[", "te?st"]
+ALPHABET = "xab./\nsrcmdREADMEfootTt"
+
+
+def make_components (keys):
+  result = OrderedDict()
+  for key in keys:
+    result[key] = components.Component(key, ["owner"])
+  return result
+
+
+class ComponentMatcherTest (unittest.TestCase):
+  def assert_same (self, rules, items):
+    comps = make_components(rules)
+    matcher = components.ComponentMatcher(comps)
+    valid = make_components([key for key in rules if key not in [i[0] for i in matcher.invalid]])
+    for item in items:
+      self.assertEqual(matcher.match(item)[0], components.find_component_re(valid, item)[0],
+                       "rules %r item %r" % (rules, item))
+
+  def test_newline_before_match (self):
+    self.assert_same(["x"], ["\n.xxb", "a\nx", "\n\nx"])
+    self.assert_same(["y", "x"], ["\n.xxb", "a\nx", "\n\nx", "y\n"])
+
+  def test_same_as_find_component_re (self):
+    rand = random.Random(1234)
+    for i in range(300):
+      rules = rand.sample(RULES, rand.randint(1, len(RULES)))
+      items = ["".join(rand.choice(ALPHABET) for j in range(rand.randint(0, 12))) for k in range(20)]
+      self.assert_same(rules, items)
+
+  def test_memo (self):
+    matcher = components.ComponentMatcher(make_components(["x", "y"]), memo_size = 1)
+    self.assertEqual(matcher.match("ay")[0], "y")
+    self.assertEqual(matcher.match("ay")[0], "y")
+    self.assertEqual(matcher.match("ax")[0], "x")
+    self.assertEqual(matcher.memo_stats(), {"hits": 1, "misses": 2, "entries": 1})
+
+
+class PackageTrieTest (unittest.TestCase):
+  def test_same_as_find_component (self):
+    comps = make_components(["com.foo", "com.foo.bar", "org", "com.foo.bar.baz.qux"])
+    trie = components.PackageTrie(comps)
+    for item in ["com.foo.bar.x", "com.foo", "com.food", "org.a.b", "com", "com.foo.bar.baz", ""]:
+      self.assertEqual(trie.find(item), components.find_component(comps, item), item)
+
+  def test_built_on_first_find (self):
+    trie = components.PackageTrie(make_components(["com.foo"]))
+    self.assertTrue(trie.root is None)
+    self.assertEqual(trie.find("com.foo.bar")[0], "com.foo")
+    copy = cPickle.loads(cPickle.dumps(trie, cPickle.HIGHEST_PROTOCOL))
+    self.assertTrue(copy.root is None)
+    self.assertEqual(copy.find("com.foo.bar")[0], "com.foo")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+  EventCoalescer with a fake clock.
+"""
+
+import unittest
+
+import event_coalescer
+
+
+def comment_added (number, patch_number, verified = "1", project = "proj"):
+  return {"type": "comment-added", "change": {"project": project, "number": str(number)},
+          "patchSet": {"number": str(patch_number)}, "approvals": [{"type": "Verified", "value": verified}]}
+
+
+class EventCoalescerTest (unittest.TestCase):
+  def setUp (self):
+    self.coalescer = event_coalescer.EventCoalescer(10)
+
+  def test_votes_for_a_patch_set_are_coalesced (self):
+    first = comment_added(1, 2)
+    second = comment_added(1, 2)
+    self.assertTrue(self.coalescer.add(first, now = 100))
+    self.assertTrue(self.coalescer.add(second, now = 105))
+    # The replacement keeps the first event's deadline
+    self.assertEqual(self.coalescer.next_deadline(), 110)
+    self.assertEqual(self.coalescer.pop_ready(now = 109), [])
+    ready = self.coalescer.pop_ready(now = 110)
+    self.assertEqual(len(ready), 1)
+    self.assertTrue(ready[0] is second)
+    self.assertEqual(self.coalescer.stats(), {"pending": 0, "replaced": 1, "dropped": 0})
+
+  def test_newer_patch_sets_win (self):
+    self.assertTrue(self.coalescer.add(comment_added(1, 2), now = 100))
+    self.assertTrue(self.coalescer.add(comment_added(1, 3), now = 101))
+    self.assertFalse(self.coalescer.add(comment_added(1, 2), now = 102))
+    self.assertEqual([i["patchSet"]["number"] for i in self.coalescer.drain()], ["3"])
+    # Any comment on a newer patch set makes the pending vote stale
+    self.assertTrue(self.coalescer.add(comment_added(2, 1), now = 100))
+    self.assertFalse(self.coalescer.add(comment_added(2, 2, verified = "0"), now = 101))
+    self.assertEqual(self.coalescer.drain(), [])
+    self.assertEqual(self.coalescer.stats(), {"pending": 0, "replaced": 1, "dropped": 2})
+
+  def test_ready_events_come_out_oldest_first (self):
+    self.coalescer.add(comment_added(3, 1), now = 102)
+    self.coalescer.add(comment_added(1, 1), now = 100)
+    self.coalescer.add(comment_added(1, 1, project = "other"), now = 101)
+    self.coalescer.add(comment_added(2, 1), now = 115)
+    ready = self.coalescer.pop_ready(now = 112)
+    self.assertEqual([(i["change"]["project"], i["change"]["number"]) for i in ready],
+                     [("proj", "1"), ("other", "1"), ("proj", "3")])
+    self.assertEqual(self.coalescer.next_deadline(), 125)
+
+  def test_events_flush_once_they_settle (self):
+    self.assertEqual(self.coalescer.next_deadline(), None)
+    self.assertFalse(self.coalescer.add(comment_added(1, 1, verified = "-1"), now = 100))
+    self.assertEqual(self.coalescer.next_deadline(), None)
+    self.coalescer.add(comment_added(1, 1), now = 100)
+    self.assertEqual(self.coalescer.pop_ready(now = 109.9), [])
+    self.assertEqual(len(self.coalescer.pop_ready(now = 110)), 1)
+    # Without a settle time they're ready right away
+    self.coalescer.settle_seconds = 0
+    self.coalescer.add(comment_added(2, 1), now = 200)
+    self.assertEqual(len(self.coalescer.pop_ready(now = 200)), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
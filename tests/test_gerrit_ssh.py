@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+  SSHConnectionPool with fake connections, no SSH server needed.
+"""
+
+import threading
+import time
+import unittest
+
+import gerrit_ssh
+
+
+class FakeStream:
+  def __init__ (self, lines, error = None):
+    self.lines = lines
+    self.error = error
+
+  def readlines (self):
+    if self.error is not None:
+      raise self.error
+    return self.lines
+
+  def close (self):
+    pass
+
+
+class FakeClient:
+  def __init__ (self, pool):
+    self.pool = pool
+    self.closed = False
+
+  def exec_command (self, command):
+    self.pool.started.set()
+    self.pool.proceed.wait()
+    if command == "fail":
+      return (FakeStream([]), FakeStream([], IOError("read failed")), FakeStream([]))
+    return (FakeStream([]), FakeStream([command + "\n"]), FakeStream([]))
+
+  def close (self):
+    self.closed = True
+
+
+class FakeConnection (gerrit_ssh.PooledConnection):
+  def is_active (self):
+    return not self.client.closed
+
+
+class FakePool (gerrit_ssh.SSHConnectionPool):
+  def __init__ (self, size):
+    gerrit_ssh.SSHConnectionPool.__init__(self, "host", "user", "key", size)
+    self.started = threading.Event()
+    self.proceed = threading.Event()
+    self.connects = 0
+
+  def _connect (self):
+    self.connects += 1
+    return FakeConnection(FakeClient(self))
+
+
+class SSHConnectionPoolTest (unittest.TestCase):
+  def test_waiter_wakes_up_when_busy_connection_is_discarded (self):
+    pool = FakePool(1)
+    errors = []
+    def failing():
+      try:
+        pool.exec_command("fail")
+      except IOError, e:
+        errors.append(e)
+    first = threading.Thread(target=failing)
+    first.start()
+    pool.started.wait(5)
+    results = []
+    second = threading.Thread(target=lambda: results.append(pool.exec_command("ok")))
+    second.daemon = True
+    second.start()
+    time.sleep(0.2) # Waiting in acquire() for the only connection
+    pool.proceed.set()
+    first.join(5)
+    second.join(5)
+    self.assertFalse(second.is_alive())
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(results, [(["ok\n"], [])])
+    self.assertEqual(pool.connects, 2)
+
+  def test_connections_are_reused (self):
+    pool = FakePool(2)
+    pool.proceed.set()
+    for i in range(5):
+      pool.exec_command("ok")
+    self.assertEqual(pool.connects, 1)
+    self.assertEqual(pool.open_connections, 1)
+    pool.close()
+    self.assertEqual(pool.open_connections, 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""
+  Prefiltering the event stream and replaying the Verified+1 votes it missed.
+"""
+
+import json
+import unittest
+
+import gerrit_stream_events
+
+
+def make_change (number, patch_number, granted_on):
+  return {"project": "proj", "branch": "master", "id": "I%d" % number, "number": str(number),
+          "subject": "Subject", "owner": {"email": "alice@example.com"}, "url": "http://gerrit/%d" % number,
+          "currentPatchSet": {"number": str(patch_number), "ref": "refs/changes/%d" % number,
+                              "approvals": [{"type": "Verified", "value": "1", "grantedOn": granted_on}]}}
+
+
+def gerrit_line (event):
+  """An event as Gerrit writes it: JSON with Gson's escaping of HTML characters"""
+  line = json.dumps(event)
+  for character in gerrit_stream_events.JSON_ESCAPED_CHARACTERS:
+    line = line.replace(character, "\\u%04x" % ord(character))
+  return line
+
+def comment_added (project, owner = "Alice"):
+  return gerrit_line({"type": "comment-added", "change": {"project": project, "branch": "master",
+                      "owner": {"name": owner, "email": "alice@example.com"}},
+                      "author": {"name": owner}, "approvals": [{"type": "Verified", "value": "1"}]})
+
+def ref_updated (project):
+  return gerrit_line({"type": "ref-updated", "submitter": {"name": "Bob"},
+                      "refUpdate": {"project": project, "refName": "refs/heads/master",
+                                    "oldRev": "a" * 40, "newRev": "b" * 40}})
+
+
+class EventPrefilterTest (unittest.TestCase):
+  def setUp (self):
+    self.prefilter = gerrit_stream_events.EventPrefilter(["comment-added", "ref-updated"],
+                                                         ["proj", "team/tools", 'say "hi"\\now'])
+
+  def test_watched_events_pass (self):
+    self.assertTrue(self.prefilter.accept(comment_added("proj")))
+    self.assertTrue(self.prefilter.accept(ref_updated("team/tools")))
+    # Owner names Gson escapes don't matter, only the project name is looked for
+    self.assertTrue(self.prefilter.accept(comment_added("proj", "O'Brien <ob>")))
+    self.assertTrue(self.prefilter.accept(comment_added('say "hi"\\now')))
+    self.assertEqual(self.prefilter.stats(), {"accepted": 4, "dropped_type": 0, "dropped_project": 0})
+    self.assertEqual(json.loads(comment_added("proj", "O'Brien <ob>"))["change"]["owner"]["name"], "O'Brien <ob>")
+
+  def test_other_types_are_dropped_before_the_projects_are_looked_at (self):
+    self.assertFalse(self.prefilter.accept(gerrit_line({"type": "patchset-created", "change": {"project": "proj"}})))
+    self.assertFalse(self.prefilter.accept(gerrit_line({"type": "change-merged", "change": {"project": "team/tools"}})))
+    self.assertFalse(self.prefilter.accept(comment_added("other")))
+    # Only the whole quoted name matches
+    self.assertFalse(self.prefilter.accept(ref_updated("proj-tools")))
+    self.assertFalse(self.prefilter.accept(ref_updated("team/tools/old")))
+    self.assertEqual(self.prefilter.stats(), {"accepted": 0, "dropped_type": 2, "dropped_project": 3})
+
+  def test_names_gerrit_escapes_turn_the_project_check_off (self):
+    for name in ["a=b", "it's", "r&d", u"caf\xe9"]:
+      self.prefilter.set_projects(["proj", name])
+      self.assertEqual(self.prefilter.project_needles, None)
+      self.assertTrue(self.prefilter.accept(comment_added(name)))
+      # Left for the check after decoding
+      self.assertTrue(self.prefilter.accept(ref_updated("unwatched")))
+      self.assertFalse(self.prefilter.accept(gerrit_line({"type": "patchset-created"})))
+    self.prefilter.set_projects(["proj"])
+    self.assertFalse(self.prefilter.accept(ref_updated("unwatched")))
+
+
+class CatchUpTest (unittest.TestCase):
+  def test_comment_added_from_query (self):
+    event = gerrit_stream_events.comment_added_from_query(make_change(12, 3, 1000), 900)
+    self.assertEqual((event["change"]["number"], event["patchSet"]["number"]), ("12", "3"))
+    self.assertTrue(event["catchUp"])
+    self.assertEqual(gerrit_stream_events.comment_added_from_query(make_change(12, 3, 1000), 1001), None)
+
+  def test_seen_votes_keeps_the_newest (self):
+    seen = gerrit_stream_events.SeenVotes(2)
+    seen.add(1, 1)
+    seen.add("2", "1")
+    seen.add(2, 1)
+    self.assertTrue(seen.contains("1", "1"))
+    seen.add(3, 1)
+    self.assertFalse(seen.contains(1, 1))
+    self.assertTrue(seen.contains(2, 1))
+    self.assertTrue(seen.contains(3, 1))
+    self.assertFalse(seen.contains(3, 2))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+  GitBatch and git_process against a throwaway repo.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+import git_batch
+import git_process
+
+
+def git (cwd, *args):
+  return subprocess.Popen(["git"] + list(args), cwd=cwd, stdout=subprocess.PIPE).communicate()[0].strip()
+
+
+class GitBatchTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    git(self.tmp, "init", "-q")
+    for name, content in [("README", "hello\n"), ("old name", "moved\n" * 20)]:
+      with open(os.path.join(self.tmp, name), "w") as f:
+        f.write(content)
+    git(self.tmp, "add", ".")
+    git(self.tmp, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "-m", "first")
+    self.first = git(self.tmp, "rev-parse", "HEAD")
+    git(self.tmp, "mv", "old name", "new\tname")
+    with open(os.path.join(self.tmp, "README"), "w") as f:
+      f.write("hello again\n")
+    git(self.tmp, "add", ".")
+    git(self.tmp, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "-m", "second\n\nbody")
+    self.second = git(self.tmp, "rev-parse", "HEAD")
+    self.batch = git_batch.GitBatch(self.tmp)
+
+  def tearDown (self):
+    self.batch.close()
+    shutil.rmtree(self.tmp)
+
+  def test_reading_objects (self):
+    info = self.batch.info("HEAD:README")
+    self.assertEqual(info[1:], ("blob", len("hello again\n")))
+    self.assertEqual(self.batch.show(self.first + ":README"), "hello\n")
+    self.assertEqual(self.batch.read_commit("HEAD"), ([self.first], "second\n\nbody"))
+    self.assertEqual(self.batch.read_commit(self.first), ([], "first"))
+
+  def test_missing_objects_dont_break_the_process (self):
+    self.assertEqual(self.batch.info("HEAD:nothing"), None)
+    self.assertEqual(self.batch.read("0" * 40), None)
+    self.assertEqual(self.batch.touched_files("no-such-branch", lambda status, path: None), None)
+    process = self.batch.processes["check"]
+    self.assertEqual(self.batch.info("HEAD:README")[1], "blob")
+    self.assertTrue(self.batch.processes["check"] is process)
+
+  def test_touched_files (self):
+    touched = []
+    self.assertEqual(self.batch.touched_files("HEAD", lambda status, path: touched.append((status[0], path))),
+                     self.second)
+    self.assertEqual(sorted(touched), [("M", "README"), ("R", "new\tname")])
+    touched = []
+    self.batch.touched_files(self.first, lambda status, path: touched.append(path))
+    self.assertEqual(sorted(touched), ["README", "old name"])
+
+  def test_dead_processes_are_restarted (self):
+    self.assertEqual(self.batch.show("HEAD:README"), "hello again\n")
+    self.batch.info("HEAD")
+    for name in ("batch", "check"):
+      self.batch.processes[name].kill()
+      self.batch.processes[name].wait()
+    self.assertEqual(self.batch.show("HEAD:README"), "hello again\n")
+    self.assertEqual(self.batch.info("HEAD")[0], self.second)
+    # Closed under it, whether it already exited or the write fails it gets a new process
+    process = self.batch.processes["check"]
+    process.stdin.close()
+    self.assertEqual(self.batch.info("HEAD")[0], self.second)
+    self.assertFalse(self.batch.processes["check"] is process)
+
+
+class GitProcessTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def test_output_and_failures (self):
+    self.assertEqual(git_process.run(["--version"], self.tmp)[:12], "git version ")
+    try:
+      git_process.run(["rev-parse", "HEAD"], self.tmp)
+      self.fail("rev-parse outside a repo succeeded")
+    except git_process.GitCommandException, e:
+      self.assertNotEqual(e.status, 0)
+      self.assertTrue("fatal" in e.stderr)
+      self.assertEqual(e.repo, self.tmp)
+
+  def test_timeout_kills_the_whole_process_group (self):
+    pid_file = os.path.join(self.tmp, "pid")
+    start = time.time()
+    # sh stands in for git, with a child like ssh under it
+    self.assertRaises(git_process.GitTimeoutException, git_process.run,
+                      ["-c", "sleep 30 & echo $! > '%s'; wait" % pid_file], self.tmp, 0.5, "sh")
+    self.assertTrue(time.time() - start < 10)
+    with open(pid_file) as f:
+      pid = int(f.read())
+    for i in range(50):
+      try:
+        os.kill(pid, 0)
+      except OSError:
+        break
+      time.sleep(0.1)
+    else:
+      self.fail("child %d is still running" % pid)
+
+
+if __name__ == "__main__":
+  unittest.main()
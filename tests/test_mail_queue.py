@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+  MailQueue against an smtpd server on localhost.
+"""
+
+import asyncore
+import smtpd
+import threading
+import unittest
+
+import mail_queue
+import sendMail
+
+
+class RecordingServer (smtpd.SMTPServer):
+  """Keeps the messages it gets and counts the connections made to it"""
+  def __init__ (self, rejects = 0):
+    smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+    self.rejects = rejects
+    self.connections = 0
+    self.messages = []
+
+  def address (self):
+    return "127.0.0.1:%d" % self.socket.getsockname()[1]
+
+  def handle_accept (self):
+    self.connections += 1
+    smtpd.SMTPServer.handle_accept(self)
+
+  def process_message (self, peer, mailfrom, rcpttos, data):
+    if self.rejects > 0:
+      self.rejects -= 1
+      return "451 Try again later"
+    self.messages.append((mailfrom, rcpttos, data))
+
+
+def make_message (number):
+  message = sendMail.EmailMessage()
+  message.setFromAddr("bot@example.com")
+  message.setToAddr(["owner@example.com"])
+  message.setSubject("Review %d" % number)
+  message.setBody("Body of review %d" % number)
+  return message
+
+
+class MailQueueTest (unittest.TestCase):
+  def start_server (self, rejects = 0):
+    self.server = RecordingServer(rejects)
+    self.running = True
+    def loop():
+      while self.running:
+        asyncore.loop(0.05, count = 1)
+    self.thread = threading.Thread(target=loop)
+    self.thread.daemon = True
+    self.thread.start()
+    return self.server
+
+  def tearDown (self):
+    self.running = False
+    self.thread.join(5)
+    asyncore.close_all()
+
+  def test_connection_is_reused (self):
+    server = self.start_server()
+    queue = mail_queue.MailQueue(server.address())
+    queue.start()
+    for i in range(3):
+      queue.put(make_message(i))
+    queue.close(10)
+    self.assertEqual(len(server.messages), 3)
+    self.assertEqual(server.connections, 1)
+    self.assertEqual(queue.stats()["sent"], 3)
+
+  def test_failed_message_is_retried (self):
+    server = self.start_server(rejects = 1)
+    queue = mail_queue.MailQueue(server.address(), retries = 2, backoff = 0)
+    queue.start()
+    queue.put(make_message(1))
+    queue.close(10)
+    self.assertEqual(len(server.messages), 1)
+    self.assertEqual(server.connections, 2)
+    stats = queue.stats()
+    self.assertEqual((stats["sent"], stats["retried"], stats["failed"]), (1, 1, 0))
+
+  def test_gives_up_after_retries (self):
+    server = self.start_server(rejects = 3)
+    queue = mail_queue.MailQueue(server.address(), retries = 1, backoff = 0)
+    queue.start()
+    queue.put(make_message(1))
+    queue.close(10)
+    self.assertEqual(server.messages, [])
+    stats = queue.stats()
+    self.assertEqual((stats["sent"], stats["retried"], stats["failed"]), (0, 1, 1))
+
+  def test_digest (self):
+    server = self.start_server()
+    queue = mail_queue.MailQueue(server.address(), digest_seconds = 60)
+    queue.start()
+    for i in range(3):
+      queue.put(make_message(i), "owner@example.com")
+    queue.put(make_message(3), "other@example.com")
+    queue.close(10)
+    self.assertEqual(len(server.messages), 2)
+    data = [i[2] for i in server.messages if "and 2 more" in i[2]]
+    self.assertEqual(len(data), 1)
+    for i in range(3):
+      self.assertTrue("Body of review %d" % i in data[0])
+    self.assertEqual(queue.stats()["digested"], 3)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+"""
+  The Prometheus text exposition of the metrics.
+"""
+
+import unittest
+
+import metrics
+
+
+class MetricsTest (unittest.TestCase):
+  def test_counter_exposition (self):
+    counter = metrics.Counter("things_total", "Things done", ["kind"])
+    counter.inc(["b"])
+    counter.inc(["a"], 2)
+    counter.inc(["b"])
+    self.assertEqual(counter.expose(), ["# HELP things_total Things done", "# TYPE things_total counter",
+                                        'things_total{kind="a"} 2.0', 'things_total{kind="b"} 2.0'])
+
+  def test_collected_counters_and_gauges (self):
+    stats = {("open",): 3, ("opened",): 10}
+    gauge = metrics.Gauge("repos", "Open repos", ["gauge"], lambda: {("open",): stats[("open",)]})
+    counter = metrics.Counter("repos_total", "Repos opened", ["counter"], lambda: {("opened",): stats[("opened",)]})
+    self.assertEqual(gauge.expose()[1:], ["# TYPE repos gauge", 'repos{gauge="open"} 3.0'])
+    self.assertEqual(counter.expose()[1:], ["# TYPE repos_total counter", 'repos_total{counter="opened"} 10.0'])
+
+  def test_failing_collect_function_exposes_no_values (self):
+    def broken():
+      raise ValueError("gone")
+    self.assertEqual(len(metrics.Counter("broken_total", "Broken", function = broken).expose()), 2)
+
+  def test_label_values_are_escaped (self):
+    gauge = metrics.Gauge("paths", "Paths", ["path"])
+    gauge.set(1, ['C:\\repo "new"\nline'])
+    self.assertEqual(gauge.expose()[2], 'paths{path="C:\\\\repo \\"new\\"\\nline"} 1.0')
+
+  def test_histogram_exposition (self):
+    histogram = metrics.Histogram("stage_seconds", "Stages", ["stage"], buckets = (0.1, 1))
+    histogram.observe(0.05, ["fetch"])
+    histogram.observe(0.5, ["fetch"])
+    histogram.observe(5, ["fetch"])
+    self.assertEqual(histogram.expose()[2:], ['stage_seconds_bucket{stage="fetch",le="0.1"} 1',
+                                              'stage_seconds_bucket{stage="fetch",le="1.0"} 2',
+                                              'stage_seconds_bucket{stage="fetch",le="+Inf"} 3',
+                                              'stage_seconds_sum{stage="fetch"} 5.55',
+                                              'stage_seconds_count{stage="fetch"} 3'])
+
+  def test_registry_ends_with_a_newline (self):
+    registry = metrics.Registry()
+    registry.register(metrics.Gauge("up", "Up")).set(1)
+    self.assertEqual(registry.expose(), "# HELP up Up\n# TYPE up gauge\nup 1.0\n")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""
+  QueryBatcher with a fake query function.
+"""
+
+import unittest
+
+import query_batcher
+
+
+class QueryBatcherTest (unittest.TestCase):
+  def setUp (self):
+    self.queries = []
+    self.batcher = query_batcher.QueryBatcher(self.query, batch_size = 3, max_age = 60)
+
+  def query (self, numbers):
+    self.queries.append(list(numbers))
+    return dict([(i, {"number": i}) for i in numbers if i != "13"])
+
+  def test_waiting_changes_are_queried_together (self):
+    for i in ["1", "2", "3", "4"]:
+      self.batcher.want(i)
+    self.assertEqual(self.batcher.get("2"), {"number": "2"})
+    self.assertEqual(self.queries, [["2", "1", "3"]])
+    self.assertEqual(self.batcher.get("1"), {"number": "1"})
+    self.assertEqual(self.batcher.get("3"), {"number": "3"})
+    self.assertEqual(self.batcher.get("4"), {"number": "4"})
+    self.assertEqual(self.queries, [["2", "1", "3"], ["4"]])
+    self.assertEqual(self.batcher.stats()["wanted"], 0)
+
+  def test_old_results_are_queried_again (self):
+    self.batcher.want("1")
+    self.batcher.want("2")
+    self.batcher.get("1")
+    self.batcher.max_age = -1
+    self.batcher.get("2")
+    self.assertEqual(self.queries, [["1", "2"], ["2"]])
+
+  def test_forgotten_and_failed_changes (self):
+    self.batcher.want("1")
+    self.batcher.want("13")
+    self.batcher.want("14")
+    self.batcher.forget("14")
+    self.assertEqual(self.batcher.get("1"), {"number": "1"})
+    self.assertEqual(self.batcher.get("13"), None)
+    self.assertEqual(self.queries, [["1", "13"], ["13"]])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+  Reloading the config file while workers read the options.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import gerrit2
+
+
+class ReloadTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "config.json")
+    with open(os.path.join(os.path.dirname(__file__), "..", "config.json.example")) as f:
+      self.config = json.load(f)
+    self.config["gitrepos"] = {"proj": {"path": os.path.join(self.tmp, "proj")}}
+    self.config["maintenanceinterval"] = 0
+    self.write()
+    gerrit2.load_options(self.path)
+    gerrit2.set_up_repos()
+
+  def tearDown (self):
+    gerrit2.console_handler = None
+    shutil.rmtree(self.tmp)
+
+  def write (self):
+    with open(self.path, "w") as f:
+      json.dump(self.config, f)
+
+  def test_new_repos_have_their_defaults_when_published (self):
+    errors = []
+    done = threading.Event()
+    def review():
+      while not done.is_set():
+        repos = gerrit2.GITREPOS
+        try:
+          [repos[i]["regexbranch"] for i in repos.keys()]
+        except KeyError, e:
+          errors.append(e)
+    thread = threading.Thread(target=review)
+    thread.start()
+    for i in range(50):
+      self.config["gitrepos"]["proj%d" % i] = {"path": os.path.join(self.tmp, "proj%d" % i)}
+      self.write()
+      self.assertTrue(gerrit2.reload_options(self.path))
+    done.set()
+    thread.join(5)
+    self.assertEqual(errors, [])
+    self.assertEqual(len(gerrit2.watched_projects), 51)
+    self.assertFalse("regexbranch" in self.config["gitrepos"]["proj"])
+
+  def test_bad_file_changes_nothing (self):
+    repos, settle_seconds = gerrit2.GITREPOS, gerrit2.SETTLE_SECONDS
+    self.config["settleseconds"] = settle_seconds + 1
+    self.config["timeoutfetch"] = "soon"
+    self.write()
+    self.assertFalse(gerrit2.reload_options(self.path))
+    self.assertTrue(gerrit2.GITREPOS is repos)
+    self.assertEqual(gerrit2.SETTLE_SECONDS, settle_seconds)
+
+    with open(self.path, "w") as f:
+      f.write("{")
+    self.assertFalse(gerrit2.reload_options(self.path))
+    self.assertTrue(gerrit2.GITREPOS is repos)
+
+  def test_restart_options_are_kept (self):
+    workers = gerrit2.NUMBER_WORKERS
+    self.config["workers"] = workers + 3
+    self.config["settleseconds"] = 17
+    self.write()
+    self.assertTrue(gerrit2.reload_options(self.path))
+    self.assertEqual(gerrit2.NUMBER_WORKERS, workers)
+    self.assertEqual(gerrit2.SETTLE_SECONDS, 17)
+
+  def test_debuglogging_is_applied (self):
+    gerrit2.console_handler = logging.StreamHandler()
+    self.config["debuglogging"] = True
+    self.write()
+    self.assertTrue(gerrit2.reload_options(self.path))
+    self.assertEqual(gerrit2.console_handler.level, logging.DEBUG)
+    self.config["debuglogging"] = False
+    self.write()
+    self.assertTrue(gerrit2.reload_options(self.path))
+    self.assertEqual(gerrit2.console_handler.level, logging.INFO)
+
+
+if __name__ == "__main__":
+  unittest.main()
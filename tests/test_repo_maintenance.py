@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+  RepoLocks and MaintenanceScheduler on throwaway repos.
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import repo_maintenance
+
+
+def git (cwd, *args):
+  subprocess.check_call(["git"] + list(args), cwd=cwd, stdout=open(os.devnull, "w"))
+
+
+class RepoLocksTest (unittest.TestCase):
+  def test_shared_holders_dont_wait_for_each_other (self):
+    locks = repo_maintenance.RepoLocks()
+    with locks.hold("repo", 0) as first:
+      with locks.hold("repo", 0) as second:
+        self.assertTrue(first and second)
+      with locks.hold("repo", 0.2, exclusive = True) as held:
+        self.assertFalse(held)
+    with locks.hold("repo", 0, exclusive = True) as held:
+      self.assertTrue(held)
+
+  def test_shared_gives_up_after_timeout (self):
+    locks = repo_maintenance.RepoLocks()
+    with locks.hold("repo", exclusive = True):
+      start = time.time()
+      with locks.hold("repo", 0.3) as held:
+        self.assertFalse(held)
+      self.assertTrue(time.time() - start >= 0.3)
+    with locks.hold("repo", 0) as held:
+      self.assertTrue(held)
+
+  def test_exclusive_waits_for_release_and_goes_first (self):
+    locks = repo_maintenance.RepoLocks()
+    lock = locks.get("repo")
+    lock.acquire_shared()
+    got = []
+    def gc():
+      with locks.hold("repo", 5, exclusive = True) as held:
+        got.append(held)
+    thread = threading.Thread(target=gc)
+    thread.start()
+    time.sleep(0.1)
+    # A waiting gc keeps new reviews out, so it isn't starved
+    self.assertFalse(lock.acquire_shared(0.1))
+    lock.release_shared()
+    thread.join(5)
+    self.assertEqual(got, [True])
+    self.assertTrue(lock.acquire_shared(0))
+
+
+class MaintenanceSchedulerTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    origin = os.path.join(self.tmp, "origin")
+    os.makedirs(origin)
+    git(origin, "init", "-q")
+    with open(os.path.join(origin, "file"), "w") as f:
+      f.write("content\n")
+    git(origin, "add", "file")
+    git(origin, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "-m", "init")
+    self.mirror = os.path.join(self.tmp, "mirror")
+    git(self.tmp, "clone", "-q", origin, self.mirror)
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def test_gc_is_postponed_while_a_review_holds_the_lock (self):
+    locks = repo_maintenance.RepoLocks()
+    scheduler = repo_maintenance.MaintenanceScheduler(locks, "origin", gc_loose_objects = 0, gc_lock_wait = 0.2)
+    scheduler.set_paths([self.mirror])
+    with locks.hold(self.mirror):
+      self.assertEqual(scheduler.run_once(), 0)
+    stats = scheduler.stats()
+    self.assertEqual((stats["fetches"], stats["gcs"], stats["busy"], stats["dirty"]), (1, 0, 1, 1))
+    self.assertEqual(scheduler.run_once(), 1)
+    stats = scheduler.stats()
+    self.assertEqual((stats["fetches"], stats["gcs"], stats["dirty"]), (2, 1, 0))
+
+  def test_gc_waits_for_the_reviews (self):
+    locks = repo_maintenance.RepoLocks()
+    scheduler = repo_maintenance.MaintenanceScheduler(locks, "origin", gc_loose_objects = 0, gc_lock_wait = 5)
+    scheduler.set_paths([self.mirror])
+    locks.get(self.mirror).acquire_shared()
+    threading.Timer(0.3, locks.get(self.mirror).release_shared).start()
+    self.assertEqual(scheduler.run_once(), 1)
+    self.assertEqual(scheduler.stats()["gcs"], 1)
+
+  def test_missing_paths_are_cloned_on_the_maintenance_thread (self):
+    pool = repo_maintenance.ObjectPool(os.path.join(self.tmp, "pool"))
+    pool.ensure()
+    scheduler = repo_maintenance.MaintenanceScheduler(repo_maintenance.RepoLocks(), "origin", interval = 0, pool = pool)
+    clone = os.path.join(self.tmp, "clone")
+    scheduler.set_paths([self.mirror, clone], {clone: os.path.join(self.tmp, "origin")})
+    self.assertFalse(os.path.exists(clone))
+    scheduler.start()
+    for i in range(100):
+      if scheduler.stats()["clones"] > 0 and pool.is_linked(self.mirror):
+        break
+      time.sleep(0.1)
+    scheduler.close()
+    self.assertEqual(scheduler.stats()["clones"], 1)
+    self.assertTrue(pool.is_linked(clone))
+    self.assertTrue(pool.is_linked(self.mirror))
+
+
+class ObjectPoolTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def test_existing_pool_is_never_gcd (self):
+    path = os.path.join(self.tmp, "pool")
+    os.makedirs(path)
+    git(path, "init", "-q", "--bare")
+    repo_maintenance.ObjectPool(path).ensure()
+    config = subprocess.Popen(["git", "config", "--list"], cwd=path, stdout=subprocess.PIPE).communicate()[0]
+    self.assertTrue("gc.auto=0" in config.splitlines())
+    self.assertTrue("gc.pruneexpire=never" in config.splitlines())
+
+
+if __name__ == "__main__":
+  unittest.main()
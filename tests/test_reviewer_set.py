@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""
+  ReviewerSet and picking the owners of a component for a change's author.
+"""
+
+import unittest
+
+import components
+import gerrit2
+import reviewer_set
+
+
+class ReviewerSetTest (unittest.TestCase):
+  def test_reviewers_are_added_once (self):
+    reviewers = reviewer_set.ReviewerSet()
+    reviewers.add_multiple(["bob", "carol", "bob"], ("a/file", "Matched on: a"))
+    reviewers.add("carol", ("b/file", "Matched on: b"))
+    self.assertEqual(reviewers.keys(), ["bob", "carol"])
+    self.assertEqual(len(reviewers["bob"]), 2)
+    self.assertEqual(reviewers.top(), ("bob", 2))
+    self.assertTrue(reviewers.is_matched("b/file"))
+    del reviewers["carol"]
+    self.assertFalse(reviewers.is_matched("b/file"))
+    self.assertTrue(reviewers.is_matched("a/file"))
+
+  def test_names_differing_in_case_are_one_reviewer (self):
+    reviewers = reviewer_set.ReviewerSet()
+    reviewers.add("Bob", ("a/file", ""))
+    reviewers.add("bob", ("b/file", ""))
+    reviewers.add("BOB", ("c/file", ""))
+    self.assertEqual(reviewers.keys(), ["Bob"])
+    self.assertEqual(len(reviewers["bob"]), 3)
+    self.assertTrue("bOb" in reviewers)
+    self.assertEqual(reviewers.top(), ("Bob", 3))
+    del reviewers["BOB"]
+    self.assertEqual(len(reviewers), 0)
+    self.assertFalse("bob" in reviewers)
+    self.assertFalse(reviewers.is_matched("a/file"))
+
+  def test_excluded_reviewers_are_never_top (self):
+    reviewers = reviewer_set.ReviewerSet(excluded = ["noone"])
+    reviewers.add_multiple(["NoOne", "NoOne", "alice"], ("a/file", ""))
+    self.assertEqual(reviewers.top(), ("alice", 1))
+    reviewers.add("bob", ("b/file", ""))
+    reviewers.add("bob", ("c/file", ""))
+    del reviewers["bob"]
+    self.assertEqual(reviewers.top(), ("alice", 1))
+
+
+class PickOwnerTest (unittest.TestCase):
+  def test_the_author_is_never_picked (self):
+    component = components.Component("core", ["Alice", "bob", "carol"])
+    self.assertEqual(gerrit2.pick_owner(component, "alice"), "bob")
+    self.assertEqual(gerrit2.pick_owner_all(component, "alice"), ["bob", "carol"])
+    self.assertEqual(gerrit2.pick_owner(component, "dave"), "Alice")
+    alone = components.Component("tools", ["Alice"])
+    self.assertEqual(gerrit2.pick_owner(alone, "ALICE"), gerrit2.AUTHOR_NO_ONE)
+    self.assertEqual(gerrit2.pick_owner_all(alone, "alice"), [gerrit2.AUTHOR_NO_ONE])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+  SpillQueue spilling to disk, persisting and recovering.
+"""
+
+from Queue import Empty
+import os
+import shutil
+import tempfile
+import unittest
+
+import spill_queue
+
+
+class SpillQueueTest (unittest.TestCase):
+  def setUp (self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "events.spill")
+
+  def tearDown (self):
+    shutil.rmtree(self.tmp)
+
+  def get_all (self, queue):
+    items = []
+    while True:
+      try:
+        items.append(queue.get(False))
+      except Empty:
+        return items
+
+  def test_spilled_items_come_back_in_order (self):
+    queue = spill_queue.SpillQueue(self.path, high_watermark = 3, low_watermark = 1)
+    for i in range(8):
+      queue.put("event %d\n" % i)
+    self.assertEqual(queue.stats()["memory"], 3)
+    self.assertEqual(queue.stats()["spilled"], 5)
+    self.assertEqual(queue.get(False), "event 0")
+    queue.put("event 8")
+    self.assertEqual(self.get_all(queue), ["event %d" % i for i in range(1, 9)])
+    self.assertFalse(os.path.exists(self.path))
+    self.assertFalse(os.path.exists(self.path + ".offset"))
+    self.assertRaises(Empty, queue.get, True, 0.1)
+
+  def test_offset_is_kept_while_items_are_on_disk (self):
+    queue = spill_queue.SpillQueue(self.path, high_watermark = 2, low_watermark = 0)
+    for i in range(6):
+      queue.put("event %d" % i)
+    self.assertEqual([queue.get(False) for i in range(3)], ["event 0", "event 1", "event 2"])
+    with open(self.path + ".offset") as f:
+      offset = int(f.read())
+    with open(self.path) as f:
+      f.seek(offset)
+      self.assertEqual([i.split("\t", 1)[1] for i in f.readlines()], ["event 4\n", "event 5\n"])
+
+  def test_persist_and_recover_after_partial_consumption (self):
+    queue = spill_queue.SpillQueue(self.path, high_watermark = 2, low_watermark = 0)
+    for i in range(6):
+      queue.put("event %d" % i)
+    self.assertEqual([queue.get(False) for i in range(3)], ["event 0", "event 1", "event 2"])
+    # event 3 in memory, events 4 and 5 past the offset on disk
+    queue.persist()
+    self.assertEqual(os.listdir(self.tmp), ["events.spill"])
+    self.assertEqual(queue.stats()["memory"], 0)
+
+    recovered = spill_queue.SpillQueue(self.path, high_watermark = 2, low_watermark = 0)
+    self.assertEqual(recovered.qsize(), 3)
+    recovered.put("event 6")
+    self.assertEqual(self.get_all(recovered), ["event 3", "event 4", "event 5", "event 6"])
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_recover_skips_the_items_read_before_a_crash (self):
+    queue = spill_queue.SpillQueue(self.path, high_watermark = 2, low_watermark = 0)
+    for i in range(6):
+      queue.put("event %d" % i)
+    queue.get(False)
+    queue.get(False)
+    queue.get(False)
+    # No persist: the items read back into memory are lost, the ones past the offset aren't
+    recovered = spill_queue.SpillQueue(self.path, high_watermark = 2, low_watermark = 0)
+    self.assertEqual(self.get_all(recovered), ["event 4", "event 5"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+  Runs the reviewer assignment of gerrit2.py over the history of a repo,
+  to see how a components-regex.txt would have assigned reviewers.
+
+  Usage: whatif.py [--top N] REPO_PATH COMPONENTS_FILE REVISION_RANGE
+
+  COMPONENTS_FILE is a components-regex.txt on disk, or a REV:PATH spec in
+  the repo, for example origin/master:components-regex.txt.
+  REVISION_RANGE is anything 'git log' takes, for example
+  'origin/master@{1 year ago}..origin/master' or '--since=1.year origin/master'.
+
+  Every commit is treated as if it asked for an AUTOREVIEW: HIGH matches
+  add all their owners, and every other file gets an owner from its NORMAL
+  match.  Merge commits are skipped.  The whole range is read from one
+  'git log' and each distinct path is only matched once per priority.
+"""
+
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict
+import logging
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+import gerrit2
+import git_process
+
+# The header of each commit in the log starts with this
+COMMIT_MARKER = "\x01"
+LOG_FORMAT = "--format=%x01%H%x00%ae"
+MATCH_CACHE_SIZE = 200000
+
+
+class Commit:
+  """The parts of a CommentAddedEvent the matching uses"""
+  def __init__ (self, sha, author, touched_files):
+    self.sha = sha
+    self.author = author
+    if "@" in self.author:
+      self.author = self.author[:self.author.index("@")]
+    self.touched_files = touched_files
+
+
+def nul_tokens (stream, read_size = 65536):
+  """Yields the NUL terminated tokens of stream as they're read"""
+  pending = ""
+  while True:
+    data = os.read(stream.fileno(), read_size)
+    if data == "":
+      break
+    parts = (pending + data).split("\0")
+    pending = parts.pop()
+    for part in parts:
+      yield part
+  if pending != "":
+    yield pending
+
+def parse_log (tokens):
+  """Yields a Commit for each commit of 'git log -z --name-status' output in LOG_FORMAT"""
+  commit = None
+  tokens = iter(tokens)
+  for token in tokens:
+    if token.startswith(COMMIT_MARKER):
+      if commit is not None:
+        yield commit
+      commit = Commit(token[len(COMMIT_MARKER):], tokens.next(), [])
+      continue
+    status = token.lstrip("\n")
+    if status == "" or commit is None:
+      continue
+    path = tokens.next()
+    if status[:1] in ("R", "C"):
+      path = tokens.next() # Renames and copies have the old path first
+    commit.touched_files.append(path)
+  if commit is not None:
+    yield commit
+
+def read_components (repo_path, components_file):
+  if os.path.isfile(components_file):
+    with open(components_file, "r") as f:
+      return f.read()
+  return git_process.run(["show", components_file], repo_path)
+
+
+class WhatIf:
+  def __init__ (self, all_components):
+    self.all_components = all_components
+    self.commits = 0
+    self.files = 0
+    self.load = {}         # reviewer => [commits, times main reviewer, files]
+    self.unmatched = {}    # path => number of commits
+    self.unmatched_commits = 0
+    self.rule_hits = OrderedDict()
+    for key in all_components["regexhigh"].keys():
+      self.rule_hits[("HIGH", key)] = 0
+    for key in all_components["regexnormal"].keys():
+      self.rule_hits[("NORMAL", key)] = 0
+
+  def add (self, commit):
+    self.commits += 1
+    self.files += len(commit.touched_files)
+    reviewers = gerrit2.new_reviewer_set()
+    for (i, match, component) in gerrit2.match_high_priority(commit, self.all_components, reviewers):
+      self.rule_hits[("HIGH", match)] += 1
+    normal_matches = self.all_components["matchernormal"].match_all(commit.touched_files)
+    for (i, match, component) in normal_matches:
+      if component is not None:
+        self.rule_hits[("NORMAL", match)] += 1
+    matches = gerrit2.match_touched_files(commit, self.all_components, normal_matches)
+    reviewers = gerrit2.process_touched_files(commit, self.all_components, starting_reviewers = reviewers,
+                                              matches = matches)
+
+    if gerrit2.AUTHOR_NO_ONE in reviewers:
+      self.unmatched_commits += 1
+      for reason in reviewers[gerrit2.AUTHOR_NO_ONE]:
+        self.unmatched[reason[0]] = self.unmatched.get(reason[0], 0) + 1
+    top_reviewer, top_count = reviewers.top()
+    for reviewer in reviewers.keys():
+      if reviewer == gerrit2.AUTHOR_NO_ONE:
+        continue
+      if reviewer not in self.load:
+        self.load[reviewer] = [0, 0, 0]
+      self.load[reviewer][0] += 1
+      self.load[reviewer][2] += len(reviewers[reviewer])
+      if reviewer == top_reviewer:
+        self.load[reviewer][1] += 1
+
+  def report (self, elapsed, top):
+    print "Evaluated %d commits, %d touched files in %.2f seconds (%.0f commits/sec)" % \
+      (self.commits, self.files, elapsed, self.commits / max(elapsed, 0.000001))
+    print ""
+    print "Reviewer load:"
+    print "  %-24s %10s %10s %10s" % ("reviewer", "commits", "main", "files")
+    by_load = sorted(self.load.items(), key = lambda i: (i[1][0], i[1][2]), reverse = True)
+    for reviewer, (commits, main, files) in by_load[:top]:
+      print "  %-24s %10d %10d %10d" % (reviewer, commits, main, files)
+    if len(by_load) > top:
+      print "  ... %d more reviewers" % (len(by_load) - top)
+    print ""
+    print "Unmatched files: %d paths in %d commits" % (len(self.unmatched), self.unmatched_commits)
+    by_count = sorted(self.unmatched.items(), key = lambda i: i[1], reverse = True)
+    for path, commits in by_count[:top]:
+      print "  %6d  %s" % (commits, path)
+    if len(by_count) > top:
+      print "  ... %d more paths" % (len(by_count) - top)
+    print ""
+    print "Rule hits (files):"
+    for (priority, key), hits in self.rule_hits.items():
+      print "  %-6s %8d  %s" % (priority, hits, key)
+
+
+def main ():
+  parser = optparse.OptionParser(usage = "%prog [--top N] REPO_PATH COMPONENTS_FILE REVISION_RANGE")
+  parser.add_option("--top", type = "int", default = 20, help = "Number of reviewers and unmatched paths to list")
+  (opts, args) = parser.parse_args()
+  if len(args) < 3:
+    parser.error("REPO_PATH, COMPONENTS_FILE and REVISION_RANGE are required")
+  repo_path, components_file = args[0], args[1]
+  revision_range = args[2:]
+
+  # The per file debug logging of the matching would dominate the run time
+  gerrit2.logger.setLevel(logging.ERROR)
+  gerrit2.logger.addHandler(logging.StreamHandler())
+  gerrit2.MATCH_CACHE_SIZE = MATCH_CACHE_SIZE
+
+  try:
+    components_text = read_components(repo_path, components_file)
+  except git_process.GitCommandException, e:
+    print "Couldn't read %s: %s" % (components_file, e.stderr.strip())
+    sys.exit(1)
+  all_components = gerrit2.build_regex_components(components_text, components_file)
+  whatif = WhatIf(all_components)
+
+  start = time.time()
+  log = git_process.popen(["log", "-z", "-M", "--name-status", "--no-merges", LOG_FORMAT] + revision_range,
+                          repo_path, stdout = subprocess.PIPE)
+  for commit in parse_log(nul_tokens(log.stdout)):
+    whatif.add(commit)
+  if log.wait() != 0:
+    print "git log failed with exit status %d" % log.returncode
+    sys.exit(1)
+  whatif.report(time.time() - start, opts.top)
+
+
+if __name__ == "__main__":
+  main()